@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Obstacle avoidance from the Multi-ranger deck.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Multiranger directions, in the order of the range arrays below
+DIRECTIONS = ('front', 'back', 'left', 'right', 'up')
+
+# Velocity (vx, vy, vz) in the body frame pushing away from an obstacle in each direction
+PUSH = np.array([
+    [-1.0, 0.0, 0.0], # front
+    [1.0, 0.0, 0.0], # back
+    [0.0, -1.0, 0.0], # left
+    [0.0, 1.0, 0.0], # right
+    [0.0, 0.0, -1.0], # up
+])
+
+
+def _exponential(x, k=4.0):
+    return (np.exp(-k * x) - np.exp(-k)) / (1.0 - np.exp(-k))
+
+
+# Push strength 1 at the obstacle down to 0 at min_distance, by normalized distance x in [0, 1]
+FALLOFFS = {
+    'linear': lambda x: 1.0 - x,
+    'quadratic': lambda x: (1.0 - x) ** 2,
+    'smooth': lambda x: 1.0 - x * x * (3.0 - 2.0 * x),
+    'exponential': _exponential,
+}
+
+
+class RepulsionField:
+    """Combine all multiranger distances and a target height into one hover setpoint.
+
+    Every direction closer than min_distance pushes away from the obstacle
+    with a strength given by falloff (a FALLOFFS name or a function of the
+    normalized distance), all directions in one vectorized step. The
+    horizontal velocity is limited to max_speed. Height moves towards the
+    target height at most max_z_speed; an obstacle above stops climbing and
+    pushes down.
+    Meant to be called once per tick of a fixed-rate control loop.
+    """
+    def __init__(self, rate_hz, min_distance=0.8, max_speed=0.8, falloff='linear',
+                 up_distance=0.4, max_z_speed=0.5, z_gain=5.0, z=0.0):
+        self.dt = 1.0 / rate_hz
+        self.min_distance = np.array([min_distance] * 4 + [up_distance])
+        self.max_speed = max_speed
+        self.falloff = FALLOFFS[falloff] if isinstance(falloff, str) else falloff
+        self.max_z_speed = max_z_speed
+        self.z_gain = z_gain
+        self.z = z
+
+        # Latest distances, NaN when out of range
+        self.ranges = np.full(len(DIRECTIONS), np.nan)
+        self.push = np.zeros(len(DIRECTIONS))
+        self.velocity = np.zeros(3)
+
+    def read(self, mr):
+        """Take the latest distances from a cflib Multiranger."""
+        for i, direction in enumerate(DIRECTIONS):
+            distance = getattr(mr, direction)
+            self.ranges[i] = np.nan if distance is None else distance
+
+    def command(self, z_target, ranges=None):
+        """Hover setpoint (vx, vy, z) for the latest distances, or ranges in DIRECTIONS order."""
+        if ranges is not None:
+            self.ranges[:] = ranges
+        x = np.clip(self.ranges / self.min_distance, 0.0, 1.0)
+        # Out of range (NaN) pushes nothing
+        np.copyto(self.push, np.nan_to_num(self.falloff(x), nan=0.0))
+        np.dot(self.push, PUSH, out=self.velocity)
+        self.velocity[:2] *= self.max_speed
+
+        speed = np.hypot(self.velocity[0], self.velocity[1])
+        if speed > self.max_speed:
+            self.velocity[:2] *= self.max_speed / speed
+
+        vz = self.z_gain * (z_target - self.z)
+        if self.velocity[2] < 0.0:
+            # No climbing towards an obstacle above
+            vz = min(vz, 0.0) + self.velocity[2] * self.max_z_speed
+        self.velocity[2] = min(max(vz, -self.max_z_speed), self.max_z_speed)
+        self.z = max(0.0, self.z + self.velocity[2] * self.dt)
+        return float(self.velocity[0]), float(self.velocity[1]), float(self.z)
+
+
+#
+# OCCUPANCY GRID
+#
+
+
+# Cell coordinates packed into one int64, +-2^20 cells per axis
+_PACK_OFFSET = 1 << 20
+_PACK_MASK = (1 << 21) - 1
+
+
+class OccupancyGrid:
+    """Rolling occupancy map of the room from multiranger rays, in log-odds.
+
+    The map is sparse: cells live in chunks of chunk_size cells per side,
+    created when a ray first reaches them. At most max_chunks are kept, the
+    least recently updated ones are forgotten first, so memory stays bounded
+    while the drone explores. dims is 2 (x, y) or 3 (x, y, z, the up ranger
+    adds to the map too).
+
+    update() casts all rays of one multiranger reading at once: cells along
+    a ray become more likely free, the cell it ends in more likely occupied.
+    Looking up a cell is a dict lookup and an array index.
+    """
+    def __init__(self, resolution=0.05, dims=2, chunk_size=32, max_chunks=256, max_range=2.0,
+                 l_occupied=0.85, l_free=-0.4, l_min=-2.0, l_max=3.5, threshold=0.5):
+        self.resolution = resolution
+        self.dims = dims
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.max_range = max_range
+        self.l_occupied = l_occupied
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.threshold = threshold
+
+        # chunk index tuple -> log-odds array, least recently updated first
+        self.chunks = OrderedDict()
+        self.updates = 0
+
+        # Distances along a ray at which cells are sampled, half a cell apart
+        self._steps = np.arange(0.0, max_range + resolution, resolution / 2.0)
+        # Rays in DIRECTIONS order in the body frame
+        self._rays = -PUSH if dims == 3 else -PUSH[:4, :2]
+
+    def _world_rays(self, yaw):
+        """Ray directions rotated from the body frame by yaw (in rad)."""
+        c, s = np.cos(yaw), np.sin(yaw)
+        rays = self._rays.copy()
+        rays[:, 0] = c * self._rays[:, 0] - s * self._rays[:, 1]
+        rays[:, 1] = s * self._rays[:, 0] + c * self._rays[:, 1]
+        return rays
+
+    def _cells(self, points):
+        return np.floor(points / self.resolution).astype(np.int64)
+
+    def _pack(self, cells):
+        """One int64 per cell (21 bits per axis), so sets of cells are fast 1D unique/isin."""
+        packed = np.zeros(len(cells), dtype=np.int64)
+        for axis in range(self.dims):
+            packed |= (cells[:, axis] + _PACK_OFFSET) << (21 * axis)
+        return packed
+
+    def _unpack(self, packed):
+        cells = np.empty((len(packed), self.dims), dtype=np.int64)
+        for axis in range(self.dims):
+            cells[:, axis] = ((packed >> (21 * axis)) & _PACK_MASK) - _PACK_OFFSET
+        return cells
+
+    def _by_chunk(self, cells):
+        """(chunk key, mask of cells in that chunk, local cell indexes) for every chunk touched."""
+        unique_keys, inverse = np.unique(self._pack(cells // self.chunk_size), return_inverse=True)
+        local = cells % self.chunk_size
+        for i, key in enumerate(map(tuple, self._unpack(unique_keys).tolist())):
+            mask = inverse == i
+            yield key, mask, tuple(local[mask].T)
+
+    def _chunk(self, key, create):
+        chunk = self.chunks.get(key)
+        if chunk is None and create:
+            chunk = np.zeros((self.chunk_size,) * self.dims, dtype=np.float32)
+            self.chunks[key] = chunk
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+        return chunk
+
+    def _add(self, cells, value):
+        """Add value to the log-odds of unique cells, one np.add.at per chunk touched."""
+        if len(cells) == 0:
+            return
+        for key, _, idx in self._by_chunk(cells):
+            chunk = self._chunk(key, True)
+            self.chunks.move_to_end(key)
+            chunk[idx] = np.clip(chunk[idx] + value, self.l_min, self.l_max)
+
+    def update(self, position, yaw, ranges):
+        """Add one reading: ranges in DIRECTIONS order (NaN when out of range) from position, yaw in rad."""
+        position = np.asarray(position, dtype=float)[:self.dims]
+        rays = self._world_rays(yaw)
+        ranges = np.asarray(ranges, dtype=float)[:len(rays)]
+        hit = ranges <= self.max_range
+        free_until = np.where(hit, ranges, self.max_range)
+
+        # All sample points of all rays at once, (rays, steps, dims)
+        points = position + rays[:, None, :] * self._steps[None, :, None]
+        free = np.unique(self._pack(self._cells(points[self._steps[None, :] < free_until[:, None]])))
+        hit = np.unique(self._pack(self._cells(position + rays[hit] * ranges[hit, None])))
+        # The cell a ray ends in is not also free
+        free = free[~np.isin(free, hit, assume_unique=True)]
+        self._add(self._unpack(free), self.l_free)
+        self._add(self._unpack(hit), self.l_occupied)
+        self.updates += 1
+
+    def _values(self, cells):
+        """Log-odds of many cells, one gather per chunk touched."""
+        values = np.zeros(len(cells), dtype=np.float32)
+        for key, mask, idx in self._by_chunk(cells):
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                values[mask] = chunk[idx]
+        return values
+
+    def log_odds(self, point):
+        """Log-odds of the cell at point, 0 (unknown) where nothing was seen."""
+        cell = np.floor(np.asarray(point[:self.dims]) / self.resolution).astype(int)
+        key = tuple((cell // self.chunk_size).tolist())
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return 0.0
+        return float(chunk[tuple(cell % self.chunk_size)])
+
+    def occupied(self, point):
+        return self.log_odds(point) > self.threshold
+
+    def ranges(self, position, yaw, max_distance, out=None):
+        """Distance to the first occupied cell along each ray within max_distance, NaN if none.
+
+        A fixed number of cell lookups for all rays at once, so the map can
+        stand in for (or back up) the multiranger in RepulsionField.
+        """
+        position = np.asarray(position, dtype=float)[:self.dims]
+        rays = self._world_rays(yaw)
+        if out is None:
+            out = np.full(len(DIRECTIONS), np.nan)
+        out[:] = np.nan
+        steps = self._steps[self._steps <= max_distance]
+        points = position + rays[:, None, :] * steps[None, :, None]
+        occupied = (self._values(self._cells(points.reshape(-1, self.dims))) > self.threshold).reshape(len(rays), -1)
+        seen = occupied.any(axis=1)
+        out[:len(rays)][seen] = steps[occupied.argmax(axis=1)[seen]]
+        return out
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the multiranger avoidance: cost per control tick of the
+vectorized repulsion field, compared to the four scalar remaps it replaces
+and to the tick period, and of occupancy map updates and queries.
+"""
+
+import time
+
+import numpy as np
+
+from avoidance import FALLOFFS, OccupancyGrid, RepulsionField
+
+
+# Settings
+rate = 50 # Hz, control loop rate
+n_ticks = 20000
+min_distance = 0.8 # m
+max_speed = 0.8 # m/s
+
+
+class FakeMultiranger:
+    """Random distances, None when out of range, like cflib's Multiranger."""
+    def __init__(self):
+        self.front = self.back = self.left = self.right = self.up = None
+
+    def update(self):
+        values = np.random.uniform(0.0, 2.0, 5)
+        self.front, self.back, self.left, self.right, self.up = [
+            None if v > 1.5 else float(v) for v in values]
+
+
+def remap(val, inMin, inMax, outMin, outMax):
+    if val < inMin:
+        val = inMin
+    if val > inMax:
+        val = inMax
+    return outMin + (val - inMin) * (outMax - outMin) / (inMax - inMin)
+
+
+def scalar_tick(mr):
+    vx = 0.0
+    vy = 0.0
+    if mr.front is not None:
+        vx -= remap(mr.front, 0.0, min_distance, max_speed, 0.0)
+    if mr.back is not None:
+        vx += remap(mr.back, 0.0, min_distance, max_speed, 0.0)
+    if mr.left is not None:
+        vy -= remap(mr.left, 0.0, min_distance, max_speed, 0.0)
+    if mr.right is not None:
+        vy += remap(mr.right, 0.0, min_distance, max_speed, 0.0)
+    return vx, vy
+
+
+def report(name, costs):
+    period = 1.0 / rate
+    print("{:<28} cost p50 {:6.1f} us p99 {:6.1f} us ({:5.3f} % of the {:.0f} ms tick)".format(
+        name, np.percentile(costs, 50) * 1e6, np.percentile(costs, 99) * 1e6,
+        100 * np.percentile(costs, 99) / period, period * 1000))
+
+
+mr = FakeMultiranger()
+costs = np.zeros(n_ticks)
+for i in range(n_ticks):
+    mr.update()
+    start = time.perf_counter()
+    scalar_tick(mr)
+    costs[i] = time.perf_counter() - start
+report('scalar remap (x, y)', costs)
+
+for falloff in FALLOFFS:
+    field = RepulsionField(rate, min_distance=min_distance, max_speed=max_speed, falloff=falloff, z=0.5)
+    for i in range(n_ticks):
+        mr.update()
+        start = time.perf_counter()
+        field.read(mr)
+        field.command(0.8)
+        costs[i] = time.perf_counter() - start
+    report('field ' + falloff + ' (x, y, z)', costs)
+
+for dims in [2, 3]:
+    grid = OccupancyGrid(dims=dims)
+    update_costs = np.zeros(n_ticks // 10)
+    query_costs = np.zeros(n_ticks // 10)
+    map_ranges = np.zeros(5)
+    for i in range(len(update_costs)):
+        mr.update()
+        field.read(mr)
+        # Fly slowly around a 2 x 2 m room
+        position = (np.cos(i / 500.0), np.sin(i / 500.0), 0.5)
+        yaw = i / 100.0
+        start = time.perf_counter()
+        grid.update(position, yaw, field.ranges)
+        update_costs[i] = time.perf_counter() - start
+        start = time.perf_counter()
+        grid.ranges(position, yaw, min_distance, out=map_ranges)
+        query_costs[i] = time.perf_counter() - start
+    report('map {}D update'.format(dims), update_costs)
+    report('map {}D ranges query'.format(dims), query_costs)
+    print("{:<28} {} chunks".format('', len(grid.chunks)))
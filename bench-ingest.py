@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of control loop jitter with QTM frames decoded in the flight process
+or in a separate process publishing to shared memory (qtm_process in cf-qualisys.py).
+
+Frames of a synthetic recording are replayed at frame_rate and decoded like
+cf-qualisys.py does, while a control loop ticks at control_rate on the same
+event loop and a few threads keep the GIL busy the way cflib's radio
+threads do.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from ingest import ingest_main, receive
+from mocap import Body6d, FlightRecorder, PosePredictor, PoseRing, PoseStore, Rotation, open_recording, replay_recording
+from scheduling import RateScheduler
+
+
+# Settings
+body_counts = [3, 20, 50]
+frame_rate = 300 # Hz
+control_rate = 100 # Hz
+duration = 5.0 # s per run
+radio_threads = 2 # threads competing for the GIL
+ring_slots = 32
+
+
+def write_recording(path, n_bodies, n_frames):
+    recorder = FlightRecorder(path, ['body' + str(i) for i in range(n_bodies)])
+    rot = Rotation([1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0])
+    for frame in range(n_frames):
+        t = frame / frame_rate
+        bodies = [Body6d([1000 * np.cos(t + i), 1000 * np.sin(t + i), 1000.0], rot) for i in range(n_bodies)]
+        recorder.write(int(t * 1e6), frame, bodies)
+    recorder.close()
+
+
+def radio_load(stop):
+    """Pure Python work in short bursts, like a radio thread polling for packets."""
+    while not stop.is_set():
+        sum(range(2000))
+        time.sleep(0.0002)
+
+
+async def control_loop(get_poses, predictor):
+    scheduler = RateScheduler(control_rate)
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        await scheduler.wait_async()
+        poses = get_poses()
+        if poses is not None:
+            poses.position(0)
+            poses.yaw(0)
+            predictor.predict(1, 0.02)
+    return scheduler
+
+
+async def run_single(path, n_bodies):
+    body_names, records = open_recording(path)
+    poses = PoseStore(n_bodies, euler_idxs=[0, 1], euler_mode='lazy')
+    predictor = PosePredictor(n_bodies)
+
+    def on_packet(packet):
+        header, component_6d = packet.get_6d()
+        valid = poses.update_6d(component_6d)
+        predictor.update(poses.pos, valid, packet.timestamp)
+        poses.extpose(0)
+
+    replay = asyncio.create_task(replay_recording(records, on_packet))
+    scheduler = await control_loop(lambda: poses, predictor)
+    replay.cancel()
+    return scheduler, poses.frames
+
+
+async def run_process(path, n_bodies):
+    loop = asyncio.get_running_loop()
+    # Spawned like cf-qualisys.py does, the radio load threads are already running
+    context = multiprocessing.get_context('spawn')
+    control, child_control = context.Pipe()
+    notify, child_notify = context.Pipe(duplex=False)
+    process = context.Process(target=ingest_main, daemon=True,
+                              args=(child_control, child_notify, None, ['body0', 'body1'], 'lazy', None, path))
+    process.start()
+    await receive(loop, control)
+    ring = PoseRing(n_bodies, slots=ring_slots)
+    predictor = PosePredictor(n_bodies)
+    state = {'poses': None, 'frames': 0, 'torn': 0}
+
+    def on_ring():
+        os.read(notify.fileno(), 4096)
+        view = ring.latest()
+        if view is None:
+            return
+        pos = view.pos.copy()
+        valid = view.valid.copy()
+        view.extpose(0)
+        if not view.intact():
+            state['torn'] += 1
+            return
+        state['poses'] = view
+        predictor.update(pos, valid, view.timestamp)
+        state['frames'] += 1
+
+    loop.add_reader(notify.fileno(), on_ring)
+    control.send(('ring', ring.name, ring_slots))
+    scheduler = await control_loop(lambda: state['poses'], predictor)
+    loop.remove_reader(notify.fileno())
+    control.send(('stop',))
+    await receive(loop, control)
+    process.join()
+    state['poses'] = None
+    ring.close()
+    ring.unlink()
+    return scheduler, state['frames']
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_bodies in body_counts:
+            path = os.path.join(tmp, 'bench.qtmrec')
+            write_recording(path, n_bodies, int((duration + 1) * frame_rate))
+            for mode, run in (('single', run_single), ('process', run_process)):
+                stop = threading.Event()
+                threads = [threading.Thread(target=radio_load, args=(stop,), daemon=True) for _ in range(radio_threads)]
+                for thread in threads:
+                    thread.start()
+                scheduler, frames = asyncio.run(run(path, n_bodies))
+                stop.set()
+                for thread in threads:
+                    thread.join()
+                print("{:3d} bodies {:7} | frames {:5d} | jitter p50 {:6.3f} ms p99 {:6.3f} ms p99.9 {:6.3f} ms"
+                      " | overruns {:3d}".format(
+                          n_bodies, mode, frames, scheduler.jitter_percentile(50) * 1000,
+                          scheduler.jitter_percentile(99) * 1000, scheduler.jitter_percentile(99.9) * 1000,
+                          scheduler.overruns))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the respiration signal pipeline: cost per BITalino batch
+compared to the time a batch takes to arrive, at several sampling rates.
+"""
+
+import time
+
+import numpy as np
+
+from biosignal import RespirationPipeline
+
+
+# Settings
+configs = [ # (sampling rate in Hz, samples per batch)
+    (100, 16),
+    (1000, 16),
+    (1000, 100),
+]
+out_rate = 50 # Hz
+n_batches = 2000
+breath_rate = 15 # per minute, of the synthetic signal
+
+
+for sampling_rate, n_samples in configs:
+    pipeline = RespirationPipeline(sampling_rate, out_rate=out_rate)
+    costs = np.zeros(n_batches)
+    for i in range(n_batches):
+        t = (np.arange(n_samples) + i * n_samples) / sampling_rate
+        raw = 512 + 200 * np.sin(2 * np.pi * breath_rate / 60.0 * t) + 5 * np.random.randn(n_samples)
+        start = time.perf_counter()
+        pipeline.process(t, raw)
+        costs[i] = time.perf_counter() - start
+    period = n_samples / sampling_rate
+    print("{:5d} Hz x {:3d} samples | batch period {:7.2f} ms | cost p50 {:6.3f} ms p99 {:6.3f} ms"
+          " ({:5.2f} % of period) | breath rate {:4.1f}/min".format(
+              sampling_rate, n_samples, period * 1000,
+              np.percentile(costs, 50) * 1000, np.percentile(costs, 99) * 1000,
+              100 * np.percentile(costs, 99) / period, pipeline.breath_rate or 0.0))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of script startup: time from launching a script to its first setpoint.
+
+Runs every script several times with CF_STARTUP_BENCH set, so it stops at its
+first setpoint instead of taking off. Time is measured from process launch to
+the 'Time to first setpoint' line. The devices each script uses must be on.
+With cold = True the TOC cache is emptied before every run.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from helpers import CACHE_DIR, LOG_DIR, STARTUP_BENCH_ENV
+
+
+# Settings
+scripts = ['cf-flowdeck.py', 'cf-flowdeck-bitalino.py', 'cf-flowdeck-multiranger-bitalino.py', 'cf-qualisys.py']
+runs = 5
+cold = False
+timeout = 60 # in s, per run
+results_file = os.path.join(LOG_DIR, 'startup-bench.csv') # script, unix time, cold, time to first setpoint in s
+
+
+env = dict(os.environ, **{STARTUP_BENCH_ENV: '1'})
+here = os.path.dirname(os.path.abspath(__file__))
+
+os.makedirs(os.path.dirname(results_file), exist_ok=True)
+with open(results_file, 'a') as results:
+    for script in scripts:
+        times = []
+        for run in range(runs):
+            if cold:
+                shutil.rmtree(CACHE_DIR, ignore_errors=True)
+            start = time.monotonic()
+            proc = subprocess.Popen([sys.executable, os.path.join(here, script)], cwd=here, env=env,
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True)
+            elapsed = None
+            for line in proc.stdout:
+                if 'Time to first setpoint' in line:
+                    elapsed = time.monotonic() - start
+                    break
+                if time.monotonic() - start > timeout:
+                    break
+            # The script stops by itself after its first setpoint, keep draining its output meanwhile
+            try:
+                proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+            if elapsed is None:
+                print('{}: run {} did not reach its first setpoint (exit code {})'.format(script, run + 1, proc.returncode))
+                continue
+            times.append(elapsed)
+            results.write('{},{:.3f},{},{:.3f}\n'.format(script, time.time(), int(cold), elapsed))
+        if times:
+            print('{:<38} first setpoint after min {:6.2f} s median {:6.2f} s max {:6.2f} s ({} runs{})'.format(
+                script, min(times), np.median(times), max(times), len(times), ', cold cache' if cold else ''))
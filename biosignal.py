@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+BITalino acquisition and respiration signal handling for the flight scripts.
+"""
+
+import time
+from threading import Lock, Thread
+
+import numpy as np
+
+
+class BitalinoAcquisition(Thread):
+    """Read BITalino samples on their own thread into a preallocated ring buffer.
+
+    bt.read() blocks until n_samples are available, so the flight loop never
+    calls it directly. Instead it takes the latest samples with latest() or
+    window(), which never wait for the device. Samples are timestamped with
+    time.monotonic(), spaced by the sampling period back from the time the
+    batch arrived. on_batch, if set, is called on the acquisition thread with
+    the (times, samples) of every new batch.
+    """
+    def __init__(self, bt, sampling_rate, n_samples=16, n_columns=6, buffer_seconds=10.0):
+        Thread.__init__(self, daemon=True)
+
+        self.bt = bt
+        self.sampling_rate = sampling_rate
+        self.n_samples = n_samples
+
+        capacity = max(n_samples, int(buffer_seconds * sampling_rate))
+        self.data = np.zeros((capacity, n_columns))
+        self.times = np.zeros(capacity)
+        # Total number of samples written, the ring index is count % capacity
+        self.count = 0
+        self.batches = 0
+        self.error = None
+        self.on_batch = None
+
+        self._offsets = (np.arange(n_samples) - (n_samples - 1)) / sampling_rate
+        self._batch_times = np.zeros(n_samples)
+        self._lock = Lock()
+        self._stay_open = True
+
+    def close(self):
+        self._stay_open = False
+        self.join()
+
+    def run(self):
+        capacity = len(self.data)
+        while self._stay_open:
+            try:
+                batch = self.bt.read(self.n_samples)
+            except Exception as ex:
+                # Keep the error for the flight loop, which decides whether to land
+                self.error = ex
+                return
+            np.add(self._offsets, time.monotonic(), out=self._batch_times)
+            n_columns = min(batch.shape[1], self.data.shape[1])
+
+            start = self.count % capacity
+            end = start + self.n_samples
+            with self._lock:
+                if end <= capacity:
+                    self.data[start:end, :n_columns] = batch[:, :n_columns]
+                    self.times[start:end] = self._batch_times
+                else:
+                    split = capacity - start
+                    self.data[start:, :n_columns] = batch[:split, :n_columns]
+                    self.data[:end - capacity, :n_columns] = batch[split:, :n_columns]
+                    self.times[start:] = self._batch_times[:split]
+                    self.times[:end - capacity] = self._batch_times[split:]
+                self.count += self.n_samples
+                self.batches += 1
+            if self.on_batch:
+                self.on_batch(self._batch_times, batch)
+
+    def latest(self, column=5):
+        """Latest (time, value) of one column, or None before the first batch."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % len(self.data)
+            return self.times[i], self.data[i, column]
+
+    def window(self, n, column=5):
+        """Copies of the times and values of the last n samples (fewer at start-up), oldest first."""
+        capacity = len(self.data)
+        with self._lock:
+            n = min(n, self.count, capacity)
+            end = self.count % capacity
+            idx = np.arange(end - n, end) % capacity
+            return self.times[idx], self.data[idx, column]
+
+
+#
+# RESPIRATION SIGNAL PROCESSING
+#
+
+
+def remap_array(values, inMin, inMax, outMin, outMax, out=None):
+    """Vectorized remap: clip values to [inMin, inMax] and map linearly to [outMin, outMax]."""
+    out = np.clip(values, min(inMin, inMax), max(inMin, inMax), out=out)
+    out -= inMin
+    out *= (outMax - outMin) / (inMax - inMin)
+    out += outMin
+    return out
+
+
+def butter2_lowpass(cutoff, fs):
+    """Second-order Butterworth low-pass (b, a) via the bilinear transform."""
+    k = np.tan(np.pi * cutoff / fs)
+    norm = 1.0 / (1.0 + np.sqrt(2.0) * k + k * k)
+    b0 = k * k * norm
+    return (b0, 2.0 * b0, b0), (1.0, 2.0 * (k * k - 1.0) * norm, (1.0 - np.sqrt(2.0) * k + k * k) * norm)
+
+
+def one_pole_lowpass(cutoff, fs):
+    """First-order low-pass (b, a), for slow baselines."""
+    p = np.exp(-2.0 * np.pi * cutoff / fs)
+    return (1.0 - p, 0.0, 0.0), (1.0, -p, 0.0)
+
+
+class BlockIIR:
+    """Second-order IIR filter applied to whole batches with matrix products.
+
+    The recursion is unrolled for a batch length n: y = H x + O s and
+    s' = A s + C x, with s the 2-element filter state carried between batches.
+    The matrices are computed once per batch length, so filtering a batch is
+    two small matrix-vector products instead of a per-sample Python loop.
+    """
+    def __init__(self, b, a):
+        a0 = a[0]
+        self.b = [v / a0 for v in b]
+        self.a = [v / a0 for v in a]
+        self.state = np.zeros(2)
+        self._initialized = False
+        self._matrices = {}
+
+    def _step(self, s, x):
+        """One sample of direct form II transposed, returns (y, new state)."""
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+        y = b0 * x + s[0]
+        return y, np.array([b1 * x - a1 * y + s[1], b2 * x - a2 * y])
+
+    def _unroll(self, n):
+        # Response to each unit state and each unit input, by running the recursion once per basis vector
+        H = np.zeros((n, n))
+        O = np.zeros((n, 2))
+        A = np.zeros((2, 2))
+        C = np.zeros((2, n))
+        for j in range(2):
+            s = np.zeros(2)
+            s[j] = 1.0
+            for i in range(n):
+                O[i, j], s = self._step(s, 0.0)
+            A[:, j] = s
+        # Impulse response, H is Toeplitz
+        s = np.zeros(2)
+        h = np.zeros(n)
+        for i in range(n):
+            h[i], s = self._step(s, 1.0 if i == 0 else 0.0)
+        for i in range(n):
+            H[i:, i] = h[:n - i]
+        # Final state from each input sample: impulse at i then n - 1 - i free steps
+        for i in range(n):
+            s = np.zeros(2)
+            _, s = self._step(s, 1.0)
+            for _ in range(n - 1 - i):
+                _, s = self._step(s, 0.0)
+            C[:, i] = s
+        return H, O, A, C
+
+    def process(self, x):
+        n = len(x)
+        if n not in self._matrices:
+            self._matrices[n] = self._unroll(n)
+        H, O, A, C = self._matrices[n]
+        if not self._initialized:
+            # Start in steady state at the first sample to avoid a long start-up transient
+            dc = sum(self.b) / sum(self.a)
+            b0, _, b2 = self.b
+            a2 = self.a[2]
+            y0 = dc * x[0]
+            self.state[:] = (y0 - b0 * x[0], b2 * x[0] - a2 * y0)
+            self._initialized = True
+        y = H @ x + O @ self.state
+        self.state = A @ self.state + C @ x
+        return y
+
+
+class RespirationPipeline:
+    """Streaming processing of whole batches of raw respiration samples.
+
+    Per batch: second-order low-pass with carried state, baseline removal
+    (detrend) with a slow low-pass, decimation to out_rate with carried phase,
+    and an incremental breath rate and phase estimate from upward zero
+    crossings of the detrended signal. z and LED colour are mapped from the
+    decimated signal in one vectorized step. Meant to be called with every
+    new batch, e.g. as BitalinoAcquisition.on_batch.
+    """
+    def __init__(self, sampling_rate, out_rate=50, cutoff=1.0, baseline_cutoff=0.05,
+                 sensor_min=0, sensor_max=1024, z_min=0.5, z_max=1.2, led_min=0, led_max=100,
+                 hysteresis=5.0, min_breath_period=1.0, max_breath_period=15.0):
+        self.sampling_rate = sampling_rate
+        self.decimation = max(1, int(round(sampling_rate / out_rate)))
+        self.out_rate = sampling_rate / self.decimation
+        self.sensor_min = sensor_min
+        self.sensor_max = sensor_max
+        self.z_min = z_min
+        self.z_max = z_max
+        self.led_min = led_min
+        self.led_max = led_max
+        self.hysteresis = hysteresis
+        self.min_breath_period = min_breath_period
+        self.max_breath_period = max_breath_period
+
+        cutoff = min(cutoff, 0.45 * self.out_rate)
+        self._lowpass = BlockIIR(*butter2_lowpass(cutoff, sampling_rate))
+        self._baseline = BlockIIR(*one_pole_lowpass(baseline_cutoff, sampling_rate))
+        self._phase = 0
+
+        # Breath detection state
+        self._above = False
+        self._last_crossing = None
+        self.breath_period = None
+
+        # Latest outputs
+        self.filtered = None
+        self.detrended = None
+        self.z = None
+        self.led = None
+        self.breath_rate = None
+        self.breath_phase = None
+        self.batches = 0
+
+    def process(self, times, raw):
+        """Process one batch. times: sample timestamps in s, raw: sensor values."""
+        raw = np.asarray(raw, dtype=float)
+        filtered = self._lowpass.process(raw)
+        detrended = filtered - self._baseline.process(filtered)
+
+        # Decimate, carrying the phase over batch boundaries
+        idx = slice(self._phase, None, self.decimation)
+        out_times = times[idx]
+        out_filtered = filtered[idx]
+        out_detrended = detrended[idx]
+        self._phase = (self._phase - len(raw)) % self.decimation
+        if len(out_filtered) == 0:
+            return
+
+        self._update_breath(out_times, out_detrended)
+
+        # Vectorized output mappings
+        z = remap_array(out_filtered, self.sensor_min, self.sensor_max, self.z_min, self.z_max)
+        red = remap_array(out_filtered, self.sensor_min, self.sensor_max, self.led_min, self.led_max)
+        self.filtered = out_filtered
+        self.detrended = out_detrended
+        self.z = z
+        self.led = np.stack((red, np.zeros_like(red), self.led_max - red), axis=1)
+        self.batches += 1
+
+        if self.breath_period:
+            self.breath_rate = 60.0 / self.breath_period
+            self.breath_phase = ((out_times[-1] - self._last_crossing) / self.breath_period) % 1.0
+
+    def _update_breath(self, times, x):
+        """Upward zero crossings with hysteresis, found for the whole batch at once."""
+        # Schmitt trigger state is carried over batches; only samples outside the
+        # hysteresis band can change it
+        high = x > self.hysteresis
+        low = x < -self.hysteresis
+        decided = np.nonzero(high | low)[0]
+        if len(decided) == 0:
+            return
+        states = high[decided]
+        prev = np.concatenate(([self._above], states[:-1]))
+        rising = decided[states & ~prev]
+        self._above = bool(states[-1])
+        for t in times[rising]:
+            if self._last_crossing is not None:
+                period = t - self._last_crossing
+                if self.min_breath_period <= period <= self.max_breath_period:
+                    # Smooth over breaths
+                    if self.breath_period is None:
+                        self.breath_period = period
+                    else:
+                        self.breath_period += 0.3 * (period - self.breath_period)
+            self._last_crossing = t
+
+    def latest(self):
+        """Latest (z, (r, g, b)), or None before the first output."""
+        z, led = self.z, self.led
+        if z is None:
+            return None
+        return float(z[-1]), (int(led[-1, 0]), int(led[-1, 1]), int(led[-1, 2]))
@@ -3,24 +3,17 @@
 
 import logging
 import numpy
+import sys
 import time
 from threading import Thread
 
-from bitalino import BITalino
-
 import cflib.crtp
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.positioning.motion_commander import MotionCommander
 
-# Fns
-
-def remap(val, inMin=0, inMax=1024, outMin=0.5, outMax=1.5):
-    if val < inMin:
-        val = inMin
-    if val > inMax:
-        val = inMax
-    return outMin + (val - inMin) * (outMax - outMin) / (inMax - inMin)
-
+from biosignal import BitalinoAcquisition, RespirationPipeline
+from helpers import Startup, bt_connect, cf_connect, cf_preflight_reset, first_setpoint, ring_blink
+from ledring import LedRing
+from scheduling import RateScheduler
 
 # Bitalino Settings
 bt_macAddress = "98:D3:71:FD:63:15"
@@ -29,15 +22,23 @@ bt_acqChannels = [0]
 bt_samplingRate = 100
 bt_nSamples = 16
 bt_timeout = 2
+bt_connectRetries = 10
 bt_respSensorMin = 0
 bt_respSensorMax = 1024
+bt_respCutoff = 1.0 # Hz, low-pass on the respiration signal before it drives z
 
 # Crazyflie Settings
 cf_uri = 'radio://0/80/2M'
+cf_connectRetries = 3
 cf_zMin = 0.5
 cf_zMax = 1.2
 cf_ledMin = 0
 cf_ledMax = 100
+cf_setpointRate = 50 # Hz, independent of the BITalino sampling rate
+cf_ledRate = 10 # Hz, max LED ring update rate
+
+# Give up if a device is not connected within this many seconds
+startup_timeout = 30
 
 # Run for a finite number of seconds
 running_time = 16
@@ -45,89 +46,100 @@ running_time = 16
 # Init Crazyflie
 cflib.crtp.init_drivers(enable_debug_driver=False)
 
-with SyncCrazyflie(cf_uri) as scf:
+
+def on_bitalino_retry(attempt, error):
+    # Blink the LED ring once the Crazyflie is connected
+    scf = startup.ready('crazyflie')
+    if scf:
+        ring_blink(scf.cf)
+
+
+# Connect to the Crazyflie and the BITalino at the same time
+startup = Startup(timeout=startup_timeout)
+startup.add('crazyflie', lambda: cf_connect(cf_uri), close=lambda scf: scf.close_link(),
+            retries=cf_connectRetries)
+startup.add('bitalino', lambda: bt_connect(bt_macAddress, timeout=bt_timeout, retries=1),
+            close=lambda bt: bt.close(), retries=bt_connectRetries, on_retry=on_bitalino_retry)
+
+with startup as devices:
+    print(startup.report())
+    scf = devices['crazyflie']
+    bt = devices['bitalino']
     cf = scf.cf
-    cf.param.set_value('ring.effect', '0')
-    cf.param.set_value('kalman.resetEstimation', '1')
-    time.sleep(0.1)
-    cf.param.set_value('kalman.resetEstimation', '0')
-
-    # Connect to BITalino
-    print("Connecting to Bitalino " + bt_macAddress)
-    for i in range(0,10):
-        cf.param.set_value('ring.effect', '1')
-        try:
-            bt = BITalino(bt_macAddress, timeout=bt_timeout)
-        except OSError:
-            print("Connection " + str(i+1) + "/10 failed! Retrying...")
-            cf.param.set_value('ring.effect', '9')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '0')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '9')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '0')
-            time.sleep(0.1)
-            continue
-        finally:
-            print("Connected to Bitalino " + bt_macAddress)
-        break
+    # Cached param writes, repeated values are not sent again
+    params = cf_preflight_reset(cf)
 
     # Set battery threshold
     bt.battery(bt_batteryThreshold)
         
-    # Start Acquisition
+    # Start Acquisition, read on its own thread
     bt.start(bt_samplingRate, bt_acqChannels)
+    acquisition = BitalinoAcquisition(bt, bt_samplingRate, bt_nSamples)
+    # Filter every batch as a whole on the acquisition thread
+    pipeline = RespirationPipeline(bt_samplingRate, out_rate=cf_setpointRate, cutoff=bt_respCutoff,
+                                   sensor_min=bt_respSensorMin, sensor_max=bt_respSensorMax,
+                                   z_min=cf_zMin, z_max=cf_zMax, led_min=cf_ledMin, led_max=cf_ledMax)
+    acquisition.on_batch = lambda times, batch: pipeline.process(times, batch[:, 5])
+    acquisition.start()
 
     start = time.time()
     end = time.time()
 
     # Lift-off warning
-    cf.param.set_value('ring.effect', '6')
+    params.set('ring.effect', '6')
     time.sleep(2)
 
     # Lift-off
+    if first_setpoint():
+        acquisition.close()
+        bt.stop()
+        params.close()
+        sys.exit()
     cf.commander.send_hover_setpoint(0, 0, 0, 0.5)
 
-    # Set solid color effect
-    cf.param.set_value('ring.effect', '7')
+    # Write colours to the LED ring memory
+    led_ring = LedRing(cf, max_rate=cf_ledRate, params=params)
+    led_ring.enable()
 
     # It's on
+    z = 0.5
+    led = None
+    scheduler = RateScheduler(cf_setpointRate)
+    print_every = max(1, int(cf_setpointRate / cf_ledRate))
     while (end - start) < running_time:
-        # Read respiration sensor at A0
-        dataAcquired = bt.read(bt_nSamples)
-        for sample in range(bt_nSamples):
-            resp = dataAcquired[sample, 5]
+        scheduler.wait()
+        if acquisition.error:
+            print("Bitalino read failed: " + str(acquisition.error))
+            break
+        # Latest filtered respiration sensor output at A0, never waits for the BITalino
+        output = pipeline.latest()
+        if output is not None:
             # Set z
-            if sample in set([0]):
-                print("Resp: " + str(int(resp)))
-                z = remap(resp, bt_respSensorMin, bt_respSensorMax, cf_zMin, cf_zMax)
-                print("z:    " + str(y))
-                cf.commander.send_hover_setpoint(0, 0, 0, z)
-            # Set light
-            if sample in set([0, 4, 8, 12]):
-                print("Resp:  " + str(int(resp)))
-                led_r = int(remap(resp, bt_respSensorMin, bt_respSensorMax, cf_ledMin, cf_ledMax))
-                led_g = 0
-                led_b = int(cf_ledMax - led_r)
+            z, led = output
+        cf.commander.send_hover_setpoint(0, 0, 0, z)
+        # Set light, only sent when it visibly changes and at most at cf_ledRate
+        if led is not None:
+            led_r, led_g, led_b = led
+            led_ring.set_all(led_r, led_g, led_b)
+            if scheduler.ticks % print_every == 0:
+                print("Resp:  " + str(int(pipeline.filtered[-1])))
                 print("z:     " + str(z))
                 print("led_r: " + str(led_r))
-                cf.param.set_value('ring.solidBlue', str(led_b))
-                cf.param.set_value('ring.solidRed', str(led_r))
-                cf.param.set_value('ring.solidGreen', str(led_g))
-            time.sleep(0.01)
+                if pipeline.breath_rate:
+                    print("Breath rate: {:4.1f}/min".format(pipeline.breath_rate))
         end = time.time()
+    acquisition.close()
+    print("LED ring: " + str(led_ring.stats()))
     
     # Land Crazyflie smoothly
     while (z > 0):
         z -= 0.05
         cf.commander.send_hover_setpoint(0, 0, 0, z)
         time.sleep(0.1)
-    cf.param.set_value('ring.effect', '0')
+    params.set('ring.effect', '0')
+    params.close()
+    print("Params: " + str(params.stats()))
 
         
-    # Stop acquisition
-    bt.stop()
-        
-    # Close connection
-    bt.close()
\ No newline at end of file
+    # Stop acquisition, the connections are closed when leaving startup
+    bt.stop()
\ No newline at end of file
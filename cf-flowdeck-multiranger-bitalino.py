@@ -42,18 +42,24 @@ For the example to run the following hardware is needed:
  * Multiranger deck
 """
 import logging
+import math
 import sys
 import time
 
-from bitalino import BITalino
+import numpy as np
 
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.mem import MemoryElement
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+from cflib.crazyflie.log import LogConfig
 from cflib.positioning.motion_commander import MotionCommander
 from cflib.utils.multiranger import Multiranger
 
+from avoidance import OccupancyGrid, RepulsionField
+from biosignal import BitalinoAcquisition, RespirationPipeline
+from helpers import Startup, bt_connect, cf_connect, cf_preflight_reset, first_setpoint, ring_blink
+from ledring import LedRing
+from scheduling import RateScheduler
+
 # Bitalino Settings
 bt_macAddress = "98:D3:71:FD:63:15"
 bt_batteryThreshold = 30
@@ -61,26 +67,41 @@ bt_acqChannels = [0]
 bt_samplingRate = 100
 bt_nSamples = 16
 bt_timeout = 2
+bt_connectRetries = 10
 bt_respSensorMin = 0
 bt_respSensorMax = 1024
+bt_respCutoff = 1.0 # Hz, low-pass on the respiration signal before it drives z
 
 #Crazyflie Settings
 cf_uri = 'radio://0/80/2M'
+cf_connectRetries = 3
 cf_minDistance = 0.8  # m
 cf_maxSpeed = 0.8 # m/s
-cf_zSpeed = 0.1 # m
+cf_falloff = 'linear' # how avoidance speed grows as obstacles get closer, see avoidance.FALLOFFS
+cf_upDistance = 0.4 # m, obstacles above closer than this push down
+cf_zSpeed = 0.5 # m/s, max vertical speed
+
+# Remember obstacles in an occupancy map built from the ranges and the flow deck position,
+# so they are avoided also when the multiranger does not see them
+cf_map = True
+cf_mapDims = 2 # 2 for x, y or 3 to map the ceiling as well
+cf_mapResolution = 0.05 # m
+cf_mapRate = 10 # Hz, the multiranger logs at 10 Hz
 cf_zMin = 0.5
 cf_zMax = 1.2
+cf_setpointRate = 50 # Hz, independent of the BITalino sampling rate
 
-# Run for a finite number of seconds
-running_time = 16
+# LED ring shows the multiranger distances: red for front/right/back/left, blue for up
+cf_ledRanges = False
+cf_ledRate = 10 # Hz, max LED ring update rate
+cf_ledRangeLeds = {'front': [0, 1, 11], 'right': [2, 3, 4], 'back': [5, 6, 7], 'left': [8, 9, 10]}
+cf_ledUpLeds = [1, 2, 4, 5, 7, 8, 10, 11]
 
+# Give up if a device is not connected within this many seconds
+startup_timeout = 30
 
-def is_close(range):
-    if range is None:
-        return False
-    else:
-        return range < MIN_DISTANCE
+# Run for a finite number of seconds
+running_time = 16
 
 
 def remap(val, inMin=0.0, inMax=1.5, outMin=60.0, outMax=0.0):
@@ -93,146 +114,139 @@ def remap(val, inMin=0.0, inMax=1.5, outMin=60.0, outMax=0.0):
 
 cflib.crtp.init_drivers(enable_debug_driver=False)
 
-with SyncCrazyflie(cf_uri) as scf:
+
+def on_bitalino_retry(attempt, error):
+    # Blink the LED ring once the Crazyflie is connected
+    scf = startup.ready('crazyflie')
+    if scf:
+        ring_blink(scf.cf)
+
+
+# Connect to the Crazyflie and the BITalino at the same time
+startup = Startup(timeout=startup_timeout)
+startup.add('crazyflie', lambda: cf_connect(cf_uri), close=lambda scf: scf.close_link(),
+            retries=cf_connectRetries)
+startup.add('bitalino', lambda: bt_connect(bt_macAddress, timeout=bt_timeout, retries=1),
+            close=lambda bt: bt.close(), retries=bt_connectRetries, on_retry=on_bitalino_retry)
+
+with startup as devices:
+    print(startup.report())
+    scf = devices['crazyflie']
+    bt = devices['bitalino']
 
     cf = scf.cf
 
-    # Start LED Deck with effect 1 = White Spinner
-    cf.param.set_value('ring.effect', '1')
+    # Cached param writes, repeated values are not sent again
+    params = cf_preflight_reset(cf)
 
-    cf.param.set_value('kalman.resetEstimation', '1')
-    time.sleep(0.1)
-    cf.param.set_value('kalman.resetEstimation', '0')
+    # Start LED Deck with effect 1 = White Spinner
+    params.set('ring.effect', '1')
     time.sleep(2)
 
-    # Connect to BITalino
-    print("Connecting to Bitalino " + bt_macAddress)
-    for i in range(0,10):
-        cf.param.set_value('ring.effect', '1')
-        try:
-            bt = BITalino(bt_macAddress, timeout=bt_timeout)
-        except OSError:
-            print("Connection " + str(i+1) + "/10 failed! Retrying...")
-            cf.param.set_value('ring.effect', '9')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '0')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '9')
-            time.sleep(0.1)
-            cf.param.set_value('ring.effect', '0')
-            time.sleep(0.1)
-            continue
-        finally:
-            print("Connected to Bitalino " + bt_macAddress)
-        break
-
      # Set battery threshold
     bt.battery(bt_batteryThreshold)
         
-    # Start Acquisition
+    # Start Acquisition, read on its own thread
     bt.start(bt_samplingRate, bt_acqChannels)
+    acquisition = BitalinoAcquisition(bt, bt_samplingRate, bt_nSamples)
+    # Filter every batch as a whole on the acquisition thread
+    pipeline = RespirationPipeline(bt_samplingRate, out_rate=cf_setpointRate, cutoff=bt_respCutoff,
+                                   sensor_min=bt_respSensorMin, sensor_max=bt_respSensorMax,
+                                   z_min=cf_zMin, z_max=cf_zMax)
+    acquisition.on_batch = lambda times, batch: pipeline.process(times, batch[:, 5])
+    acquisition.start()
 
     start = time.time()
     end = time.time()
 
     with Multiranger(scf) as mr:
 
-        # Set LED Deck effect param to 13 = N/A
-        # To write to individual LEDs
-        # cf.param.set_value('ring.effect', '13')
-        # mem = cf.mem.get_mems(MemoryElement.TYPE_DRIVER_LED)
-
         # Lift-off warning
-        cf.param.set_value('ring.effect', '6')
+        params.set('ring.effect', '6')
         time.sleep(2)
 
         # Lift-off
+        if first_setpoint():
+            acquisition.close()
+            bt.stop()
+            params.close()
+            sys.exit()
         cf.commander.send_hover_setpoint(0, 0, 0, 0.5)
 
-        # Set solid color effect
-        cf.param.set_value('ring.effect', '7')
-
-
+        led_ring = None
+        if cf_ledRanges:
+            # Write to individual LEDs through the LED ring memory
+            led_ring = LedRing(cf, max_rate=cf_ledRate, params=params)
+            led_ring.enable()
+            led_frame = np.zeros((12, 3))
+        else:
+            # Set solid color effect
+            params.set('ring.effect', '7')
+
+
+        # One velocity command from all ranges and the respiration height, every tick
+        avoidance = RepulsionField(cf_setpointRate, min_distance=cf_minDistance, max_speed=cf_maxSpeed,
+                                   falloff=cf_falloff, up_distance=cf_upDistance, max_z_speed=cf_zSpeed, z=0.5)
+        z_target = 0.5
+        z = 0.5
+
+        occupancy = None
+        if cf_map:
+            occupancy = OccupancyGrid(resolution=cf_mapResolution, dims=cf_mapDims)
+            map_ranges = np.full(len(avoidance.ranges), np.nan)
+            map_every = max(1, int(cf_setpointRate / cf_mapRate))
+            # Latest x, y, z and yaw from the flow deck estimate
+            cf_pose = np.full(4, np.nan)
+
+            def on_position(timestamp, data, logconf):
+                cf_pose[:] = (data['stateEstimate.x'], data['stateEstimate.y'],
+                              data['stateEstimate.z'], math.radians(data['stabilizer.yaw']))
+
+            position_log = LogConfig(name='Position', period_in_ms=int(1000 / cf_mapRate))
+            for variable in ['stateEstimate.x', 'stateEstimate.y', 'stateEstimate.z', 'stabilizer.yaw']:
+                position_log.add_variable(variable, 'float')
+            cf.log.add_config(position_log)
+            position_log.data_received_cb.add_callback(on_position)
+            position_log.start()
+
+        scheduler = RateScheduler(cf_setpointRate)
         while (end - start) < running_time:
+            scheduler.wait()
+            if acquisition.error:
+                print("Bitalino read failed: " + str(acquisition.error))
+                break
             
-            # Avoid obstacles
-            vx = 0.0
-            vy = 0.0
-
-            if mr.front is not None:
-                dvx = remap(mr.front, 0.0, cf_minDistance, cf_maxSpeed, 0.0)
-                vx -= dvx
-                # print("FRONT: " + str(mr.front) + " --> " + str(dvx))
-            if mr.back is not None:
-                dvx = remap(mr.back,  0.0, cf_minDistance, cf_maxSpeed, 0.0)
-                vx += dvx
-                # print("BACK: " + str(mr.back) + " --> " + str(dvx))
-            if mr.left is not None:
-                dvy = remap(mr.left,  0.0, cf_minDistance, cf_maxSpeed, 0.0)
-                vy -= dvy
-                # print("LEFT: " + str(mr.left) + " --> " + str(dvy))
-            if mr.right is not None:
-                dvy = remap(mr.right, 0.0, cf_minDistance, cf_maxSpeed, 0.0)
-                vy += dvy
-                # print("RIGHT: " + str(mr.right) + " --> " + str(dvy))
-
-            # Read respiration sensor at A0
-            dataAcquired = bt.read(bt_nSamples)
-            for sample in range(bt_nSamples):
-                resp = dataAcquired[sample, 5]
+            # Latest filtered respiration sensor output at A0, never waits for the BITalino
+            output = pipeline.latest()
+            if output is not None:
                 # Set z
-                if sample in set([0]):
-                    print("Resp: " + str(int(resp)))
-                    z = remap(resp, bt_respSensorMin, bt_respSensorMax, cf_zMin, cf_zMax)
-                    print("z:    " + str(y))
-                    cf.commander.send_hover_setpoint(x, y, 0, z)
-                # # Set light
-                # if sample in set([0, 4, 8, 12]):
-                #     print("Resp:  " + str(int(resp)))
-                #     led_r = int(remap(resp, bt_respSensorMin, bt_respSensorMax, cf_ledMin, cf_ledMax))
-                #     led_g = 0
-                #     led_b = int(cf_ledMax - led_r)
-                #     print("z:     " + str(z))
-                #     print("led_r: " + str(led_r))
-                #     cf.param.set_value('ring.solidBlue', str(led_b))
-                #     cf.param.set_value('ring.solidRed', str(led_r))
-                #     cf.param.set_value('ring.solidGreen', str(led_g))
-                time.sleep(0.01)
+                z_target, _ = output
+
+            # Avoid obstacles, with the latest ranges logged by the Multiranger
+            avoidance.read(mr)
+            if occupancy and not np.isnan(cf_pose[0]):
+                position, yaw = cf_pose[:3], cf_pose[3]
+                if scheduler.ticks % map_every == 0:
+                    occupancy.update(position, yaw, avoidance.ranges)
+                # Closest of what the multiranger sees now and what the map remembers
+                occupancy.ranges(position, yaw, cf_minDistance, out=map_ranges)
+                np.fmin(avoidance.ranges, map_ranges, out=avoidance.ranges)
+            vx, vy, z = avoidance.command(z_target)
+            cf.commander.send_hover_setpoint(vx, vy, 0, z)
             end = time.time()
 
-            
-            # if multiranger.front is not None:
-            #     mem[0].leds[ 0].set(r=remap(multiranger.front), g=0, b=0)
-            #     mem[0].leds[ 1].set(r=remap(multiranger.front), g=0, b=0)
-            #     mem[0].leds[11].set(r=remap(multiranger.front), g=0, b=0)
-            # if multiranger.right is not None:
-            #     mem[0].leds[ 2].set(r=remap(multiranger.right), g=0, b=0)
-            #     mem[0].leds[ 3].set(r=remap(multiranger.right), g=0, b=0)
-            #     mem[0].leds[ 4].set(r=remap(multiranger.right), g=0, b=0)
-            # if multiranger.back is not None:
-            #     mem[0].leds[ 5].set(r=remap(multiranger.back), g=0, b=0)
-            #     mem[0].leds[ 6].set(r=remap(multiranger.back), g=0, b=0)
-            #     mem[0].leds[ 7].set(r=remap(multiranger.back), g=0, b=0)
-            # if multiranger.left is not None:
-            #     mem[0].leds[ 8].set(r=remap(multiranger.left), g=0, b=0)
-            #     mem[0].leds[ 9].set(r=remap(multiranger.left), g=0, b=0)
-            #     mem[0].leds[10].set(r=remap(multiranger.left), g=0, b=0)
-            # if multiranger.up is not None:
-            #     mem[0].leds[ 1].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[ 2].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[ 4].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[ 5].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[ 7].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[ 8].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[10].set(r=0, g=0, b=remap(multiranger.up))
-            #     mem[0].leds[11].set(r=0, g=0, b=remap(multiranger.up))
-            # mem[0].write_data(None)
-            
-            # yawrate = 0 # deg / sec
-            
-            # cf.commander.send_hover_setpoint(vx, vy, yawrate, z)
-
-            # time.sleep(0.1)
+            # Show ranges on the LED ring, closer is brighter.
+            # Only sent when the frame visibly changes, at most at cf_ledRate
+            if led_ring:
+                led_frame[:] = 0
+                for direction, leds in cf_ledRangeLeds.items():
+                    distance = getattr(mr, direction)
+                    if distance is not None:
+                        led_frame[leds, 0] = remap(distance)
+                if mr.up is not None:
+                    led_frame[cf_ledUpLeds, 0] = 0
+                    led_frame[cf_ledUpLeds, 2] = remap(mr.up)
+                led_ring.set_frame(led_frame)
         
         while (z > 0):
             z -= 0.05
@@ -240,10 +254,16 @@ with SyncCrazyflie(cf_uri) as scf:
             time.sleep(0.1)
         #  cf.param.set_value('ring.effect', '0')
 
-        # Stop acquisition
+        if led_ring:
+            print("LED ring: " + str(led_ring.stats()))
+        if occupancy:
+            position_log.stop()
+            print("Map: {} updates, {} chunks".format(occupancy.updates, len(occupancy.chunks)))
+        params.close()
+        print("Params: " + str(params.stats()))
+
+        # Stop acquisition, the connections are closed when leaving startup
+        acquisition.close()
         bt.stop()
-            
-        # Close connection
-        bt.close()
 
     print('Demo terminated!')
\ No newline at end of file
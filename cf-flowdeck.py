@@ -1,6 +1,7 @@
 # A simple test for the Flow Deck, moves Crazyflie up and down
 
 import logging
+import sys
 import time
 
 import cflib.crtp
@@ -8,6 +9,10 @@ from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.positioning.motion_commander import MotionCommander
 
+from estimator import reset_estimator
+from helpers import CACHE_DIR, first_setpoint
+from params import ParamClient
+
 URI = 'radio://0/80/2M'
 
 # Only output errors from the logging framework
@@ -18,14 +23,20 @@ if __name__ == '__main__':
     # Initialize the low-level drivers (don't list the debug drivers)
     cflib.crtp.init_drivers(enable_debug_driver=False)
 
-    with SyncCrazyflie(URI, cf=Crazyflie(rw_cache='./cache')) as scf:
+    with SyncCrazyflie(URI, cf=Crazyflie(rw_cache=CACHE_DIR)) as scf:
         cf = scf.cf
 
-        cf.param.set_value('kalman.resetEstimation', '1')
-        time.sleep(0.1)
-        cf.param.set_value('kalman.resetEstimation', '0')
+        params = ParamClient(cf)
+        if not reset_estimator(params):
+            print('Crazyflie did not acknowledge the estimator reset!')
+            params.close(0)
+            sys.exit(1)
+        params.close()
         time.sleep(2)
 
+        if first_setpoint():
+            sys.exit()
+
         for y in range(5):
             cf.commander.send_hover_setpoint(0, 0, 0, 0.2)
             time.sleep(1)
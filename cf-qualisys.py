@@ -8,6 +8,7 @@ Can adjust offsets (x, y, z) from controller in flight.
 
 WARNINGS:
 - Front of Crazyflie must be facing positive X when script is started
+  (applies to every Crazyflie in swarm)
 - At least one "controller" body must be present and specified in the list controller_body_names
 
 Full tutorial: [TBA]
@@ -15,21 +16,26 @@ Full tutorial: [TBA]
 
 import asyncio
 import math
+import multiprocessing
+import os
 import time
-import xml.etree.cElementTree as ET
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from pynput import keyboard
-
-import qtm
+import numpy as np
 
 import cflib.crtp
-from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.mem import MemoryElement
-from cflib.crazyflie.mem import Poly4D
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.crazyflie.syncLogger import SyncLogger
+
+from estimator import reset_estimator, wait_for_estimator_async
+from extpose import AdaptiveRateController, ExtposeSender, PackedExtposeSender, radio_address_id, send_extpose_rot_matrix
+from geofence import Box, Geofence, load_geofence
+from helpers import CACHE_DIR, LOG_DIR, Startup, StartupError, cf_connect, first_setpoint
+from ingest import ingest_main, receive
+from latency import LatencyHistogram, LatencyTracker
+from mocap import FlightRecorder, PosePredictor, PoseRing, PoseSnapshots, PoseStore, open_recording, qtm_body_names, replay_recording
+from params import ParamClient
+from scheduling import RateScheduler
+from trajectory import SegmentPlanner, TrajectoryStreamer
 
 
 #
@@ -41,10 +47,47 @@ from cflib.crazyflie.syncLogger import SyncLogger
 cf_uri = 'radio://0/80/2M'
 qtm_ip = "127.0.0.1"
 
+# Connection attempts and the time all devices get to become ready (in s), connected in parallel
+qtm_connect_retries = 5
+cf_connect_retries = 3
+startup_timeout = 30.0
+
+# QTM streaming, the control loops and keyboard input all run on one asyncio event loop.
+# Blocking cflib calls (connecting, estimator reset, waiting for parameter writes)
+# run on a pool of at most cflib_workers threads, None for one per drone and two spare.
+cflib_workers = None
+param_timeout = 2.0 # in s, for parameter writes to be acknowledged
+
 # QTM rigid body names
 cf_body_name = 'cf'
 controller_body_names = ['traqr20', 'traqr35']
 
+# Crazyflies to fly, each with its radio URI, QTM body name and offset (in m)
+# from the controller, added to controller_offset_x/y/z.
+# All of them share one QTM connection and one decode per frame.
+swarm = [
+    {'uri': cf_uri, 'body': cf_body_name, 'offset': (0.0, 0.0, 0.0)},
+    # {'uri': 'radio://0/80/2M/E7E7E7E702', 'body': 'cf2', 'offset': (0.5, 0.0, 0.0)},
+]
+
+# Where controller yaw comes from: 'qtm' streams the 6deuler component as well,
+# 'eager' and 'lazy' stream only 6d and derive euler angles on the host,
+# 'eager' for every frame and 'lazy' only for the yaw a control tick reads
+euler_mode = 'lazy'
+
+# Decode QTM frames in a separate process that publishes the poses to shared memory,
+# so decoding does not compete with the control loops and radio threads for the GIL.
+# A frame stays readable for qtm_ring_slots - 1 frame periods (about 100 ms at 300 Hz),
+# which should outlast pose_max_age; frames and control ticks that read one overwritten are dropped.
+# Needs an event loop that can watch pipes, i.e. Linux or macOS.
+qtm_process = False
+qtm_ring_slots = 32
+
+# Recording and replay of QTM 6DOF frames
+qtm_record_file = None # e.g. 'flight.qtmrec', records every frame received from QTM
+qtm_replay_file = None # e.g. 'flight.qtmrec', replays a recording instead of connecting to QTM
+qtm_replay_speed = 1.0 # 1.0 for real time, > 1.0 for accelerated, None for max speed
+
 # Physical space config
 x_min = -1.0 # in m
 x_max = 1.0 # in m
@@ -52,12 +95,63 @@ y_min = -2.0 # in m
 y_max = 1.0 # in m
 z_min = 0.0 # in m
 z_max = 1.5 # in m
-safeZone_margin = 0.2 # in m
+safeZone_margin = 0.2 # in m, on every side of the box
+# Allowed and no-fly volumes (pillars, tables, ...) from a file, see geofence.py,
+# instead of the box above. Drones land when they get further than safeZone_margin
+# outside, targets are kept inside.
+geofence_file = None # e.g. 'room.json'
 controller_offset_x = 0.0 # in m
 controller_offset_y = -0.5 # in m
 controller_offset_z = 0.5 # in m
 cf_max_vel = 0.22 # in m/s
 cf_trackingLoss_treshold = 200
+# Control ticks skip poses that arrived more than pose_max_age ago, and drones land
+# when no new poses have arrived for pose_timeout (QTM stalled or disconnected)
+pose_max_age = 0.05 # in s
+pose_timeout = 0.5 # in s
+
+# Extpose streaming
+extpose_rate = 100 # in Hz, max rate of mocap poses sent over the radio
+extpose_max_age = 0.1 # in s, poses older than this are dropped
+# Broadcast poses of all drones in packed packets (2 drones per packet) instead of one
+# unicast packet per drone. Drones are told apart by the last byte of their radio address.
+extpose_packed = False
+extpose_broadcast_uri = 'radiobroadcast://0/80/2M'
+# Adapt the (unicast) extpose rate to radio link quality, between extpose_min_rate and extpose_rate
+extpose_adaptive = True
+extpose_min_rate = 20 # in Hz
+extpose_rate_log = os.path.join(LOG_DIR, 'extpose_rate.csv') # rate changes: drone, unix time, link quality, old rate, new rate
+
+# Estimator warm-up: done once the Kalman position variance has varied less than
+# estimator_threshold over estimator_window samples logged every estimator_log_period ms
+estimator_log_period = 20 # in ms
+estimator_window = 25
+estimator_threshold = 0.001
+estimator_timeout = 10.0 # in s
+
+# Control loop
+control_rate = 100 # in Hz, e.g. 50, 100 or 200
+setpoint_keepalive = 0.2 # in s, resend unchanged setpoints at least this often
+# Setpoints that change by less than this count as unchanged, also when predict_target moves them a little
+setpoint_resolution = 0.001 # in m
+setpoint_yaw_resolution = 0.1 # in degrees
+
+# Follow a prediction of where the controller is by the time the drone reacts:
+# its pose is extrapolated by its age when the setpoint is sent plus predict_extra_latency
+predict_target = True
+predict_extra_latency = 0.02 # in s, mocap capture and radio latency not measurable on the host
+predict_alpha = 0.4
+predict_beta = 0.05
+
+# Follow with short polynomial trajectory segments run by the high-level commander,
+# instead of a position setpoint every control tick. New segments are only sent when the
+# target is predicted to leave the path the current one converges onto by trajectory_threshold.
+trajectory_mode = False
+trajectory_horizon = 1.0 # in s, length of a segment
+trajectory_threshold = 0.05 # in m
+
+# Stamp every frame from QTM to radio and keep latency histograms (press 'l' in flight to print)
+latency_tracking = True
 
 
 #
@@ -81,29 +175,7 @@ class Pose:
         self.roll = roll
         self.pitch = pitch
         self.yaw = yaw
-        self.rotmatrix = rot
-
-    @classmethod
-    def from_qtm_6d(cls, qtm_6d):
-        """Build pose from rigid body data in QTM 6d component"""
-        qtm_rot = qtm_6d[1].matrix
-        cf_rot = [[qtm_rot[0], qtm_rot[3], qtm_rot[6]],
-                  [qtm_rot[1], qtm_rot[4], qtm_rot[7]],
-                  [qtm_rot[2], qtm_rot[5], qtm_rot[8]]]
-        return cls(qtm_6d[0][0] / 1000,
-                   qtm_6d[0][1] / 1000,
-                   qtm_6d[0][2] / 1000,
-                   rotmatrix = cf_rot)
-
-    @classmethod
-    def from_qtm_6deuler(cls, qtm_6deuler):
-        """Build pose from rigid body data in QTM 6deuler component"""
-        return cls(qtm_6deuler[0][0] / 1000,
-                   qtm_6deuler[0][1] / 1000,
-                   qtm_6deuler[0][2] / 1000,
-                   roll  = qtm_6deuler[1][2],
-                   pitch = qtm_6deuler[1][1],
-                   yaw   = qtm_6deuler[1][0])
+        self.rotmatrix = rotmatrix
 
     def distance_to(self, other_point):
         return sqrt(
@@ -125,10 +197,10 @@ class Pose:
 #
 
 fly = True
-cf_trackingLoss = 0
-cf_pose = Pose(0, 0, 0)
-controller_poses = [Pose(0, 0, 0)] * len(controller_body_names)
 controller_select = 0
+latency = LatencyTracker(['receive', 'decode', 'update', 'extpose', 'setpoint']) if latency_tracking else None
+# Age of the poses every control tick used, by drone URI (press 'l' in flight to print)
+pose_age = {}
 
 
 #
@@ -136,102 +208,279 @@ controller_select = 0
 #
 
 
-class QtmWrapper(Thread):
-    """Run QTM connection on its own thread."""
+class QtmWrapper:
+    """QTM connection, streaming on the event loop it was connected from."""
     def __init__(self):
-        Thread.__init__(self)
-
-        self.on_cf_pose = None
+        # (body index, callback) pairs receiving the full pose of that body on every valid frame
+        self.pose_callbacks = []
         self.connection = None
         self.bodyToIdx = {}
+        # Newest snapshot (PoseView) of all bodies, swapped on every frame
+        self.poses = None
+        # Poses updated in place by decoding, and the snapshots published from them
+        self._store = None
+        self.snapshots = None
+        self.predictor = None
+        self.controller_idxs = []
+        # Body indexes of the drones, in swarm order, and their signed distance to the geofence
+        self.drone_idxs = []
+        self.fence_distance = np.zeros(len(swarm))
+        self.last_frame = -1
+        self.euler_mode = euler_mode
+        self.recorder = None
+        self._replay_task = None
         self._stay_open = True
+        # Decoding process, its pipes and the shared memory it publishes poses to
+        self.process = None
+        self.ring = None
+        self.torn = 0
+        self._control = None
+        self._notify = None
+        self._first_frame = None
+
+    def add_pose_callback(self, body_name, callback):
+        # Replace rather than mutate the list, it may be iterated while a frame is handled
+        self.pose_callbacks = self.pose_callbacks + [(self.bodyToIdx[body_name], callback)]
+
+    def remove_pose_callback(self, callback):
+        self.pose_callbacks = [(idx, cb) for idx, cb in self.pose_callbacks if cb != callback]
+
+    async def connect(self):
+        """Connect and start streaming. Raises ConnectionError if QTM or a body is not available."""
+        self.bodyToIdx = {}
+        if qtm_process:
+            for index, name in enumerate(await self._start_process()):
+                self.bodyToIdx[name] = index
+        elif qtm_replay_file:
+            print('Replaying QTM recording ' + qtm_replay_file)
+            body_names, records = open_recording(qtm_replay_file)
+            for index, name in enumerate(body_names):
+                self.bodyToIdx[name] = index
+            if self.euler_mode == 'qtm':
+                # Recordings hold the 6d component only
+                self.euler_mode = 'lazy'
+        else:
+            # Imported here, while the radio links come up
+            import qtm
 
-        self.start()
-
-    def close(self):
-        self._stay_open = False
-        self.join()
-
-    def run(self):
-        asyncio.run(self._life_cycle())
-
-    async def _life_cycle(self): 
-        await self._connect()
-        while(self._stay_open):
-            await asyncio.sleep(1)
-        await self._close()
-
-    async def _connect(self):
-        print('Connecting to QTM at ' + qtm_ip)
-        self.connection = await qtm.connect(qtm_ip)
+            print('Connecting to QTM at ' + qtm_ip)
+            self.connection = await qtm.connect(qtm_ip)
+            if self.connection is None:
+                raise ConnectionError('QTM connection failed')
 
-        params_xml = await self.connection.get_parameters(parameters=['6d'])
-        xml = ET.fromstring(params_xml)
-        for index, body in enumerate(xml.findall("*/Body/Name")):
-            self.bodyToIdx[body.text.strip()] = index
+            for index, name in enumerate(await qtm_body_names(self.connection)):
+                self.bodyToIdx[name] = index
         print('QTM 6DOF bodies and indexes: ' + str(self.bodyToIdx))
+        euler_idxs = [self.bodyToIdx[name] for name in controller_body_names if name in self.bodyToIdx]
+        self._store = PoseStore(len(self.bodyToIdx), euler_idxs=euler_idxs, euler_mode=self.euler_mode)
+        self.snapshots = PoseSnapshots(len(self.bodyToIdx))
+        self.poses = self.snapshots.front
+        if predict_target:
+            self.predictor = PosePredictor(len(self.bodyToIdx), alpha=predict_alpha, beta=predict_beta)
 
         # Check if all the bodies are there
 
-        if cf_body_name in self.bodyToIdx:
-            print("Crazyflie body '" + cf_body_name + "' found in QTM 6DOF bodies.")
-        else:
-            print("Crazyflie body '" + cf_body_name + "' not found in QTM 6DOF bodies!")
-            print("Aborting...")
-            self._stay_open = False
+        missing = False
+        for drone in swarm:
+            if drone['body'] in self.bodyToIdx:
+                print("Crazyflie body '" + drone['body'] + "' found in QTM 6DOF bodies.")
+            else:
+                print("Crazyflie body '" + drone['body'] + "' not found in QTM 6DOF bodies!")
+                missing = True
 
         for controller_body_name in controller_body_names:
             if controller_body_name in self.bodyToIdx:
                 print("Controller body '" + controller_body_name + "' found in QTM 6DOF bodies.")
             else:
                 print("Controller body '" + controller_body_name + "' not found in QTM 6DOF bodies!")
-                print("Aborting...")
-                self._stay_open = False
-
-        await self.connection.stream_frames(components=['6d', '6deuler'], on_packet=self._on_packet)
+                missing = True
+
+        if missing:
+            if self.connection:
+                self.connection.disconnect()
+                self.connection = None
+            if self.process:
+                await self._stop_process()
+            raise ConnectionError('QTM bodies not available')
+
+        self.controller_idxs = [self.bodyToIdx[name] for name in controller_body_names]
+        self.drone_idxs = [self.bodyToIdx[drone['body']] for drone in swarm]
+
+        if self.process:
+            # Poses come from shared memory from now on, connected once they do
+            loop = asyncio.get_running_loop()
+            self.ring = PoseRing(len(self.bodyToIdx), slots=qtm_ring_slots)
+            self._first_frame = loop.create_future()
+            loop.add_reader(self._notify.fileno(), self._on_ring)
+            self._control.send(('ring', self.ring.name, qtm_ring_slots))
+            self.poses = None
+            await self._first_frame
+            return
+
+        if qtm_record_file:
+            print('Recording QTM frames to ' + qtm_record_file)
+            self.recorder = FlightRecorder(qtm_record_file, self.bodyToIdx.keys())
+
+        if qtm_replay_file:
+            self._replay_task = asyncio.create_task(replay_recording(
+                records, self._on_packet, speed=qtm_replay_speed,
+                should_stop=lambda: not self._stay_open))
+            return
+
+        if self.euler_mode == 'qtm':
+            components = ['6d', '6deuler']
+        else:
+            components = ['6d']
+        await self.connection.stream_frames(components=components, on_packet=self._on_packet)
 
 
     def _on_packet(self, packet):
-        global cf_pose, controller_poses, cf_trackingLoss
+        received = time.perf_counter_ns()
+        if latency:
+            latency.begin(packet.framenumber, packet.timestamp, at=received)
+
         # We need the 6d component to send full pose to Crazyflie,
-        # and the 6deuler component for convenient calculations
+        # and euler angles (6deuler or derived from 6d) for convenient calculations
         header, component_6d = packet.get_6d()
-        header, component_6deuler = packet.get_6d_euler()
 
         if component_6d is None:
             print('No 6d component in QTM packet!')
             return              
-        
-        if component_6deuler is None:
-            print('No 6deuler component in QTM packet!')
-            return      
-
-        # Get 6DOF data for Crazyflie
-        cf_6d = component_6d[self.bodyToIdx[cf_body_name]]
-        # Store in temp until validity is checked
-        _cf_pose = Pose.from_qtm_6d(cf_6d)
-        # Check validity
-        if _cf_pose.is_valid():
-            # Update global var for pose
-            cf_pose = _cf_pose
-            # Stream full pose to Crazyflie
-            if self.on_cf_pose:
-                self.on_cf_pose([cf_pose.x, cf_pose.y, cf_pose.z, cf_pose.rotmatrix])
-                cf_trackingLoss = 0
-        else:
-            cf_trackingLoss += 1
-
-        # Get 6DOF data for controllers and update globals
 
-        for i, controller_body_name in enumerate(controller_body_names):
-            controller_6deuler = component_6deuler[self.bodyToIdx[controller_body_name]]
-            _controller_pose = Pose.from_qtm_6deuler(controller_6deuler)
-            if _controller_pose.is_valid():
-                controller_poses[i] = _controller_pose
-
-    async def _close(self):
-        await self.connection.stream_frames_stop()
-        self.connection.disconnect()
+        if latency:
+            latency.stamp(packet.framenumber, 'decode')
+
+        if self.recorder:
+            self.recorder.write(packet.timestamp, packet.framenumber, component_6d)
+
+        if self.euler_mode == 'qtm':
+            header, component_6deuler = packet.get_6d_euler()
+            if component_6deuler is None:
+                print('No 6deuler component in QTM packet!')
+                return      
+
+        # Update all bodies in place, invalid (NaN) bodies keep their last pose
+        self._store.update_6d(component_6d)
+        if self.euler_mode == 'qtm':
+            self._store.update_6deuler(component_6deuler)
+        # Readers switch to the new frame at once
+        self.poses = poses = self.snapshots.publish(self._store, packet.framenumber, packet.timestamp, received)
+        self._on_poses(poses.pos, poses.valid, packet.framenumber, packet.timestamp,
+                       self._extposes(poses, poses.valid, packet.framenumber))
+
+    def _on_ring(self):
+        """New frame(s) published by the decoding process."""
+        os.read(self._notify.fileno(), 4096)
+        view = self.ring.latest()
+        if view is None or view.framenumber == self.last_frame:
+            return
+        # Copy what is used here, and drop the frame if the writer got round to its slot meanwhile
+        pos = view.pos.copy()
+        valid = view.valid.copy()
+        extposes = self._extposes(view, valid, view.framenumber)
+        if not view.intact():
+            self.torn += 1
+            return
+        if latency:
+            latency.begin(view.framenumber, view.timestamp, at=view.received)
+            latency.stamp(view.framenumber, 'decode', at=view.decoded)
+        # Readers get the newest view, the previous one is only kept by readers still using it
+        self.poses = view
+        self._on_poses(pos, valid, view.framenumber, view.timestamp, extposes)
+        if not self._first_frame.done():
+            self._first_frame.set_result(view.framenumber)
+
+    def _extposes(self, poses, valid, framenumber):
+        """(callback, full pose tagged with the frame number) of every valid body with a pose callback."""
+        extposes = []
+        for idx, callback in self.pose_callbacks:
+            if valid[idx]:
+                pose = poses.extpose(idx)
+                pose.append(framenumber)
+                extposes.append((callback, pose))
+        return extposes
+
+    def _on_poses(self, pos, valid, framenumber, timestamp, extposes):
+        if self.predictor:
+            self.predictor.update(pos, valid, timestamp)
+        self.last_frame = framenumber
+        if latency:
+            latency.stamp(framenumber, 'update')
+
+        # Geofence check of all drones at once
+        self.fence_distance = geofence.exit_distance(pos[self.drone_idxs])
+
+        # Fan out full poses to the Crazyflies
+        for callback, pose in extposes:
+            callback(pose)
+
+    async def _start_process(self):
+        """Start the decoding process. Returns the QTM body names."""
+        if qtm_replay_file:
+            print('Replaying QTM recording ' + qtm_replay_file + ' in a decoding process')
+        else:
+            print('Connecting to QTM at ' + qtm_ip + ' from a decoding process')
+        # Spawned, not forked: a fork would copy the cflib and startup threads (and the locks they hold)
+        context = multiprocessing.get_context('spawn')
+        self._control, child_control = context.Pipe()
+        self._notify, child_notify = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=ingest_main, name='qtm-ingest', daemon=True,
+            args=(child_control, child_notify, qtm_ip, controller_body_names, self.euler_mode,
+                  qtm_record_file, qtm_replay_file, qtm_replay_speed))
+        self.process.start()
+        child_control.close()
+        child_notify.close()
+        try:
+            message = await receive(asyncio.get_running_loop(), self._control)
+        except EOFError:
+            message = ('error', 'decoding process exited')
+        if message[0] == 'error':
+            await self._stop_process()
+            raise ConnectionError(message[1])
+        return message[1]
+
+    async def _stop_process(self):
+        loop = asyncio.get_running_loop()
+        if self.ring:
+            loop.remove_reader(self._notify.fileno())
+        try:
+            self._control.send(('stop',))
+            message = await asyncio.wait_for(receive(loop, self._control), 2.0)
+            print('Decoding process published ' + str(message[1]) + ' frames, ' + str(self.torn) + ' torn.')
+        except (OSError, EOFError, asyncio.TimeoutError):
+            pass
+        await loop.run_in_executor(None, self.process.join, 2.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._control.close()
+        self._notify.close()
+        self.process = None
+        if self.ring:
+            # Views into the shared memory must be gone before it is closed
+            self.poses = None
+            self.ring.close()
+            self.ring.unlink()
+            self.ring = None
+
+    async def close(self):
+        self._stay_open = False
+        if self.process:
+            await self._stop_process()
+        if self._replay_task:
+            await self._replay_task
+        if self.connection:
+            import qtm
+
+            try:
+                await self.connection.stream_frames_stop()
+                self.connection.disconnect()
+            except (qtm.QRTCommandException, OSError) as ex:
+                # QTM may have dropped the connection already
+                print('Stopping QTM stream failed: ' + str(ex))
+        if self.recorder:
+            self.recorder.close()
+            print('Recorded ' + str(self.recorder.frames) + ' QTM frames.')
 
 
 #
@@ -239,77 +488,44 @@ class QtmWrapper(Thread):
 #
 
 
-def send_extpose_rot_matrix(cf, x, y, z, rot):
-    """Send full pose from mocap to Crazyflie."""
-    qw = sqrt(1 + rot[0][0] + rot[1][1] + rot[2][2]) / 2
-    qx = sqrt(1 + rot[0][0] - rot[1][1] - rot[2][2]) / 2
-    qy = sqrt(1 - rot[0][0] + rot[1][1] - rot[2][2]) / 2
-    qz = sqrt(1 - rot[0][0] - rot[1][1] + rot[2][2]) / 2
-    # Normalize the quaternion
-    ql = math.sqrt(qx ** 2 + qy ** 2 + qz ** 2 + qw ** 2)
-    # Send to Crazyflie
-    cf.extpos.send_extpose(x, y, z, qx / ql, qy / ql, qz / ql, qw / ql)
+async def setup_estimator(scf, params, name=''):
+    """Set up Crazyflie state estimator. Returns the time it took to converge in s, or None."""
+    start = time.monotonic()
 
+    applied = await run_blocking(params.apply, {
+        # Activate Kalman estimator
+        'stabilizer.estimator': '2',
+        # Set the std deviation for the quaternion data pushed into the Kalman filter.
+        # The default value seems to be a bit too low.
+        'locSrv.extQuatStdDev': 0.6,
+    })
 
-def setup_estimator(cf):
-    """Set up Crazyflie state estimator."""
-    # Activate Kalman estimator
-    cf.param.set_value('stabilizer.estimator', '2')
-
-    # Set the std deviation for the quaternion data pushed into the Kalman filter.
-    # The default value seems to be a bit too low.
-    cf.param.set_value('locSrv.extQuatStdDev', 0.6)
-    
     # Reset estimator
-    cf.param.set_value('kalman.resetEstimation', '1')
-    time.sleep(0.1)
-    cf.param.set_value('kalman.resetEstimation', '0')
-    time.sleep(1)
-
-    # Wait for estimator to stabilize
-
-    print('Waiting for estimator to find position...')
+    if not applied or not await run_blocking(reset_estimator, params):
+        print(name + 'Estimator parameters not acknowledged within ' + str(params.timeout) + ' s!')
+        return None
 
-    log_config = LogConfig(name='Kalman Variance', period_in_ms=500)
-    log_config.add_variable('kalman.varPX', 'float')
-    log_config.add_variable('kalman.varPY', 'float')
-    log_config.add_variable('kalman.varPZ', 'float')
+    # Wait for estimator to stabilize, as soon as the variance is stable
 
-    var_y_history = [1000] * 10
-    var_x_history = [1000] * 10
-    var_z_history = [1000] * 10
+    print(name + 'Waiting for estimator to find position...')
 
-    threshold = 0.001
+    converged = await wait_for_estimator_async(scf, period_in_ms=estimator_log_period, window=estimator_window,
+                                               threshold=estimator_threshold, timeout=estimator_timeout, name=name)
+    if converged is None:
+        print(name + 'Estimator did not converge within ' + str(estimator_timeout) + ' s!')
+        return None
+    elapsed = time.monotonic() - start
+    print(name + 'Estimator ready, preflight took {:.2f} s'.format(elapsed))
+    return elapsed
 
-    with SyncLogger(scf, log_config) as logger:
-        for log_entry in logger:
-            data = log_entry[1]
 
-            var_x_history.append(data['kalman.varPX'])
-            var_x_history.pop(0)
-            var_y_history.append(data['kalman.varPY'])
-            var_y_history.pop(0)
-            var_z_history.append(data['kalman.varPZ'])
-            var_z_history.pop(0)
-
-            min_x = min(var_x_history)
-            max_x = max(var_x_history)
-            min_y = min(var_y_history)
-            max_y = max(var_y_history)
-            min_z = min(var_z_history)
-            max_z = max(var_z_history)
-
-            print("Kalman variance | X: {:8.4f}  Y: {:8.4f}  Z: {:8.4f}".format(
-                max_x - min_x, max_y - min_y, max_z - min_z))
-
-            if (max_x - min_x) < threshold and (
-                max_y - min_y) < threshold and (
-                max_z - min_z) < threshold:
-                break
+def run_blocking(fn, *args, **kwargs):
+    """Run a blocking (cflib) call on the executor, awaitable from the event loop."""
+    return asyncio.get_running_loop().run_in_executor(None, partial(fn, *args, **kwargs))
 
 
 def on_press(key):
-    """React to keyboard."""
+    """React to keyboard. Called on the event loop, see read_commands."""
     global fly, controller_offset_x, controller_offset_y, controller_offset_z, controller_select
     if key == keyboard.Key.esc:
         fly = False
@@ -332,78 +548,293 @@ def on_press(key):
             controller_select = 1
         if key.char == "3":
             controller_select = 2
+        if key.char == "l" and latency:
+            print(latency.report())
+        if key.char == "l":
+            for uri, histogram in pose_age.items():
+                print(uri + ": Pose age: " + pose_age_report(histogram))
         print("Controller: " + controller_body_names[controller_select])
         print("Offset: X: {:5.2f}  Y: {:5.2f}  Z: {:5.2f}".format(
                 controller_offset_x, controller_offset_y, controller_offset_z))
 
 
-# 
-# ACTION
-# 
+def pose_age_report(histogram):
+    s = histogram.summary()
+    return "p50: {:6.3f} ms p99: {:6.3f} ms max: {:6.3f} ms".format(s['p50_ms'], s['p99_ms'], s['max_ms'])
 
 
-# Init Crazyflie drivers
-cflib.crtp.init_drivers(enable_debug_driver=False)
+def start_keyboard(loop, commands):
+    """Start listening to the keyboard, key presses are queued to commands on loop."""
+    global keyboard
+    # Imported here, on the executor while the devices connect
+    from pynput import keyboard
 
-# Connect to QTM
-qtm_wrapper = QtmWrapper()
+    listener = keyboard.Listener(on_press=lambda key: loop.call_soon_threadsafe(commands.put_nowait, key))
+    listener.start()
+    return listener
 
-with SyncCrazyflie(cf_uri, cf=Crazyflie(rw_cache='./cache')) as scf:
+
+async def read_commands(commands):
+    """Apply key presses one at a time, so on_press never runs while a control tick does."""
+    while True:
+        on_press(await commands.get())
+
+
+async def fly_drone(scf, drone):
+    """Follow the selected controller with one Crazyflie until landing. Runs as one task per drone."""
     cf = scf.cf
+    uri = drone['uri']
+    offset_x, offset_y, offset_z = drone['offset']
 
-    listener = keyboard.Listener(on_press=on_press)
-    listener.start()
+    # Slow down. Written in the background while the estimator is set up
+    params = ParamClient(cf, timeout=param_timeout)
+    params.set('posCtlPid.xyVelMax', cf_max_vel)
+    params.set('posCtlPid.zVelMax', cf_max_vel)
 
-    # Slow down
-    cf.param.set_value('posCtlPid.xyVelMax', cf_max_vel)
-    cf.param.set_value('posCtlPid.zVelMax', cf_max_vel)
+    cf_idx = qtm_wrapper.bodyToIdx[drone['body']]
+    fence_idx = swarm.index(drone)
 
     # Set up callbacks to handle data from QTM
-    qtm_wrapper.on_cf_pose = lambda pose: send_extpose_rot_matrix(cf, pose[0], pose[1], pose[2], pose[3])
-
-    setup_estimator(cf)
+    if extpose_packed:
+        drone_id = radio_address_id(uri)
+        extpose_sender = None
+        put_pose = lambda pose: packed_sender.put(drone_id, pose)
+    else:
+        def send_extpose(pose):
+            send_extpose_rot_matrix(cf, pose[0], pose[1], pose[2], pose[3])
+            if latency:
+                latency.stamp(pose[4], 'extpose')
+
+        # Poses go through a latest-value mailbox so the radio never blocks QTM
+        extpose_sender = ExtposeSender(send_extpose, rate_hz=extpose_rate, max_age=extpose_max_age)
+        put_pose = extpose_sender.put
+    rate_controller = None
+    if extpose_sender and extpose_adaptive:
+        rate_controller = AdaptiveRateController(extpose_sender, min_rate=extpose_min_rate,
+                                                 max_rate=extpose_rate, log_file=extpose_rate_log, name=uri)
+        cf.link_quality_updated.add_callback(rate_controller.on_link_quality)
+    qtm_wrapper.add_pose_callback(drone['body'], put_pose)
+
+    def stop_extpose():
+        qtm_wrapper.remove_pose_callback(put_pose)
+        if rate_controller:
+            cf.link_quality_updated.remove_callback(rate_controller.on_link_quality)
+            rate_controller.close()
+            print(uri + ": Extpose rate changes: " + str(len(rate_controller.changes)))
+        if extpose_sender:
+            extpose_sender.close()
+            print(uri + ": Extpose: " + str(extpose_sender.stats()))
+        params.close()
+        print(uri + ": Params: " + str(params.stats()))
+
+    if await setup_estimator(scf, params, name=uri + ': ') is None or first_setpoint(uri + ': '):
+        await run_blocking(stop_extpose)
+        return
 
     # FLY
+    scheduler = RateScheduler(control_rate)
+    last_setpoint = None
+    last_setpoint_time = 0.0
+    setpoints_skipped = 0
+    setpoints_sent = 0
+    planner = None
+    if trajectory_mode:
+        planner = SegmentPlanner(horizon=trajectory_horizon, threshold=trajectory_threshold, max_speed=cf_max_vel)
+        streamer = TrajectoryStreamer(cf)
+    age_histogram = pose_age[uri] = LatencyHistogram()
+    stale_ticks = 0
+    torn_ticks = 0
+    # Targets the clamp cannot bring inside hold the last safe one
+    safe_target = geofence.clamp(qtm_wrapper.poses.position(cf_idx))
+    fly_start = time.monotonic()
     while(fly == True):
+        await scheduler.wait_async()
+        # One consistent snapshot of all bodies for the whole tick
+        poses = qtm_wrapper.poses
+        age = poses.age()
+        age_histogram.record(int(age * 1e9))
+        if age > pose_timeout:
+            print(uri + ": NO POSES FOR {:.2f} s!".format(age))
+            break
+        if age > pose_max_age:
+            stale_ticks += 1
+            continue
 
-        # Land if drone strays out of bounding box
-        if not (x_min - safeZone_margin < cf_pose.x < x_max + safeZone_margin
-           and  y_min - safeZone_margin < cf_pose.y < y_max + safeZone_margin
-           and  z_min - safeZone_margin < cf_pose.z < z_max + safeZone_margin):
-            print("DRONE HAS LEFT SAFE ZONE!")
+        # Select controller to follow
+        controller_idx = qtm_wrapper.controller_idxs[controller_select]
+        # Read what the tick needs from the frame; from shared memory, skip the tick if it was overwritten meanwhile
+        cf_lost = int(poses.lost[cf_idx])
+        cf_position = poses.position(cf_idx)
+        controller_position = poses.position(controller_idx)
+        controller_yaw = poses.yaw(controller_idx)
+        if not poses.intact():
+            torn_ticks += 1
+            continue
+
+        # Land if drone strays out of the geofence
+        if qtm_wrapper.fence_distance[fence_idx] > safeZone_margin:
+            print(uri + ": DRONE HAS LEFT SAFE ZONE!")
             break
         # Land if drone disappears
-        if cf_trackingLoss > cf_trackingLoss_treshold:
-            print("TRACKING LOST FOR " + str(cf_trackingLoss_treshold) + " FRAMES!")
+        if cf_lost > cf_trackingLoss_treshold:
+            print(uri + ": TRACKING LOST FOR " + str(cf_trackingLoss_treshold) + " FRAMES!")
             break
 
-        # Select controller to follow
-        controller_pose = controller_poses[controller_select]
+        if predict_target:
+            horizon = time.monotonic() - qtm_wrapper.predictor.updated + predict_extra_latency
+            controller_x, controller_y, controller_z = qtm_wrapper.predictor.predict(controller_idx, horizon)
+        else:
+            controller_x, controller_y, controller_z = controller_position
 
         # Compute target
         target_pose = Pose(
-            controller_pose.x + controller_offset_x,
-            controller_pose.y + controller_offset_y,
-            controller_pose.z + controller_offset_z,
-            yaw = controller_pose.yaw
+            controller_x + controller_offset_x + offset_x,
+            controller_y + controller_offset_y + offset_y,
+            controller_z + controller_offset_z + offset_z,
+            yaw = controller_yaw
         )
 
-        # Keep target inside bounding box
-        target_pose.x = max(x_min, min(target_pose.x, x_max))
-        target_pose.y = max(y_min, min(target_pose.y, y_max))
-        target_pose.z = max(z_min, min(target_pose.z, z_max))
-
-        # Go to target
-        cf.commander.send_position_setpoint(target_pose.x, target_pose.y, target_pose.z, target_pose.yaw)
+        # Keep target inside the geofence, at the nearest allowed point
+        target = (target_pose.x, target_pose.y, target_pose.z)
+        clamped = safe_target = geofence.clamp(target, fallback=safe_target)
+        target_pose.x, target_pose.y, target_pose.z = clamped.tolist()
+
+        now = time.monotonic()
+        if planner:
+            # Plan along the predicted controller path, a segment is only sent when the plan changes
+            if not streamer.ready():
+                continue
+            if predict_target:
+                velocity = qtm_wrapper.predictor.vel[controller_idx]
+                acceleration = qtm_wrapper.predictor.acc[controller_idx]
+                if not np.allclose(clamped, target):
+                    # A clamped target slides along the fence, follow the clamp of where it is heading
+                    ahead = geofence.clamp(np.asarray(target) + velocity * planner.lookahead, fallback=clamped)
+                    velocity = (ahead - clamped) / planner.lookahead
+                    acceleration = np.zeros(3)
+            else:
+                velocity = acceleration = np.zeros(3)
+            segment = planner.update(now, clamped, velocity, target_pose.yaw, acceleration=acceleration,
+                                     position=cf_position)
+            if segment:
+                streamer.send(segment)
+                if latency:
+                    latency.stamp(qtm_wrapper.last_frame, 'setpoint')
+            continue
+
+        # Go to target, skipping unchanged setpoints (but keep the commander watchdog fed)
+        setpoint = (target_pose.x, target_pose.y, target_pose.z, target_pose.yaw)
+        quantized = (round(target_pose.x / setpoint_resolution), round(target_pose.y / setpoint_resolution),
+                     round(target_pose.z / setpoint_resolution), round(target_pose.yaw / setpoint_yaw_resolution))
+        if quantized != last_setpoint or now - last_setpoint_time > setpoint_keepalive:
+            cf.commander.send_position_setpoint(*setpoint)
+            if latency:
+                latency.stamp(qtm_wrapper.last_frame, 'setpoint')
+            last_setpoint = quantized
+            last_setpoint_time = now
+            setpoints_sent += 1
+        else:
+            setpoints_skipped += 1
         
         # # DEBUG
-        # print(cf_pose)
-        # print(controller_pose)
+        # print(poses.pos[cf_idx])
+        # print(poses.pos[controller_idx])
 
     # Land calmly
-    print("Landing...")
+    print(uri + ": Landing...")
+    print(uri + ": Control loop: " + str(scheduler) + " Skipped setpoints: " + str(setpoints_skipped))
+    print(uri + ": Pose age: " + pose_age_report(age_histogram) + " Stale ticks: " + str(stale_ticks)
+          + " Torn ticks: " + str(torn_ticks))
+    flown = time.monotonic() - fly_start
+    if planner:
+        print(uri + ": Trajectory: {} segments, {} packets ({:.1f}/s)".format(
+            planner.planned, streamer.packets(), streamer.packets() / flown) + " " + str(streamer.stats()))
+    else:
+        print(uri + ": Setpoints: {} packets ({:.1f}/s)".format(setpoints_sent, setpoints_sent / flown))
     for z in range(5, 0, -1):
         cf.commander.send_hover_setpoint(0, 0, 0, float(z) / 10.0)
-        time.sleep(0.15)
+        await asyncio.sleep(0.15)
+
+    await run_blocking(stop_extpose)
+
+
+# 
+# ACTION
+# 
+
 
-qtm_wrapper.close()
+async def main():
+    loop = asyncio.get_running_loop()
+    workers = cflib_workers or len(swarm) + 2
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cflib'))
+
+    # Connect QTM (on this loop) and all Crazyflies at the same time
+    startup = Startup(timeout=startup_timeout)
+    def connect_qtm():
+        asyncio.run_coroutine_threadsafe(qtm_wrapper.connect(), loop).result()
+        return qtm_wrapper
+
+    startup.add('QTM ' + qtm_ip, connect_qtm,
+                close=lambda wrapper: asyncio.run_coroutine_threadsafe(wrapper.close(), loop).result(),
+                retries=qtm_connect_retries)
+    for drone in swarm:
+        startup.add(drone['uri'], lambda uri=drone['uri']: cf_connect(uri, rw_cache=CACHE_DIR),
+                    close=lambda scf: scf.close_link(), retries=cf_connect_retries)
+    ready = run_blocking(startup.run)
+
+    # Fly all Crazyflies in parallel, one task per drone, and shut down once all have landed
+    commands = asyncio.Queue()
+    command_task = asyncio.create_task(read_commands(commands))
+    listener = None
+    try:
+        listener = await run_blocking(start_keyboard, loop, commands)
+        devices = await ready
+        print(startup.report())
+        results = await asyncio.gather(*(fly_drone(devices[drone['uri']], drone) for drone in swarm),
+                                       return_exceptions=True)
+        for drone, result in zip(swarm, results):
+            if isinstance(result, Exception):
+                print(drone['uri'] + ': Flight failed: ' + repr(result))
+    except StartupError as ex:
+        print('Startup failed: ' + str(ex))
+        print(startup.report())
+    finally:
+        if listener:
+            listener.stop()
+        command_task.cancel()
+        # Close whatever connected, also when startup is still running
+        await asyncio.wait([ready])
+        await run_blocking(startup.close)
+
+
+
+# The decoding process (qtm_process) is spawned and imports this script without running it
+if __name__ == '__main__':
+    # Init Crazyflie drivers
+    cflib.crtp.init_drivers(enable_debug_driver=False)
+
+    # Precompute the geofence distance grid
+    if geofence_file:
+        geofence = load_geofence(geofence_file)
+    else:
+        geofence = Geofence([Box((x_min, y_min, z_min), (x_max, y_max, z_max))])
+    print('Geofence grid: ' + ' x '.join(str(n) for n in geofence.shape))
+
+    qtm_wrapper = QtmWrapper()
+
+    # One broadcast sender shared by the whole swarm
+    packed_sender = None
+    if extpose_packed:
+        # Poses carry their frame number, stamped once the packet with them is sent
+        on_sent = (lambda pose: latency.stamp(pose[4], 'extpose')) if latency else None
+        packed_sender = PackedExtposeSender(cflib.crtp.get_link_driver(extpose_broadcast_uri),
+                                            rate_hz=extpose_rate, max_age=extpose_max_age, on_sent=on_sent)
+
+    asyncio.run(main())
+
+    if packed_sender:
+        packed_sender.close()
+        print("Packed extpose: " + str(packed_sender.stats()))
+
+    if latency:
+        print(latency.report())
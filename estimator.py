@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Crazyflie state estimator warm-up.
+
+Instead of fixed sleeps, the Kalman position variance is streamed at a high
+rate and the estimator is considered ready as soon as the variance has stayed
+within a threshold over a sliding window. Each drone waits on its own log
+stream, so a swarm warms up in parallel when called from per-drone threads,
+or from tasks on one event loop with wait_for_estimator_async().
+"""
+
+import asyncio
+import time
+from collections import deque
+from threading import Event
+
+from cflib.crazyflie.log import LogConfig
+
+
+class SlidingRange:
+    """Minimum and maximum of the last n values, O(1) amortized per update."""
+    def __init__(self, n):
+        self.n = n
+        self._count = 0
+        # Monotonic deques of (index, value)
+        self._min = deque()
+        self._max = deque()
+
+    def update(self, value):
+        i = self._count
+        self._count += 1
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((i, value))
+        if self._min[0][0] <= i - self.n:
+            self._min.popleft()
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((i, value))
+        if self._max[0][0] <= i - self.n:
+            self._max.popleft()
+
+    def full(self):
+        return self._count >= self.n
+
+    def range(self):
+        return self._max[0][1] - self._min[0][1]
+
+
+class ConvergenceDetector:
+    """Detect when every streamed variable has varied less than threshold over the last window samples."""
+    def __init__(self, names, window=25, threshold=0.001):
+        self.names = list(names)
+        self.threshold = threshold
+        self._ranges = [SlidingRange(window) for _ in self.names]
+
+    def update(self, data):
+        """Add one log sample (dict by variable name). Returns True once converged."""
+        converged = True
+        for name, sliding in zip(self.names, self._ranges):
+            sliding.update(data[name])
+            if not sliding.full() or sliding.range() >= self.threshold:
+                converged = False
+        return converged
+
+    def ranges(self):
+        return [sliding.range() for sliding in self._ranges]
+
+
+def reset_estimator(params):
+    """Pulse 'kalman.resetEstimation' through a params.ParamClient. Returns False if a write was not acknowledged."""
+    if not params.set('kalman.resetEstimation', '1', ordered=True, wait=True):
+        return False
+    time.sleep(0.1)
+    return params.set('kalman.resetEstimation', '0', ordered=True, wait=True)
+
+
+def _watch_variance(scf, on_converged, period_in_ms, window, threshold, settle_time, print_every, name):
+    """Stream the Kalman position variance, on_converged() is called once from the log thread when stable.
+
+    Samples during the first settle_time seconds are ignored, in case they were
+    logged before the reset took effect.
+    Returns the started LogConfig, to be stopped with _stop_watching().
+    """
+    variables = ['kalman.varPX', 'kalman.varPY', 'kalman.varPZ']
+    detector = ConvergenceDetector(variables, window=window, threshold=threshold)
+    start = time.monotonic()
+    state = {'done': False, 'last_print': start}
+
+    def on_data(timestamp, data, logconf):
+        now = time.monotonic()
+        if now - start < settle_time or state['done']:
+            return
+        if detector.update(data):
+            state['done'] = True
+            on_converged()
+        if print_every and now - state['last_print'] >= print_every:
+            state['last_print'] = now
+            print(name + "Kalman variance | X: {:8.4f}  Y: {:8.4f}  Z: {:8.4f}".format(*detector.ranges()))
+
+    log_config = LogConfig(name='Kalman Variance', period_in_ms=period_in_ms)
+    for variable in variables:
+        log_config.add_variable(variable, 'float')
+    scf.cf.log.add_config(log_config)
+    log_config.data_received_cb.add_callback(on_data)
+    log_config.start()
+    return log_config
+
+
+def _stop_watching(log_config):
+    log_config.stop()
+    log_config.delete()
+
+
+def wait_for_estimator(scf, period_in_ms=20, window=25, threshold=0.001, timeout=10.0,
+                       settle_time=0.1, print_every=0.5, name=''):
+    """Stream the Kalman position variance until it is stable.
+
+    Returns the time it took in s, or None on timeout.
+    """
+    done = Event()
+    start = time.monotonic()
+    log_config = _watch_variance(scf, done.set, period_in_ms, window, threshold, settle_time, print_every, name)
+    try:
+        converged = done.wait(timeout)
+    finally:
+        _stop_watching(log_config)
+
+    if not converged:
+        return None
+    return time.monotonic() - start
+
+
+async def wait_for_estimator_async(scf, period_in_ms=20, window=25, threshold=0.001, timeout=10.0,
+                                   settle_time=0.1, print_every=0.5, name=''):
+    """Like wait_for_estimator(), awaited on the event loop instead of holding a thread while waiting."""
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def on_converged():
+        loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+    start = time.monotonic()
+    log_config = _watch_variance(scf, on_converged, period_in_ms, window, threshold, settle_time, print_every, name)
+    try:
+        await asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        _stop_watching(log_config)
+    return time.monotonic() - start
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming of external pose (mocap) data to the Crazyflie.
+
+The mocap thread hands every new pose to an ExtposeSender, which keeps only
+the newest one and pushes it over the radio from its own thread at a fixed
+rate. A stalled radio therefore never holds up the mocap event loop.
+
+For swarms, PackedExtposeSender instead packs the poses of several drones
+into shared broadcast packets (the firmware's packed external pose format).
+"""
+
+import math
+import os
+import struct
+import time
+from threading import Condition, Thread
+
+from cflib.crtp.crtpstack import CRTPPacket
+from cflib.crtp.crtpstack import CRTPPort
+
+
+def _sqrt(x):
+    """Calculate sqrt while avoiding rounding errors with slightly negative x."""
+    if x < 0.0:
+        return 0.0
+    return math.sqrt(x)
+
+
+def rot_matrix_to_quat(rot):
+    """Normalized quaternion (qx, qy, qz, qw) from a rotation matrix."""
+    qw = _sqrt(1 + rot[0][0] + rot[1][1] + rot[2][2]) / 2
+    qx = _sqrt(1 + rot[0][0] - rot[1][1] - rot[2][2]) / 2
+    qy = _sqrt(1 - rot[0][0] + rot[1][1] - rot[2][2]) / 2
+    qz = _sqrt(1 - rot[0][0] - rot[1][1] + rot[2][2]) / 2
+    # Normalize the quaternion
+    ql = math.sqrt(qx ** 2 + qy ** 2 + qz ** 2 + qw ** 2)
+    return qx / ql, qy / ql, qz / ql, qw / ql
+
+
+def send_extpose_rot_matrix(cf, x, y, z, rot):
+    """Send full pose from mocap to Crazyflie."""
+    qx, qy, qz, qw = rot_matrix_to_quat(rot)
+    cf.extpos.send_extpose(x, y, z, qx, qy, qz, qw)
+
+
+class ExtposeSender(Thread):
+    """Send the latest pose on its own thread at up to rate_hz.
+
+    send: callable taking the pose object passed to put()
+    rate_hz: maximum send rate, None sends as fast as poses arrive
+    max_age: poses older than this (in s) are dropped instead of sent
+    """
+    def __init__(self, send, rate_hz=100, max_age=0.1):
+        Thread.__init__(self, daemon=True)
+
+        self.send = send
+        self.rate_hz = rate_hz
+        self.max_age = max_age
+
+        # Counters
+        self.received = 0
+        self.sent = 0
+        self.overwritten = 0
+        self.dropped = 0
+
+        self._cond = Condition()
+        self._pose = None
+        self._pose_time = 0.0
+        self._stay_open = True
+
+        self.start()
+
+    def put(self, pose):
+        """Hand over a new pose, replacing any pose not sent yet. Never blocks on the radio."""
+        with self._cond:
+            if self._pose is not None:
+                self.overwritten += 1
+            self._pose = pose
+            self._pose_time = time.monotonic()
+            self.received += 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._stay_open = False
+            self._cond.notify()
+        self.join()
+
+    def stats(self):
+        return {'received': self.received, 'sent': self.sent,
+                'overwritten': self.overwritten, 'dropped': self.dropped}
+
+    def run(self):
+        next_send = time.monotonic()
+        while True:
+            # Wait for a pose (mailbox is emptied on take)
+            with self._cond:
+                while self._pose is None and self._stay_open:
+                    self._cond.wait()
+                if not self._stay_open:
+                    return
+                pose, pose_time = self._pose, self._pose_time
+                self._pose = None
+
+            now = time.monotonic()
+            if self.max_age is not None and now - pose_time > self.max_age:
+                self.dropped += 1
+                continue
+
+            self.send(pose)
+            self.sent += 1
+
+            # Pace to rate_hz; a newer pose arriving meanwhile replaces this one
+            if self.rate_hz:
+                next_send = max(next_send, now) + 1.0 / self.rate_hz
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class AdaptiveRateController:
+    """Adjust an ExtposeSender's rate to the radio link quality.
+
+    Fed with cflib link quality updates (0-100 %, frequent), it backs off
+    multiplicatively when the smoothed quality drops below low_quality and
+    ramps up additively while it stays above high_quality, deciding at most
+    once per interval. Frames are coalesced by the sender's mailbox meanwhile.
+    Every rate change is kept in changes as (time.time(), quality, old rate,
+    new rate) and appended to log_file (CSV) if given.
+    """
+    def __init__(self, sender, min_rate=10, max_rate=100, low_quality=80, high_quality=95,
+                 backoff=0.5, step=10, interval=0.5, smoothing=0.05, log_file=None, name=''):
+        self.sender = sender
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.low_quality = low_quality
+        self.high_quality = high_quality
+        self.backoff = backoff
+        self.step = step
+        self.interval = interval
+        self.smoothing = smoothing
+        self.name = name
+
+        self.quality = 100.0
+        self.changes = []
+        self._last_decision = time.monotonic()
+        self._log = None
+        if log_file:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            self._log = open(log_file, 'a')
+
+        sender.rate_hz = max_rate
+
+    def on_link_quality(self, quality):
+        """Callback for cf.link_quality_updated."""
+        self.quality += self.smoothing * (quality - self.quality)
+        now = time.monotonic()
+        if now - self._last_decision < self.interval:
+            return
+        self._last_decision = now
+
+        rate = self.sender.rate_hz
+        if self.quality < self.low_quality:
+            new_rate = max(self.min_rate, rate * self.backoff)
+        elif self.quality > self.high_quality:
+            new_rate = min(self.max_rate, rate + self.step)
+        else:
+            return
+        if new_rate != rate:
+            self.sender.rate_hz = new_rate
+            change = (time.time(), self.quality, rate, new_rate)
+            self.changes.append(change)
+            if self._log:
+                self._log.write('{},{:.3f},{:.1f},{},{}\n'.format(self.name, *change))
+                self._log.flush()
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+
+#
+# PACKED BROADCAST
+#
+
+
+# Localization port, generic channel, packed external pose type (firmware locSrv)
+LOCALIZATION_GENERIC_CH = 1
+EXT_POSE_PACKED = 9
+# id, x, y, z (mm), compressed quaternion
+_packed_item = struct.Struct('<BhhhI')
+ITEMS_PER_PACKET = (30 - 1) // _packed_item.size
+
+
+def quat_compress(qx, qy, qz, qw):
+    """Compress a unit quaternion to 32 bits like the firmware's quatcompress().
+
+    Sends the three smallest elements with 9 bits of magnitude and a sign bit
+    each, plus the index of the largest one (whose sign is made positive).
+    """
+    q = (qx, qy, qz, qw)
+    i_largest = 0
+    for i in range(1, 4):
+        if abs(q[i]) > abs(q[i_largest]):
+            i_largest = i
+    negate = q[i_largest] < 0
+    comp = i_largest
+    for i in range(4):
+        if i != i_largest:
+            negbit = (q[i] < 0) ^ negate
+            mag = int(((1 << 9) - 1) * (abs(q[i]) / math.sqrt(0.5)) + 0.5)
+            comp = (comp << 10) | (negbit << 9) | mag
+    return comp
+
+
+def radio_address_id(uri):
+    """Id a Crazyflie answers to in packed packets: the last byte of its radio address."""
+    parts = uri.split('/')
+    if len(parts) > 5 and parts[5]:
+        return int(parts[5], 16) & 0xFF
+    # Default address E7E7E7E7E7
+    return 0xE7
+
+
+def _mm(v):
+    return max(-32768, min(32767, int(round(v * 1000))))
+
+
+class PackedExtposeSender(Thread):
+    """Broadcast the latest pose of every drone in packed packets, several drones per packet.
+
+    link: link driver to send on, e.g. cflib.crtp.get_link_driver('radiobroadcast://0/80/2M')
+    Poses are put per radio address id; at every tick all pending poses are packed
+    ITEMS_PER_PACKET to a packet, so a swarm of N needs N / ITEMS_PER_PACKET packets
+    instead of N unicast extpose packets. on_sent(pose), if given, is called on the
+    sender thread for every pose once the packet carrying it went out.
+    """
+    def __init__(self, link, rate_hz=100, max_age=0.1, on_sent=None):
+        Thread.__init__(self, daemon=True)
+
+        self.link = link
+        self.rate_hz = rate_hz
+        self.max_age = max_age
+        self.on_sent = on_sent
+
+        # Counters
+        self.received = 0
+        self.sent = 0
+        self.packets = 0
+        self.overwritten = 0
+        self.dropped = 0
+        self._start = time.monotonic()
+
+        self._cond = Condition()
+        self._poses = {}
+        self._stay_open = True
+
+        self.start()
+
+    def put(self, drone_id, pose):
+        """Hand over a new pose [x, y, z, rotmatrix, ...] for drone_id."""
+        with self._cond:
+            if drone_id in self._poses:
+                self.overwritten += 1
+            self._poses[drone_id] = (pose, time.monotonic())
+            self.received += 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._stay_open = False
+            self._cond.notify()
+        self.join()
+
+    def stats(self):
+        """Counters, plus packets per second saved compared to one unicast packet per pose."""
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        return {'received': self.received, 'sent': self.sent, 'packets': self.packets,
+                'overwritten': self.overwritten, 'dropped': self.dropped,
+                'packets_saved_per_s': (self.sent - self.packets) / elapsed}
+
+    def _send(self, items, poses):
+        pk = CRTPPacket()
+        pk.port = CRTPPort.LOCALIZATION
+        pk.channel = LOCALIZATION_GENERIC_CH
+        pk.data = struct.pack('<B', EXT_POSE_PACKED) + b''.join(items)
+        self.link.send_packet(pk)
+        self.packets += 1
+        if self.on_sent:
+            for pose in poses:
+                self.on_sent(pose)
+
+    def run(self):
+        next_send = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._poses and self._stay_open:
+                    self._cond.wait()
+                if not self._stay_open:
+                    return
+                poses, self._poses = self._poses, {}
+
+            now = time.monotonic()
+            items = []
+            packed = []
+            for drone_id, (pose, pose_time) in poses.items():
+                if self.max_age is not None and now - pose_time > self.max_age:
+                    self.dropped += 1
+                    continue
+                qx, qy, qz, qw = rot_matrix_to_quat(pose[3])
+                items.append(_packed_item.pack(drone_id, _mm(pose[0]), _mm(pose[1]), _mm(pose[2]),
+                                               quat_compress(qx, qy, qz, qw)))
+                packed.append(pose)
+                self.sent += 1
+                if len(items) == ITEMS_PER_PACKET:
+                    self._send(items, packed)
+                    items = []
+                    packed = []
+            if items:
+                self._send(items, packed)
+
+            # Pace to rate_hz; poses arriving meanwhile are coalesced per drone
+            if self.rate_hz:
+                next_send = max(next_send, now) + 1.0 / self.rate_hz
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
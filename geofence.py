@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Geofence from 3D volumes, with a precomputed signed-distance grid.
+
+The allowed space is the union of the allowed volumes minus the union of the
+no-fly volumes (pillars, tables, ...). Its signed distance (negative inside)
+is computed once on a grid, after which testing whether a drone has left the
+allowed space and clamping a target to the nearest allowed point are a few
+array lookups, for any number of points at once.
+
+Geofence files are JSON:
+
+    {
+        "resolution": 0.05,
+        "allowed": [{"type": "box", "min": [-1.0, -2.0, 0.0], "max": [1.0, 1.0, 1.5]}],
+        "no_fly": [
+            {"type": "cylinder", "center": [0.0, -1.0], "radius": 0.2, "z": [0.0, 3.0]},
+            {"type": "prism", "polygon": [[0.3, 0.0], [0.9, 0.0], [0.9, 0.6], [0.3, 0.6]], "z": [0.0, 0.8]},
+            {"type": "mesh", "file": "table.obj"}
+        ]
+    }
+
+Mesh files are Wavefront OBJ with closed surfaces, relative paths are
+relative to the geofence file.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+#
+# VOLUMES
+#
+
+
+def _combine(d_xy, d_z):
+    """Signed distance of the intersection of an xy shape and a z slab."""
+    outside = np.hypot(np.maximum(d_xy, 0.0), np.maximum(d_z, 0.0))
+    return outside + np.minimum(np.maximum(d_xy, d_z), 0.0)
+
+
+class Box:
+    """Axis-aligned box."""
+    def __init__(self, low, high):
+        self.min = np.asarray(low, dtype=float)
+        self.max = np.asarray(high, dtype=float)
+
+    def bounds(self):
+        return self.min, self.max
+
+    def sdf(self, points):
+        q = np.abs(points - (self.min + self.max) / 2.0) - (self.max - self.min) / 2.0
+        return np.linalg.norm(np.maximum(q, 0.0), axis=1) + np.minimum(q.max(axis=1), 0.0)
+
+
+class Prism:
+    """Polygon in the xy plane, extruded from z[0] to z[1]."""
+    def __init__(self, polygon, z):
+        self.polygon = np.asarray(polygon, dtype=float)
+        self.z = z
+
+    def bounds(self):
+        return (np.append(self.polygon.min(axis=0), self.z[0]),
+                np.append(self.polygon.max(axis=0), self.z[1]))
+
+    def _sdf_xy(self, xy):
+        a = self.polygon
+        b = np.roll(a, -1, axis=0)
+        # Distance to every edge, (points, edges)
+        ab = b - a
+        ap = xy[:, None, :] - a[None, :, :]
+        t = np.clip((ap * ab).sum(axis=2) / (ab * ab).sum(axis=1), 0.0, 1.0)
+        distance = np.linalg.norm(ap - t[:, :, None] * ab, axis=2).min(axis=1)
+        # Inside by crossing number
+        ay, by = a[:, 1], b[:, 1]
+        y = xy[:, 1:2]
+        crosses = (ay > y) != (by > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = a[:, 0] + (y - ay) * ab[:, 0] / ab[:, 1]
+        inside = (crosses & (xy[:, 0:1] < x_cross)).sum(axis=1) % 2 == 1
+        return np.where(inside, -distance, distance)
+
+    def sdf(self, points):
+        d_z = np.maximum(self.z[0] - points[:, 2], points[:, 2] - self.z[1])
+        return _combine(self._sdf_xy(points[:, :2]), d_z)
+
+
+class Cylinder(Prism):
+    """Vertical cylinder, e.g. a pillar."""
+    def __init__(self, center, radius, z):
+        self.center = np.asarray(center, dtype=float)
+        self.radius = radius
+        self.z = z
+
+    def bounds(self):
+        return (np.append(self.center - self.radius, self.z[0]),
+                np.append(self.center + self.radius, self.z[1]))
+
+    def _sdf_xy(self, xy):
+        return np.linalg.norm(xy - self.center, axis=1) - self.radius
+
+
+class Mesh:
+    """Closed triangle mesh, inside by winding number."""
+    def __init__(self, vertices, triangles):
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.triangles = np.asarray(triangles, dtype=int)
+
+    @classmethod
+    def load_obj(cls, path):
+        vertices = []
+        triangles = []
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                if parts[0] == 'v':
+                    vertices.append([float(v) for v in parts[1:4]])
+                elif parts[0] == 'f':
+                    face = [int(p.split('/')[0]) - 1 for p in parts[1:]]
+                    # Triangle fan for polygons
+                    for i in range(1, len(face) - 1):
+                        triangles.append([face[0], face[i], face[i + 1]])
+        return cls(vertices, triangles)
+
+    def bounds(self):
+        return self.vertices.min(axis=0), self.vertices.max(axis=0)
+
+    def sdf(self, points, block=4096):
+        out = np.empty(len(points))
+        for start in range(0, len(points), block):
+            out[start:start + block] = self._sdf_block(points[start:start + block])
+        return out
+
+    def _sdf_block(self, p):
+        a, b, c = (self.vertices[self.triangles[:, i]] for i in range(3))
+        p = p[:, None, :]
+
+        # Distance to the triangle plane where the projection falls inside the triangle
+        n = np.cross(b - a, c - a)
+        n /= np.linalg.norm(n, axis=1)[:, None]
+        plane = ((p - a) * n).sum(axis=2)
+        projection = p - plane[:, :, None] * n
+        inside = np.ones(plane.shape, dtype=bool)
+        for u, v in ((a, b), (b, c), (c, a)):
+            inside &= (np.cross(v - u, projection - u) * n).sum(axis=2) >= 0.0
+        distance = np.where(inside, np.abs(plane), np.inf)
+
+        # Otherwise distance to the closest edge
+        for u, v in ((a, b), (b, c), (c, a)):
+            uv = v - u
+            t = np.clip(((p - u) * uv).sum(axis=2) / (uv * uv).sum(axis=1), 0.0, 1.0)
+            distance = np.minimum(distance, np.linalg.norm(p - u - t[:, :, None] * uv, axis=2))
+        distance = distance.min(axis=1)
+
+        # Winding number from the solid angles of all triangles
+        ra, rb, rc = a - p, b - p, c - p
+        la, lb, lc = (np.linalg.norm(r, axis=2) for r in (ra, rb, rc))
+        numerator = (ra * np.cross(rb, rc)).sum(axis=2)
+        denominator = (la * lb * lc + (ra * rb).sum(axis=2) * lc
+                       + (rb * rc).sum(axis=2) * la + (rc * ra).sum(axis=2) * lb)
+        winding = np.arctan2(numerator, denominator).sum(axis=1) / (2.0 * np.pi)
+        return np.where(np.abs(winding) > 0.5, -distance, distance)
+
+
+def volume_from_dict(spec, base_dir='.'):
+    kind = spec['type']
+    if kind == 'box':
+        return Box(spec['min'], spec['max'])
+    if kind == 'prism':
+        return Prism(spec['polygon'], spec['z'])
+    if kind == 'cylinder':
+        return Cylinder(spec['center'], spec['radius'], spec['z'])
+    if kind == 'mesh':
+        return Mesh.load_obj(os.path.join(base_dir, spec['file']))
+    raise ValueError('Unknown geofence volume type: ' + kind)
+
+
+#
+# GEOFENCE
+#
+
+
+class Geofence:
+    """Signed distance to the allowed space on a grid, with O(1) lookups.
+
+    distance(), inside() and clamp() take one point (3,) or many (n, 3).
+    Distances are trilinear interpolations of the grid, outside the grid the
+    distance to the grid is added. The grid covers the allowed volumes plus
+    padding on every side.
+    """
+    def __init__(self, allowed, no_fly=(), resolution=0.05, padding=0.5):
+        self.allowed = list(allowed)
+        self.no_fly = list(no_fly)
+        self.resolution = resolution
+
+        lows, highs = zip(*(volume.bounds() for volume in self.allowed))
+        self.origin = np.min(lows, axis=0) - padding
+        top = np.max(highs, axis=0) + padding
+        self.shape = np.ceil((top - self.origin) / resolution).astype(int) + 1
+
+        axes = [self.origin[i] + resolution * np.arange(self.shape[i]) for i in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        distance = np.min([volume.sdf(points) for volume in self.allowed], axis=0)
+        for volume in self.no_fly:
+            distance = np.maximum(distance, -volume.sdf(points))
+        self.grid = distance.reshape(self.shape).astype(np.float32)
+        self.gradient = np.stack(np.gradient(self.grid, resolution), axis=-1).astype(np.float32)
+        # Boxes alone are clamped exactly, without the grid
+        self._boxes = not self.no_fly and all(isinstance(volume, Box) for volume in self.allowed)
+
+    def _locate(self, points):
+        """Cell indexes, interpolation weights and the distance from the grid of points (n, 3)."""
+        f = (points - self.origin) / self.resolution
+        clipped = np.clip(f, 0.0, self.shape - 1.000001)
+        i = clipped.astype(int)
+        beyond = np.linalg.norm(f - clipped, axis=1) * self.resolution
+        return i, clipped - i, beyond
+
+    def distance(self, points):
+        """Signed distance to the allowed space, negative inside."""
+        points = np.asarray(points, dtype=float)
+        single = points.ndim == 1
+        points = np.atleast_2d(points)
+        i, t, beyond = self._locate(points)
+        x, y, z = i.T
+        tx, ty, tz = t.T
+        g = self.grid
+        c00 = g[x, y, z] * (1 - tx) + g[x + 1, y, z] * tx
+        c10 = g[x, y + 1, z] * (1 - tx) + g[x + 1, y + 1, z] * tx
+        c01 = g[x, y, z + 1] * (1 - tx) + g[x + 1, y, z + 1] * tx
+        c11 = g[x, y + 1, z + 1] * (1 - tx) + g[x + 1, y + 1, z + 1] * tx
+        d = (c00 * (1 - ty) + c10 * ty) * (1 - tz) + (c01 * (1 - ty) + c11 * ty) * tz + beyond
+        return float(d[0]) if single else d
+
+    def inside(self, points, margin=0.0):
+        """True where points are inside the allowed space, or less than margin outside it."""
+        return self.distance(points) < margin
+
+    def exit_distance(self, points):
+        """How far points are outside the allowed space, for checking a safety margin.
+
+        Box-only fences measure it per axis, like a bounding box check with
+        the margin added on every side; the corners of the margin are not
+        rounded off. Other fences use distance().
+        """
+        if not self._boxes:
+            return self.distance(points)
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        return np.min([(np.abs(points - (box.min + box.max) / 2.0) - (box.max - box.min) / 2.0).max(axis=1)
+                       for box in self.allowed], axis=0)
+
+    def _normal(self, points):
+        """Unit gradient of the distance, trilinearly interpolated like distance()."""
+        i, t, _ = self._locate(points)
+        x, y, z = i.T
+        n = np.zeros((len(points), 3))
+        for dx in (0, 1):
+            wx = t[:, 0] if dx else 1 - t[:, 0]
+            for dy in (0, 1):
+                wy = t[:, 1] if dy else 1 - t[:, 1]
+                for dz in (0, 1):
+                    wz = t[:, 2] if dz else 1 - t[:, 2]
+                    n += (wx * wy * wz)[:, None] * self.gradient[x + dx, y + dy, z + dz]
+        length = np.linalg.norm(n, axis=1)
+        # On a ridge (e.g. the axis of a pillar) any direction leads out
+        flat = length < 1e-6
+        n[flat] = (1.0, 0.0, 0.0)
+        length[flat] = 1.0
+        return n / length[:, None]
+
+    def _clamp_boxes(self, p, margin):
+        """Exact clamp into the nearest box, shrunk by margin."""
+        inside = np.min([box.sdf(p) for box in self.allowed], axis=0) <= -margin
+        candidates = []
+        for box in self.allowed:
+            low = np.minimum(box.min + margin, (box.min + box.max) / 2.0)
+            high = np.maximum(box.max - margin, (box.min + box.max) / 2.0)
+            candidates.append(np.clip(p, low, high))
+        candidates = np.array(candidates)
+        nearest = np.linalg.norm(candidates - p, axis=2).argmin(axis=0)
+        return np.where(inside[:, None], p, candidates[nearest, np.arange(len(p))])
+
+    def clamp(self, points, margin=0.0, iterations=10, fallback=None):
+        """Nearest points at least margin inside the allowed space, points already there are unchanged.
+
+        Exact when the allowed space is boxes only. Otherwise points step down
+        the distance gradient until distance() <= -margin; those that do not
+        get there within iterations are replaced by fallback (e.g. the last
+        safe target) if given, or else by the nearest grid node that is.
+        """
+        points = np.asarray(points, dtype=float)
+        single = points.ndim == 1
+        p = np.atleast_2d(points).copy()
+        if self._boxes:
+            p = self._clamp_boxes(p, margin)
+            return p[0] if single else p
+
+        d = self.distance(p)
+        out = d > -margin
+        if out.any():
+            # Start from the grid, its gradient is not known beyond
+            top = self.origin + (self.shape - 1) * self.resolution
+            p[out] = np.clip(p[out], self.origin, top)
+            d[out] = self.distance(p[out])
+            out = d > -margin
+        for _ in range(iterations):
+            if not out.any():
+                break
+            # Step down the distance gradient, a little further to end up inside
+            p[out] -= (d[out] + margin + 0.1 * self.resolution)[:, None] * self._normal(p[out])
+            d[out] = self.distance(p[out])
+            out = d > -margin
+        if out.any():
+            if fallback is not None:
+                p[out] = np.broadcast_to(np.asarray(fallback, dtype=float), p.shape)[out]
+            else:
+                p[out] = self._nearest_node(p[out], margin)
+        return p[0] if single else p
+
+    def _nearest_node(self, points, margin):
+        """Nearest grid nodes at least margin inside, for points the gradient steps got stuck on."""
+        nodes = np.argwhere(self.grid <= -margin)
+        if len(nodes) == 0:
+            return points
+        nodes = self.origin + nodes * self.resolution
+        return np.array([nodes[np.einsum('ij,ij->i', nodes - q, nodes - q).argmin()] for q in points])
+
+
+def load_geofence(path):
+    """Geofence from a JSON file, see the module docstring."""
+    with open(path) as f:
+        spec = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return Geofence([volume_from_dict(v, base_dir) for v in spec['allowed']],
+                    [volume_from_dict(v, base_dir) for v in spec.get('no_fly', [])],
+                    resolution=spec.get('resolution', 0.05), padding=spec.get('padding', 0.5))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Device connection helpers and a parallel startup orchestrator.
+
+Startup brings up all devices at once instead of one after the other, each
+with its own retries and timeout, and reports how long every device took to
+become ready:
+
+    startup = Startup()
+    startup.add('crazyflie', lambda: cf_connect(cf_uri), close=lambda scf: scf.close_link(), retries=3)
+    startup.add('bitalino', lambda: bt_connect(bt_macAddress, retries=1), close=lambda bt: bt.close(), retries=10)
+    with startup as devices:
+        print(startup.report())
+        ...
+"""
+
+import os
+import time
+from threading import Lock, Thread
+
+from params import ParamClient
+
+
+# Log and param TOC cache shared by all scripts, wherever they are started from.
+# Fill it ahead of a session with warm-cache.py.
+CACHE_DIR = os.environ.get('CF_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+
+# CSV logs and benchmark results, kept out of the working directory
+LOG_DIR = os.environ.get('CF_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'))
+
+# Set by bench-startup.py: scripts stop at their first setpoint instead of flying
+STARTUP_BENCH_ENV = 'CF_STARTUP_BENCH'
+
+_imported_at = time.time()
+
+
+class StartupError(Exception):
+    """One or more devices did not become ready."""
+
+
+class _Device:
+    def __init__(self, name, connect, close, retries, retry_delay, timeout, on_retry):
+        self.name = name
+        self.connect = connect
+        self.close = close
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.on_retry = on_retry
+
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.elapsed = None
+        self.abandoned = False
+        self.lock = Lock()
+        self.thread = None
+
+
+class Startup:
+    """Connect several devices in parallel, with retries and timeouts.
+
+    Every device gets a thread running connect() until it succeeds, it has
+    been tried retries times or its timeout (in s from the start) has passed.
+    run() returns a dict of the connect() results by device name, or closes
+    whatever did connect and raises StartupError. Used as a context manager,
+    the devices are closed again on exit, in reverse order.
+    """
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+        self.devices = []
+        self.start_time = None
+
+    def add(self, name, connect, close=None, retries=1, retry_delay=0.5, timeout=None, on_retry=None):
+        """Add a device. on_retry(attempt, error) is called after every failed attempt but the last."""
+        self.devices.append(_Device(name, connect, close, retries, retry_delay,
+                                    self.timeout if timeout is None else timeout, on_retry))
+
+    def run(self):
+        self.start_time = time.monotonic()
+        for device in self.devices:
+            device.thread = Thread(target=self._connect, args=(device,), daemon=True)
+            device.thread.start()
+
+        for device in self.devices:
+            device.thread.join(max(0.0, self.start_time + device.timeout - time.monotonic()))
+            with device.lock:
+                if device.thread.is_alive():
+                    # connect() cannot be interrupted, it closes its result if it still succeeds
+                    device.abandoned = True
+                    device.error = TimeoutError('not ready within {:.1f} s'.format(device.timeout))
+
+        failed = [device for device in self.devices if device.error is not None]
+        if failed:
+            self.close()
+            raise StartupError(', '.join(device.name + ': ' + str(device.error) for device in failed))
+        return {device.name: device.result for device in self.devices}
+
+    def _connect(self, device):
+        deadline = self.start_time + device.timeout
+        while True:
+            device.attempts += 1
+            try:
+                result = device.connect()
+            except Exception as ex:
+                print('{}: attempt {}/{} failed: {}'.format(device.name, device.attempts, device.retries, ex))
+                if device.attempts >= device.retries or time.monotonic() + device.retry_delay >= deadline:
+                    with device.lock:
+                        if not device.abandoned:
+                            device.error = ex
+                    return
+                if device.on_retry:
+                    device.on_retry(device.attempts, ex)
+                time.sleep(device.retry_delay)
+                continue
+            with device.lock:
+                if device.abandoned:
+                    if device.close:
+                        device.close(result)
+                    return
+                device.result = result
+                device.elapsed = time.monotonic() - self.start_time
+            print('{}: ready after {:.2f} s'.format(device.name, device.elapsed))
+            return
+
+    def ready(self, name):
+        """connect() result of a device that is connected already, else None (e.g. from on_retry of another)."""
+        for device in self.devices:
+            if device.name == name:
+                with device.lock:
+                    return device.result
+        return None
+
+    def close(self):
+        """Close all connected devices, in reverse order."""
+        for device in reversed(self.devices):
+            with device.lock:
+                result, device.result = device.result, None
+            if result is not None and device.close:
+                try:
+                    device.close(result)
+                except Exception as ex:
+                    print('{}: close failed: {}'.format(device.name, ex))
+
+    def report(self):
+        """Time to ready of every device."""
+        lines = ['Startup:']
+        for device in self.devices:
+            if device.elapsed is not None:
+                status = 'ready after {:6.2f} s'.format(device.elapsed)
+            else:
+                status = 'FAILED: ' + str(device.error)
+            lines.append('  {:<28} {} ({} attempt{})'.format(
+                device.name, status, device.attempts, '' if device.attempts == 1 else 's'))
+        if self.start_time is not None:
+            ready = [device.elapsed for device in self.devices if device.elapsed is not None]
+            if ready:
+                lines.append('  {:<28} {:6.2f} s'.format('all ready after', max(ready)))
+        return '\n'.join(lines)
+
+    def __enter__(self):
+        return self.run()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+#
+# DEVICES
+#
+
+
+def cf_connect(uri, rw_cache=CACHE_DIR):
+    """Open a SyncCrazyflie link (including the TOC download). Returns the open SyncCrazyflie."""
+    from cflib.crazyflie import Crazyflie
+    from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+
+    if rw_cache:
+        os.makedirs(rw_cache, exist_ok=True)
+    scf = SyncCrazyflie(uri, cf=Crazyflie(rw_cache=rw_cache))
+    scf.open_link()
+    return scf
+
+
+def process_start_time():
+    """Unix time the Python process started, or the time this module was imported without psutil."""
+    try:
+        import psutil
+    except ImportError:
+        return _imported_at
+    return psutil.Process().create_time()
+
+
+def first_setpoint(name=''):
+    """Print the time from process start to the first setpoint.
+
+    Returns True in a startup benchmark run, in which case the caller does not
+    send the setpoint and stops.
+    """
+    print(name + 'Time to first setpoint: {:.3f} s'.format(time.time() - process_start_time()))
+    return bool(os.environ.get(STARTUP_BENCH_ENV))
+
+
+def cf_preflight_reset(cf, params=None):
+    """Switch off the LED ring and reset the Kalman estimator. Returns the ParamClient used.
+
+    Raises StartupError if the Crazyflie does not acknowledge the reset.
+    """
+    from estimator import reset_estimator
+
+    if params is None:
+        params = ParamClient(cf)
+    params.set('ring.effect', '0')
+    if not reset_estimator(params):
+        params.close(0)
+        raise StartupError('Crazyflie did not acknowledge the estimator reset')
+    return params
+
+
+def ring_blink(cf, times=2, period=0.2):
+    """Blink the LED ring (effect 9) and leave it off, e.g. to signal a connection retry."""
+    for _ in range(times):
+        cf.param.set_value('ring.effect', '9')
+        time.sleep(period / 2)
+        cf.param.set_value('ring.effect', '0')
+        time.sleep(period / 2)
+
+
+def bt_connect(address, timeout=2, retries=10, retry_delay=0.1):
+    """Connect to a BITalino by MAC address or virtual COM port, trying up to retries times."""
+    from bitalino import BITalino
+
+    for attempt in range(1, retries + 1):
+        try:
+            bt = BITalino(address, timeout=timeout)
+        except OSError:
+            if attempt == retries:
+                raise
+            print('Connection {}/{} to BITalino {} failed! Retrying...'.format(attempt, retries, address))
+            time.sleep(retry_delay)
+            continue
+        print('Connected to BITalino ' + address)
+        return bt
+
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+QTM decoding in a separate process.
+
+The QTM connection, packet parsing and pose math run in a child process
+that publishes every frame to a PoseRing in shared memory. The flight
+process reads the poses from there without copies, and its control loop
+and radio threads no longer share the GIL with the decoder.
+
+Start-up handshake over the control pipe:
+
+    child  -> ('bodies', body_names)        or ('error', message)
+    parent -> ('ring', ring_name, slots)    or ('stop',)
+    ...                                     one byte on the notify pipe per frame
+    parent -> ('stop',)
+    child  -> ('stopped', frames)
+"""
+
+import asyncio
+import os
+import time
+
+from mocap import FlightRecorder, PoseRing, PoseStore, open_recording, qtm_body_names, replay_recording
+
+
+def receive(loop, conn):
+    """Future of the next message on a multiprocessing Connection, received on loop."""
+    future = loop.create_future()
+
+    def on_readable():
+        loop.remove_reader(conn.fileno())
+        if not future.done():
+            try:
+                future.set_result(conn.recv())
+            except EOFError as ex:
+                future.set_exception(ex)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    return future
+
+
+def ingest_main(conn, notify, qtm_ip, euler_body_names=(), euler_mode='lazy',
+                record_file=None, replay_file=None, replay_speed=1.0):
+    """Child process entry point. conn: duplex control Connection, notify: write end of the notify pipe."""
+    try:
+        asyncio.run(_ingest(conn, notify, qtm_ip, euler_body_names, euler_mode,
+                            record_file, replay_file, replay_speed))
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the whole process group, the parent stops us
+        pass
+
+
+async def _ingest(conn, notify, qtm_ip, euler_body_names, euler_mode, record_file, replay_file, replay_speed):
+    loop = asyncio.get_running_loop()
+    connection = None
+    if replay_file:
+        body_names, records = open_recording(replay_file)
+        # Recordings hold the 6d component only
+        if euler_mode == 'qtm':
+            euler_mode = 'eager'
+    else:
+        import qtm
+
+        connection = await qtm.connect(qtm_ip)
+        if connection is None:
+            conn.send(('error', 'QTM connection failed'))
+            return
+        body_names = await qtm_body_names(connection)
+    conn.send(('bodies', body_names))
+
+    message = await receive(loop, conn)
+    if message[0] != 'ring':
+        if connection:
+            connection.disconnect()
+        conn.send(('stopped', 0))
+        return
+    ring = PoseRing(len(body_names), slots=message[2], name=message[1])
+
+    # Euler angles are read straight from the ring, so they are never lazy here
+    euler_idxs = [body_names.index(name) for name in euler_body_names if name in body_names]
+    poses = PoseStore(len(body_names), euler_idxs=euler_idxs,
+                      euler_mode='eager' if euler_mode == 'lazy' else euler_mode)
+    recorder = FlightRecorder(record_file, body_names) if record_file else None
+    notify_fd = notify.fileno()
+    os.set_blocking(notify_fd, False)
+
+    def on_packet(packet):
+        received = time.perf_counter_ns()
+        header, component_6d = packet.get_6d()
+        if component_6d is None:
+            print('No 6d component in QTM packet!')
+            return
+        if recorder:
+            recorder.write(packet.timestamp, packet.framenumber, component_6d)
+        if euler_mode == 'qtm':
+            header, component_6deuler = packet.get_6d_euler()
+            if component_6deuler is None:
+                print('No 6deuler component in QTM packet!')
+                return
+        poses.update_6d(component_6d)
+        if euler_mode == 'qtm':
+            poses.update_6deuler(component_6deuler)
+        ring.publish(poses, packet.framenumber, packet.timestamp, received)
+        try:
+            os.write(notify_fd, b'\0')
+        except BlockingIOError:
+            # The reader is behind, it reads the newest frame anyway
+            pass
+
+    stop = receive(loop, conn)
+    if replay_file:
+        replay = asyncio.create_task(replay_recording(records, on_packet, speed=replay_speed,
+                                                      should_stop=stop.done))
+    else:
+        components = ['6d', '6deuler'] if euler_mode == 'qtm' else ['6d']
+        await connection.stream_frames(components=components, on_packet=on_packet)
+    try:
+        await stop
+    except EOFError:
+        # Parent is gone
+        pass
+
+    try:
+        if replay_file:
+            await replay
+        else:
+            try:
+                await connection.stream_frames_stop()
+                connection.disconnect()
+            except (qtm.QRTCommandException, OSError) as ex:
+                # QTM may have dropped the connection already
+                print('Stopping QTM stream failed: ' + str(ex))
+    finally:
+        if recorder:
+            recorder.close()
+            print('Recorded ' + str(recorder.frames) + ' QTM frames.')
+        ring.close()
+        try:
+            conn.send(('stopped', ring.published))
+        except OSError:
+            pass
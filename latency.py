@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Low-overhead latency measurement from mocap frame to radio.
+"""
+
+import time
+
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of nanosecond values.
+
+    Each power of two is split into 2**(sub_bits - 1) buckets, so recorded values
+    are kept with a relative precision of about 2**(1 - sub_bits) (3 % by default).
+    Recording is a few integer operations and a list increment.
+    """
+    def __init__(self, sub_bits=6, max_bits=40):
+        self._sub_bits = sub_bits
+        self._half = 1 << (sub_bits - 1)
+        self._counts = [0] * ((max_bits - sub_bits + 2) * self._half)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        if ns < 0:
+            ns = 0
+        shift = ns.bit_length() - self._sub_bits
+        if shift <= 0:
+            idx = ns
+        else:
+            idx = shift * self._half + (ns >> shift)
+        if idx >= len(self._counts):
+            idx = len(self._counts) - 1
+        self._counts[idx] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def _bucket_value(self, idx):
+        if idx < 2 * self._half:
+            return idx
+        shift = idx // self._half - 1
+        return (idx - shift * self._half) << shift
+
+    def percentile(self, p):
+        """Lower bound of the bucket holding the p-th percentile, in ns."""
+        if self.count == 0:
+            return 0
+        rank = max(1, int(p / 100.0 * self.count + 0.5))
+        seen = 0
+        for idx, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return self._bucket_value(idx)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        self._counts = [0] * len(self._counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def summary(self):
+        """Statistics in ms."""
+        return {'count': self.count,
+                'mean_ms': self.mean() / 1e6,
+                'p50_ms': self.percentile(50) / 1e6,
+                'p90_ms': self.percentile(90) / 1e6,
+                'p99_ms': self.percentile(99) / 1e6,
+                'max_ms': self.max / 1e6}
+
+
+class LatencyTracker:
+    """Per-frame monotonic timestamps at every pipeline stage, aggregated into histograms.
+
+    Stages are stamped in order with stamp(frame, stage); each stamp records the
+    latency since the previous stage and since the first one. Stamps of recent
+    frames live in a fixed ring of slots, so nothing is allocated per frame.
+    A stage is only stamped once per frame (e.g. the first setpoint that used it).
+
+    The QTM capture timestamp runs on another clock, so begin() records the
+    capture-to-receive delay relative to the smallest delay seen so far.
+    """
+    def __init__(self, stages, slots=1024):
+        self.stages = list(stages)
+        self._stage_idx = {stage: i for i, stage in enumerate(self.stages)}
+        self._frames = [-1] * slots
+        self._stamps = [[0] * len(self.stages) for _ in range(slots)]
+        self._min_offset = None
+        self.transport = LatencyHistogram()
+        self.step = [LatencyHistogram() for _ in self.stages]
+        self.total = [LatencyHistogram() for _ in self.stages]
+
+    def begin(self, frame, qtm_timestamp_us=None, at=None):
+        """Stamp the first stage of a new frame.
+
+        at: time.perf_counter_ns() of the stamp if not now, e.g. taken in another process.
+        """
+        now = time.perf_counter_ns() if at is None else at
+        slot = frame % len(self._frames)
+        stamps = self._stamps[slot]
+        for i in range(1, len(stamps)):
+            stamps[i] = 0
+        stamps[0] = now
+        self._frames[slot] = frame
+
+        if qtm_timestamp_us is not None:
+            offset = now - qtm_timestamp_us * 1000
+            if self._min_offset is None or offset < self._min_offset:
+                self._min_offset = offset
+            self.transport.record(offset - self._min_offset)
+
+    def stamp(self, frame, stage, at=None):
+        now = time.perf_counter_ns() if at is None else at
+        slot = frame % len(self._frames)
+        if self._frames[slot] != frame:
+            # Frame too old, its slot has been reused
+            return
+        stamps = self._stamps[slot]
+        i = self._stage_idx[stage]
+        if stamps[i]:
+            return
+        stamps[i] = now
+        # Latency since the closest earlier stage that was stamped
+        for j in range(i - 1, -1, -1):
+            if stamps[j]:
+                self.step[i].record(now - stamps[j])
+                break
+        self.total[i].record(now - stamps[0])
+
+    def reset(self):
+        self.transport.reset()
+        for histogram in self.step + self.total:
+            histogram.reset()
+
+    def snapshot(self):
+        """Current statistics per stage, can be polled during flight."""
+        stats = {'qtm->' + self.stages[0]: self.transport.summary()}
+        for i in range(1, len(self.stages)):
+            stats[self.stages[i]] = {'step': self.step[i].summary(), 'total': self.total[i].summary()}
+        return stats
+
+    def report(self):
+        lines = ["{:<12} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+            'Stage', 'Count', 'p50 ms', 'p99 ms', 'max ms', 'total p99')]
+        s = self.transport.summary()
+        lines.append("{:<12} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9}".format(
+            'qtm (rel)', s['count'], s['p50_ms'], s['p99_ms'], s['max_ms'], ''))
+        for i in range(1, len(self.stages)):
+            s = self.step[i].summary()
+            lines.append("{:<12} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                self.stages[i], s['count'], s['p50_ms'], s['p99_ms'], s['max_ms'],
+                self.total[i].percentile(99) / 1e6))
+        return '\n'.join(lines)
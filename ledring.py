@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+LED ring deck output through the LED driver memory.
+
+A whole colour frame goes out in one memory write instead of three
+'ring.solid*' param writes per colour. Frames that look the same as the one
+on the ring are skipped, and writes are capped to max_rate.
+"""
+
+import time
+
+import numpy as np
+
+from cflib.crazyflie.mem import MemoryElement
+
+
+# Ring effect that shows the LED driver memory
+RING_EFFECT_MEMORY = '13'
+
+
+class LedRing:
+    """Write colour frames to the LED ring deck with change detection and a rate cap.
+
+    threshold: smallest change, in gamma-encoded 0-255 units on any channel,
+    worth sending; smaller changes are not visible and are skipped.
+    A frame held back by the rate cap or by a write still in flight is sent
+    by a later set_frame() or flush(). cflib's LED memory has no failure
+    callback, so a write not acknowledged within write_timeout s counts as
+    failed and the next frame goes out. params: optional params.ParamClient
+    used to switch the ring effect.
+    """
+    def __init__(self, cf, max_rate=20, threshold=3.0, gamma=2.2, params=None, write_timeout=0.5):
+        self.cf = cf
+        self.params = params
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.threshold = threshold
+        self.gamma = gamma
+        self.write_timeout = write_timeout
+
+        # Counters
+        self.frames = 0
+        self.written = 0
+        self.skipped_unchanged = 0
+        self.deferred = 0
+        self.failed = 0
+
+        self._mem = None
+        self._n_leds = 0
+        self._shown = None
+        self._pending = None
+        self._in_flight = False
+        self._last_write = 0.0
+
+    def enable(self):
+        """Switch the ring to the LED memory effect."""
+        if self.params:
+            self.params.set('ring.effect', RING_EFFECT_MEMORY, wait=True)
+        else:
+            self.cf.param.set_value('ring.effect', RING_EFFECT_MEMORY)
+        self._mem = self.cf.mem.get_mems(MemoryElement.TYPE_DRIVER_LED)[0]
+        self._n_leds = len(self._mem.leds)
+        self._shown = np.full((self._n_leds, 3), np.nan)
+
+    def _perceived(self, frame):
+        return 255.0 * (np.clip(frame, 0, 255) / 255.0) ** (1.0 / self.gamma)
+
+    def set_all(self, r, g, b):
+        """Set every LED to one colour."""
+        self.set_frame(np.tile((r, g, b), (self._n_leds, 1)))
+
+    def set_frame(self, frame):
+        """Set all LEDs from an (n_leds, 3) array of r, g, b values 0-255."""
+        frame = np.asarray(frame, dtype=float)
+        self.frames += 1
+        if np.abs(self._perceived(frame) - self._perceived(self._shown)).max() < self.threshold:
+            self._pending = None
+            self.skipped_unchanged += 1
+            return
+        self._pending = frame
+        self.flush()
+
+    def flush(self):
+        """Write the pending frame if the rate cap and the previous write allow it."""
+        if self._pending is None:
+            return
+        if self._in_flight and time.monotonic() - self._last_write > self.write_timeout:
+            # Lost write: what the ring shows is unknown, any frame is worth sending
+            self._in_flight = False
+            self._shown = np.full((self._n_leds, 3), np.nan)
+            self.failed += 1
+        if self._in_flight or time.monotonic() - self._last_write < self.min_interval:
+            self.deferred += 1
+            return
+        frame, self._pending = self._pending, None
+        for led, (r, g, b) in zip(self._mem.leds, frame.astype(int).tolist()):
+            led.set(r=r, g=g, b=b)
+        self._shown = frame
+        self._in_flight = True
+        self._last_write = time.monotonic()
+        self._mem.write_data(self._write_done)
+        self.written += 1
+
+    def _write_done(self, mem, addr):
+        self._in_flight = False
+
+    def stats(self):
+        return {'frames': self.frames, 'written': self.written,
+                'skipped_unchanged': self.skipped_unchanged, 'deferred': self.deferred, 'failed': self.failed}
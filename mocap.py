@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""
+Motion capture data handling shared by the Qualisys scripts.
+"""
+
+import asyncio
+import math
+import os
+import struct
+import time
+import xml.etree.cElementTree as ET
+from collections import namedtuple
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+async def qtm_body_names(connection):
+    """Names of the QTM 6DOF bodies, in the order of the 6d component."""
+    params_xml = await connection.get_parameters(parameters=['6d'])
+    xml = ET.fromstring(params_xml)
+    return [body.text.strip() for body in xml.findall("*/Body/Name")]
+
+
+class PoseStore:
+    """Preallocated, array-backed poses of all QTM 6DOF bodies, indexed like bodyToIdx.
+
+    Positions are in m and rotation matrices are in Crazyflie (row-major) order.
+    A body keeps its last valid pose when QTM reports NaN for it; valid tells
+    whether it was seen in the latest frame.
+    Updating never allocates: all buffers are created once in __init__.
+
+    euler_mode selects where euler angles come from:
+    'qtm'   - the QTM 6deuler component, passed to update_6deuler()
+    'eager' - derived from the rotation matrices of euler_idxs on every update_6d()
+    'lazy'  - derived from the rotation matrices of euler_idxs when first read after a frame
+    """
+    def __init__(self, n_bodies, euler_idxs=None, euler_mode='qtm'):
+        if euler_mode not in ('qtm', 'eager', 'lazy'):
+            raise ValueError("Unknown euler mode '" + str(euler_mode) + "'")
+        self.n_bodies = n_bodies
+        self.euler_mode = euler_mode
+        # Bodies whose euler angles are derived on the host
+        if euler_idxs is None:
+            euler_idxs = range(n_bodies)
+        self._euler_idxs = np.array(sorted(euler_idxs), dtype=np.intp)
+        self._euler_dirty = False
+
+        self.pos = np.zeros((n_bodies, 3))
+        # QTM sends rotation matrices column-major, the transposed view is row-major
+        self._rot_qtm = np.zeros((n_bodies, 9))
+        self._rot_qtm.reshape(n_bodies, 3, 3)[:] = np.eye(3)
+        self.rot = self._rot_qtm.reshape(n_bodies, 3, 3).transpose(0, 2, 1)
+        # roll, pitch, yaw in degrees
+        self.euler = np.zeros((n_bodies, 3))
+        self.valid = np.zeros(n_bodies, dtype=bool)
+        # Consecutive frames each body has been missing for
+        self.lost = np.zeros(n_bodies, dtype=np.int64)
+        self.frames = 0
+
+        # Staging buffers for the raw frame
+        self._pos_mm = np.zeros((n_bodies, 3))
+        self._rot_raw = np.zeros((n_bodies, 9))
+        self._euler_raw = np.zeros((n_bodies, 3))
+        self._finite = np.zeros((n_bodies, 3), dtype=bool)
+        n_euler = len(self._euler_idxs)
+        self._euler_rot = np.zeros((n_euler, 3, 3))
+        self._euler_out = np.zeros((n_euler, 3))
+        self._euler_tmp = np.zeros(n_euler)
+
+    def update_6d(self, component_6d):
+        """Update from the body list of a QTM 6d component. Returns the valid mask."""
+        pos_mm, rot_raw = self._pos_mm, self._rot_raw
+        for i, body in enumerate(component_6d):
+            pos_mm[i] = body[0]
+            rot_raw[i] = body[1].matrix
+
+        # Validity for all bodies at once: QTM marks lost bodies with NaN
+        np.isfinite(pos_mm, out=self._finite)
+        self._finite.all(axis=1, out=self.valid)
+
+        mask = self.valid[:, None]
+        np.multiply(pos_mm, 0.001, out=pos_mm)
+        np.copyto(self.pos, pos_mm, where=mask)
+        np.copyto(self._rot_qtm, rot_raw, where=mask)
+        self.lost += 1
+        np.copyto(self.lost, 0, where=self.valid)
+        self.frames += 1
+
+        if self.euler_mode == 'eager':
+            self._update_euler()
+        elif self.euler_mode == 'lazy':
+            self._euler_dirty = True
+        return self.valid
+
+    def _update_euler(self):
+        """Derive euler angles from the rotation matrices of the tracked bodies in one batch.
+
+        Uses the QTM default convention R = Rx(roll) * Ry(pitch) * Rz(yaw), in degrees.
+        """
+        self._euler_dirty = False
+        rot, out, tmp = self._euler_rot, self._euler_out, self._euler_tmp
+        np.take(self.rot, self._euler_idxs, axis=0, out=rot)
+        # roll = atan2(-R12, R22)
+        np.negative(rot[:, 1, 2], out=tmp)
+        np.arctan2(tmp, rot[:, 2, 2], out=out[:, 0])
+        # pitch = asin(R02)
+        np.clip(rot[:, 0, 2], -1.0, 1.0, out=tmp)
+        np.arcsin(tmp, out=out[:, 1])
+        # yaw = atan2(-R01, R00)
+        np.negative(rot[:, 0, 1], out=tmp)
+        np.arctan2(tmp, rot[:, 0, 0], out=out[:, 2])
+        np.degrees(out, out=out)
+        self.euler[self._euler_idxs] = out
+
+    def update_6deuler(self, component_6deuler):
+        """Update euler angles from a QTM 6deuler component (bodies invalid in 6d are skipped)."""
+        euler_raw = self._euler_raw
+        for i, body in enumerate(component_6deuler):
+            # QTM order is (yaw, pitch, roll) with the default euler definition
+            euler_raw[i] = body[1][2], body[1][1], body[1][0]
+        np.copyto(self.euler, euler_raw, where=self.valid[:, None])
+
+    def position(self, idx):
+        x, y, z = self.pos[idx]
+        return float(x), float(y), float(z)
+
+    def refresh_euler(self):
+        """Derive pending lazy euler angles now, e.g. before reading self.euler directly."""
+        if self._euler_dirty:
+            self._update_euler()
+
+    def yaw(self, idx):
+        self.refresh_euler()
+        return float(self.euler[idx, 2])
+
+    def extpose(self, idx):
+        """Snapshot [x, y, z, rotmatrix] of one body for handing over to another thread."""
+        x, y, z = self.position(idx)
+        return [x, y, z, self.rot[idx].copy()]
+
+
+class PosePredictor:
+    """Alpha-beta(-gamma) tracking filter on the positions of all bodies at once.
+
+    Estimates velocity (and acceleration if gamma > 0) per body from every
+    frame, so a target can be extrapolated forward by the latency it will
+    have by the time the Crazyflie acts on it.
+    Bodies not seen in a frame keep their state, and are filtered over the
+    time since they were last seen. A body back after more than max_gap s
+    restarts at rest where it is. Nothing is allocated per frame.
+    """
+    def __init__(self, n_bodies, alpha=0.4, beta=0.05, gamma=0.0, max_horizon=0.1, max_gap=0.05):
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.max_horizon = max_horizon
+        self.max_gap = max_gap
+
+        self.pos = np.zeros((n_bodies, 3))
+        self.vel = np.zeros((n_bodies, 3))
+        self.acc = np.zeros((n_bodies, 3))
+        self._initialized = np.zeros(n_bodies, dtype=bool)
+        # QTM timestamp (us) each body was last seen at
+        self._last_seen = np.zeros(n_bodies, dtype=np.int64)
+        # time.monotonic() of the latest update
+        self.updated = 0.0
+
+        self._elapsed = np.zeros(n_bodies, dtype=np.int64)
+        self._dt = np.zeros((n_bodies, 1))
+        self._dt2 = np.zeros((n_bodies, 1))
+        self._mask = np.zeros((n_bodies, 1), dtype=bool)
+        self._restart = np.zeros((n_bodies, 1), dtype=bool)
+        self._flags = np.zeros(n_bodies, dtype=bool)
+        self._pred_pos = np.zeros((n_bodies, 3))
+        self._pred_vel = np.zeros((n_bodies, 3))
+        self._residual = np.zeros((n_bodies, 3))
+        self._tmp = np.zeros((n_bodies, 3))
+
+    def update(self, measured, valid, timestamp_us):
+        """Filter one frame. measured: (n, 3) positions in m, valid: (n,) mask, timestamp_us: QTM timestamp."""
+        self.updated = time.monotonic()
+        mask, restart, flags = self._mask[:, 0], self._restart[:, 0], self._flags
+        dt, dt2 = self._dt, self._dt2
+        # Time since each body was last seen
+        np.subtract(timestamp_us, self._last_seen, out=self._elapsed)
+        np.multiply(self._elapsed, 1e-6, out=dt[:, 0])
+        # Filter bodies seen now and within max_gap before, restart new ones and those back from a longer gap
+        np.less_equal(dt[:, 0], self.max_gap, out=flags)
+        np.logical_and(flags, self._initialized, out=flags)
+        np.greater(dt[:, 0], 0.0, out=mask)
+        np.logical_and(mask, flags, out=mask)
+        np.logical_and(mask, valid, out=mask)
+        np.logical_not(flags, out=restart)
+        np.logical_and(restart, valid, out=restart)
+        # Bodies not filtered get a harmless dt, their results are not used
+        np.logical_not(mask, out=flags)
+        np.copyto(dt[:, 0], 1.0, where=flags)
+        np.multiply(dt, dt, out=dt2)
+
+        pred_pos, pred_vel, residual, tmp = self._pred_pos, self._pred_vel, self._residual, self._tmp
+        # Predict: pos + vel * dt + acc * dt^2 / 2, vel + acc * dt
+        np.multiply(self.vel, dt, out=pred_pos)
+        np.add(self.pos, pred_pos, out=pred_pos)
+        np.multiply(self.acc, dt2, out=tmp)
+        np.multiply(tmp, 0.5, out=tmp)
+        np.add(pred_pos, tmp, out=pred_pos)
+        np.multiply(self.acc, dt, out=pred_vel)
+        np.add(self.vel, pred_vel, out=pred_vel)
+        # Correct with the residual
+        np.subtract(measured, pred_pos, out=residual)
+        np.multiply(residual, self.alpha, out=tmp)
+        np.add(pred_pos, tmp, out=tmp)
+        np.copyto(self.pos, tmp, where=self._mask)
+        np.divide(residual, dt, out=tmp)
+        np.multiply(tmp, self.beta, out=tmp)
+        np.add(pred_vel, tmp, out=tmp)
+        np.copyto(self.vel, tmp, where=self._mask)
+        if self.gamma:
+            np.divide(residual, dt2, out=tmp)
+            np.multiply(tmp, 2.0 * self.gamma, out=tmp)
+            np.add(self.acc, tmp, out=tmp)
+            np.copyto(self.acc, tmp, where=self._mask)
+
+        # New bodies and those back from a gap start at rest where they are
+        np.copyto(self.pos, measured, where=self._restart)
+        np.copyto(self.vel, 0.0, where=self._restart)
+        np.copyto(self.acc, 0.0, where=self._restart)
+        np.copyto(self._last_seen, timestamp_us, where=mask)
+        np.copyto(self._last_seen, timestamp_us, where=restart)
+        np.logical_or(self._initialized, valid, out=self._initialized)
+
+    def predict(self, idx, horizon):
+        """Position of one body extrapolated horizon s past the latest frame (capped at max_horizon)."""
+        h = max(0.0, min(horizon, self.max_horizon))
+        p, v, a = self.pos[idx], self.vel[idx], self.acc[idx]
+        k = 0.5 * h * h
+        return (float(p[0] + v[0] * h + a[0] * k),
+                float(p[1] + v[1] * h + a[1] * k),
+                float(p[2] + v[2] * h + a[2] * k))
+
+
+#
+# RECORDING AND REPLAY
+#
+
+
+# Minimal stand-ins for the qtm packet types, enough for QtmWrapper._on_packet
+Body6d = namedtuple('Body6d', ['position', 'rotation'])
+Rotation = namedtuple('Rotation', ['matrix'])
+
+RECORDING_MAGIC = b'QTMREC01'
+_recording_header = struct.Struct('<8sII')
+
+
+def recording_dtype(n_bodies):
+    """Record layout: QTM timestamp (us), frame number and the raw 6d component (mm, column-major)."""
+    return np.dtype([('timestamp', '<u8'),
+                     ('framenumber', '<u4'),
+                     ('reserved', '<u4'),
+                     ('pos', '<f4', (n_bodies, 3)),
+                     ('rot', '<f4', (n_bodies, 9))])
+
+
+class FlightRecorder:
+    """Append raw QTM 6DOF frames to a compact binary file.
+
+    The file is a small header (magic, body count, header size, body names)
+    followed by fixed-size records, so it can be memory-mapped as one array.
+    """
+    def __init__(self, path, body_names, flush_every=100):
+        self.path = path
+        self.body_names = list(body_names)
+        self.frames = 0
+        self.flush_every = flush_every
+
+        names = '\n'.join(self.body_names).encode('utf-8')
+        header_size = _recording_header.size + len(names)
+        self._file = open(path, 'wb')
+        self._file.write(_recording_header.pack(RECORDING_MAGIC, len(self.body_names), header_size))
+        self._file.write(names)
+
+        # One preallocated record, written out through a memoryview
+        self._record = np.zeros(1, dtype=recording_dtype(len(self.body_names)))
+        self._pos = self._record['pos'][0]
+        self._rot = self._record['rot'][0]
+        self._view = memoryview(self._record).cast('B')
+
+    def write(self, timestamp, framenumber, component_6d):
+        record = self._record[0]
+        record['timestamp'] = timestamp
+        record['framenumber'] = framenumber
+        for i, body in enumerate(component_6d):
+            self._pos[i] = body[0]
+            self._rot[i] = body[1].matrix
+        self._file.write(self._view)
+        self.frames += 1
+        if self.frames % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def open_recording(path):
+    """Memory-map a recording. Returns (body_names, records) without reading the records into RAM."""
+    with open(path, 'rb') as f:
+        magic, n_bodies, header_size = _recording_header.unpack(f.read(_recording_header.size))
+        if magic != RECORDING_MAGIC:
+            raise ValueError("'" + path + "' is not a QTM recording")
+        names = f.read(header_size - _recording_header.size).decode('utf-8')
+    body_names = names.split('\n') if n_bodies else []
+    dtype = recording_dtype(n_bodies)
+    # A recording cut short mid-record (e.g. crash) still maps up to the last full frame
+    n_records = (os.path.getsize(path) - header_size) // dtype.itemsize
+    records = np.memmap(path, dtype=dtype, mode='r', offset=header_size, shape=(n_records,))
+    return body_names, records
+
+
+class ReplayPacket:
+    """Recorded frame that looks like a qtm.QRTPacket to QtmWrapper._on_packet."""
+    def __init__(self, record):
+        self.timestamp = int(record['timestamp'])
+        self.framenumber = int(record['framenumber'])
+        self._record = record
+
+    def get_6d(self):
+        pos = self._record['pos'].tolist()
+        rot = self._record['rot'].tolist()
+        return None, [Body6d(p, Rotation(r)) for p, r in zip(pos, rot)]
+
+    def get_6d_euler(self):
+        # Recordings hold the 6d component only, derive euler angles on the host
+        return None, None
+
+
+async def replay_recording(records, on_packet, speed=1.0, should_stop=None):
+    """Feed recorded frames to on_packet.
+
+    speed: 1.0 for real time, > 1.0 for accelerated, None to replay as fast as possible
+    should_stop: optional callable, polled between frames
+    """
+    if len(records) == 0:
+        return
+    t0_qtm = int(records[0]['timestamp'])
+    t0 = time.monotonic()
+    for record in records:
+        if should_stop is not None and should_stop():
+            break
+        if speed:
+            due = t0 + (int(record['timestamp']) - t0_qtm) / 1e6 / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Still give the event loop a chance between frames
+            await asyncio.sleep(0)
+        on_packet(ReplayPacket(record))
+
+
+#
+# SNAPSHOTS
+#
+
+
+class PoseView:
+    """Read-only poses of all bodies in one QTM frame, read like a PoseStore.
+
+    pos, rot, euler, valid and lost are laid out as in PoseStore. With
+    lazy_euler, euler is not filled in and yaw() derives the yaw from rot
+    when read. framenumber and timestamp (us) are those of the QTM frame,
+    received is time.perf_counter_ns() when it arrived.
+    """
+    def __init__(self, pos, rot, euler, valid, lost, framenumber=-1, timestamp=0, received=0):
+        self.pos = pos
+        self.rot = rot
+        self.euler = euler
+        self.valid = valid
+        self.lost = lost
+        self.framenumber = framenumber
+        self.timestamp = timestamp
+        self.received = received
+        self.lazy_euler = False
+
+    def age(self):
+        """Time since the frame arrived, in s."""
+        return (time.perf_counter_ns() - self.received) / 1e9
+
+    def intact(self):
+        """False if the data behind the view has been overwritten since it was taken."""
+        return True
+
+    def position(self, idx):
+        x, y, z = self.pos[idx]
+        return float(x), float(y), float(z)
+
+    def yaw(self, idx):
+        if self.lazy_euler:
+            # yaw = atan2(-R01, R00), as PoseStore derives it
+            r = self.rot[idx]
+            return math.degrees(math.atan2(-r[0, 1], r[0, 0]))
+        return float(self.euler[idx, 2])
+
+    def extpose(self, idx):
+        """Snapshot [x, y, z, rotmatrix] of one body for handing over to another thread."""
+        x, y, z = self.position(idx)
+        return [x, y, z, self.rot[idx].copy()]
+
+
+class PoseSnapshots:
+    """Double-buffered PoseView snapshots of a PoseStore.
+
+    publish() copies a frame into the back buffer and swaps it to the front
+    with one reference assignment. A reader that takes front once per step
+    sees all bodies from the same frame, stamped with its frame number,
+    timestamp and arrival time. Its view is only written to again by the
+    publish() after next.
+    """
+    def __init__(self, n_bodies):
+        self._buffers = [PoseView(np.zeros((n_bodies, 3)), np.zeros((n_bodies, 3, 3)), np.zeros((n_bodies, 3)),
+                                  np.zeros(n_bodies, dtype=bool), np.zeros(n_bodies, dtype=np.int64))
+                         for _ in range(2)]
+        self._back = 0
+        self.front = self._buffers[1]
+
+    def publish(self, poses, framenumber, timestamp, received):
+        """Snapshot a PoseStore as the newest frame. Returns the new front view."""
+        view = self._buffers[self._back]
+        np.copyto(view.pos, poses.pos)
+        np.copyto(view.rot, poses.rot)
+        # Lazy euler angles are left to the readers of the few bodies that need them
+        view.lazy_euler = poses.euler_mode == 'lazy'
+        if not view.lazy_euler:
+            np.copyto(view.euler, poses.euler)
+        np.copyto(view.valid, poses.valid)
+        np.copyto(view.lost, poses.lost)
+        view.framenumber = framenumber
+        view.timestamp = timestamp
+        view.received = received
+        self._back = 1 - self._back
+        self.front = view
+        return view
+
+
+#
+# SHARED MEMORY
+#
+
+
+class _RingView(PoseView):
+    def __init__(self, ring, slot, seq):
+        s = ring._slots[slot]
+        PoseView.__init__(self, s['pos'], s['rot'], s['euler'], s['valid'], s['lost'],
+                          int(s['framenumber']), int(s['timestamp']), int(s['received']))
+        self.decoded = int(s['decoded'])
+        self._ring = ring
+        self._slot = slot
+        self._seq = seq
+
+    def intact(self):
+        return self._ring._seq[self._slot] == self._seq
+
+
+def _attach(name):
+    """Attach to shared memory without the resource tracker unlinking it when this process exits."""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers, skip that
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def ring_dtype(n_bodies):
+    """Slot layout: sequence number, frame, QTM timestamp (us), perf_counter_ns stamps and the poses."""
+    return np.dtype([('seq', '<i8'),
+                     ('framenumber', '<i8'),
+                     ('timestamp', '<i8'),
+                     ('received', '<i8'),
+                     ('decoded', '<i8'),
+                     ('pos', '<f8', (n_bodies, 3)),
+                     ('rot', '<f8', (n_bodies, 3, 3)),
+                     ('euler', '<f8', (n_bodies, 3)),
+                     ('lost', '<i8', (n_bodies,)),
+                     ('valid', '?', (n_bodies,))], align=True)
+
+
+class PoseRing:
+    """Latest poses of all bodies in shared memory: one writer process, readers in other processes.
+
+    The ring holds the last slots frames. Every slot has a sequence number
+    (a seqlock): odd while the writer fills it, even once complete. latest()
+    skips slots being written and returns views straight into the shared
+    memory, nothing is copied or pickled. A view stays valid until the
+    writer comes round to its slot again, slots - 1 frames later: readers
+    copy what they need and check intact() before using it.
+
+    Created without name, the ring allocates the shared memory (and must
+    unlink() it in the end); with the name of an existing ring, it attaches.
+    """
+    def __init__(self, n_bodies, slots=8, name=None):
+        self.n_bodies = n_bodies
+        self.slots = slots
+        dtype = ring_dtype(n_bodies)
+        size = 64 + slots * dtype.itemsize
+        self.shm = SharedMemory(create=True, size=size) if name is None else _attach(name)
+        self.name = self.shm.name
+        # Frames published so far, in its own cache line
+        self._count = np.ndarray((1,), dtype='<i8', buffer=self.shm.buf)
+        self._slots = np.ndarray((slots,), dtype=dtype, buffer=self.shm.buf, offset=64)
+        self._seq = self._slots['seq']
+        self.published = 0
+
+    def publish(self, poses, framenumber, timestamp, received=0):
+        """Write the poses of a PoseStore (with euler angles up to date) as the newest frame."""
+        slot = self.published % self.slots
+        s = self._slots[slot]
+        self._seq[slot] += 1
+        s['framenumber'] = framenumber
+        s['timestamp'] = timestamp
+        s['received'] = received
+        s['pos'] = poses.pos
+        s['rot'] = poses.rot
+        s['euler'] = poses.euler
+        s['lost'] = poses.lost
+        s['valid'] = poses.valid
+        s['decoded'] = time.perf_counter_ns()
+        self._seq[slot] += 1
+        self.published += 1
+        self._count[0] = self.published
+
+    def latest(self):
+        """View of the newest complete frame, or None before the first one."""
+        count = int(self._count[0])
+        for back in range(1, min(count, self.slots) + 1):
+            slot = (count - back) % self.slots
+            seq = int(self._seq[slot])
+            if seq % 2 == 0:
+                return _RingView(self, slot, seq)
+        return None
+
+    def close(self):
+        """Detach, after which views taken from this ring must not be used."""
+        self._count = self._slots = self._seq = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, pipelined Crazyflie parameter writes.
+
+cf.param.set_value costs a radio round-trip per call, also when the
+parameter already has that value. ParamClient keeps the last known value of
+every parameter and drops writes that would not change anything. The rest
+are handed to cflib at once, without waiting for the acks of earlier writes
+to other parameters. cflib acknowledges every write through the param update
+callback, which is how completion is tracked.
+"""
+
+from collections import deque
+from threading import Condition
+
+
+def _same(a, b):
+    """Compare parameter values as the firmware would store them."""
+    if a is None or b is None:
+        return False
+    try:
+        x, y = float(a), float(b)
+    except ValueError:
+        return str(a) == str(b)
+    # Floats come back from the firmware in single precision
+    return abs(x - y) <= 1e-6 * max(1.0, abs(x), abs(y))
+
+
+class ParamClient:
+    """Parameter writes with a value cache, redundant-write elimination and pipelining.
+
+    set() returns at once. Writes to different parameters are all in flight
+    together; cflib's param updater puts them on the radio back to back. Each
+    parameter has one write in flight at a time, later writes to it wait for
+    its ack and are coalesced there (the latest value wins), unless
+    ordered=True. apply() sets a dict of parameters and waits once for all
+    acks. Waiting gives up after timeout s: writes still unacknowledged then
+    are counted as lost and forgotten. Counters tell how many writes went out
+    over the radio and how many were avoided.
+    """
+    def __init__(self, cf, timeout=2.0):
+        self.cf = cf
+        self.cache = {}
+        self.timeout = timeout
+
+        # Counters
+        self.requested = 0
+        self.issued = 0
+        self.avoided = 0
+        self.coalesced = 0
+        self.lost = 0
+
+        self._cond = Condition()
+        # name -> value written and not acknowledged yet
+        self._in_flight = {}
+        # name -> deque of [value, ordered] waiting for the write in flight
+        self._pending = {}
+
+        cf.param.add_update_callback(cb=self._on_update)
+
+    def _on_update(self, name, value):
+        """Param update callback, called by cflib when a write is acknowledged (or a value read)."""
+        with self._cond:
+            self.cache[name] = value
+            if name not in self._in_flight:
+                return
+            pending = self._pending.get(name)
+            if pending:
+                next_value = self._in_flight[name] = pending.popleft()[0]
+                if not pending:
+                    del self._pending[name]
+            else:
+                next_value = None
+                del self._in_flight[name]
+            self._cond.notify_all()
+        if next_value is not None:
+            self._issue(name, next_value)
+
+    def _issue(self, name, value):
+        try:
+            self.cf.param.set_value(name, value)
+        except Exception:
+            # Unknown or read-only parameter, nothing will be acknowledged
+            with self._cond:
+                self._in_flight.pop(name, None)
+                self._pending.pop(name, None)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self.issued += 1
+
+    def get(self, name):
+        """Cached value, read from the Crazyflie on a cache miss."""
+        if name not in self.cache:
+            self.cache[name] = self.cf.param.get_value(name)
+        return self.cache[name]
+
+    def set(self, name, value, ordered=False, wait=False):
+        """Write a parameter unless it already has value (or will have, once the writes in flight are done).
+
+        ordered: never coalesce with other pending writes to this parameter,
+        for sequences like pulsing 'kalman.resetEstimation' 1 then 0.
+        wait: wait for all writes like wait(). Returns False if that timed out.
+        """
+        with self._cond:
+            self.requested += 1
+            pending = self._pending.get(name)
+            if pending:
+                known = pending[-1][0]
+            else:
+                known = self._in_flight.get(name, self.cache.get(name))
+            if not ordered and _same(known, value):
+                self.avoided += 1
+                return self.wait() if wait else True
+            issue = name not in self._in_flight
+            if issue:
+                self._in_flight[name] = value
+            elif not ordered and pending and not pending[-1][1]:
+                pending[-1][0] = value
+                self.coalesced += 1
+            else:
+                self._pending.setdefault(name, deque()).append([value, ordered])
+        if issue:
+            self._issue(name, value)
+        return self.wait() if wait else True
+
+    def apply(self, params, timeout=None):
+        """Set all parameters in dict params, then wait once for all writes to complete. False on timeout."""
+        for name, value in params.items():
+            self.set(name, value)
+        return self.wait(timeout)
+
+    def wait(self, timeout=None):
+        """Wait until every write has been acknowledged, at most timeout (default self.timeout) s.
+
+        Returns False on timeout, after forgetting the writes that were not
+        acknowledged, so later writes to those parameters go out again.
+        """
+        with self._cond:
+            if self._cond.wait_for(lambda: not self._in_flight, self.timeout if timeout is None else timeout):
+                return True
+            self.lost += len(self._in_flight) + sum(len(pending) for pending in self._pending.values())
+            self._in_flight.clear()
+            self._pending.clear()
+            return False
+
+    def close(self, timeout=None):
+        """Wait up to timeout (default self.timeout) s for the writes in flight, then stop tracking updates."""
+        self.wait(timeout)
+        self.cf.param.all_update_callback.remove_callback(self._on_update)
+
+    def stats(self):
+        return {'requested': self.requested, 'issued': self.issued,
+                'avoided': self.avoided, 'coalesced': self.coalesced, 'lost': self.lost}
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the QTM real-time server, for benchmarking without a mocap system.
+
+Speaks enough of the QTM RT protocol (TCP, little endian) for cf-qualisys.py:
+the welcome message, 'Version', 'GetParameters 6D' and 'StreamFrames' with
+the 6D and 6DEuler components. Streams synthetic motion for any number of
+bodies, or loops a recording made with cf-qualisys.py (qtm_record_file).
+
+Prints once per second how many frames were sent and how long the client
+made the server wait (TCP back-pressure), which shows the frame rate at
+which the client starts falling behind.
+
+Usage: set qtm_ip = "127.0.0.1" in cf-qualisys.py, start this script, then cf-qualisys.py
+"""
+
+import asyncio
+import math
+import struct
+import time
+
+import numpy as np
+
+from mocap import open_recording
+
+
+#
+# SETTINGS
+#
+
+
+host = '127.0.0.1'
+port = 22223 # QTM RT default port
+
+frame_rate = 300 # in Hz, 100-1000
+body_names = ['cf', 'traqr20', 'traqr35'] # the first body hovers, the others move
+n_extra_bodies = 0 # additional moving bodies, named body0, body1, ...
+replay_file = None # e.g. 'flight.qtmrec', stream recorded motion instead of synthetic
+
+# Client is considered behind when this many bytes are waiting to be sent
+write_buffer_limit = 64 * 1024
+
+
+#
+# QTM RT PROTOCOL
+#
+
+
+PACKET_ERROR = 0
+PACKET_COMMAND = 1
+PACKET_XML = 2
+PACKET_DATA = 3
+PACKET_NO_MORE_DATA = 4
+
+COMPONENT_6D = 5
+COMPONENT_6D_EULER = 6
+
+_header = struct.Struct('<II')
+_data_header = struct.Struct('<QII')
+_component_header = struct.Struct('<II')
+_body_header = struct.Struct('<IHH')
+
+
+def pack_packet(packet_type, payload):
+    return _header.pack(_header.size + len(payload), packet_type) + payload
+
+
+def pack_string(packet_type, text):
+    return pack_packet(packet_type, text.encode('utf-8') + b'\0')
+
+
+def parameters_xml(names):
+    bodies = ''.join('<Body><Name>{}</Name><Color R="255" G="0" B="0"/></Body>'.format(name)
+                     for name in names)
+    return ('<QTM_Parameters_Ver_1.19><The_6D><Bodies>{}</Bodies>{}</The_6D>'
+            '</QTM_Parameters_Ver_1.19>').format(len(names), bodies)
+
+
+def pack_frame(timestamp, framenumber, pos, rot, euler, components):
+    """Pack one data packet. pos: (n, 3) mm, rot: (n, 9) column-major, euler: (n, 3) degrees."""
+    n = len(pos)
+    parts = []
+    if COMPONENT_6D in components:
+        body_data = np.hstack((pos, rot)).astype('<f4').tobytes()
+        parts.append(_component_header.pack(_component_header.size + _body_header.size + len(body_data),
+                                            COMPONENT_6D))
+        parts.append(_body_header.pack(n, 0, 0))
+        parts.append(body_data)
+    if COMPONENT_6D_EULER in components:
+        body_data = np.hstack((pos, euler)).astype('<f4').tobytes()
+        parts.append(_component_header.pack(_component_header.size + _body_header.size + len(body_data),
+                                            COMPONENT_6D_EULER))
+        parts.append(_body_header.pack(n, 0, 0))
+        parts.append(body_data)
+    payload = _data_header.pack(timestamp, framenumber, len(components)) + b''.join(parts)
+    return pack_packet(PACKET_DATA, payload)
+
+
+#
+# MOTION SOURCES
+#
+
+
+class SyntheticMotion:
+    """Bodies moving on circles around the room centre, each with its own phase and yaw."""
+    def __init__(self, names):
+        self.names = names
+        n = len(names)
+        self.phase = np.linspace(0.0, 2 * math.pi, n, endpoint=False)
+        self.pos = np.zeros((n, 3))
+        self.rot = np.zeros((n, 9))
+        self.euler = np.zeros((n, 3))
+
+    def frame(self, t):
+        angle = 0.5 * t + self.phase
+        # The first body (Crazyflie) hovers at 1 m, the others circle at hand height
+        self.pos[:, 0] = 500 * np.cos(angle)
+        self.pos[:, 1] = 500 * np.sin(angle)
+        self.pos[:, 2] = 1000 + 100 * np.sin(2 * angle)
+        self.pos[0] = (0.0, 0.0, 1000.0)
+        yaw = angle.copy()
+        yaw[0] = 0.0
+        c, s = np.cos(yaw), np.sin(yaw)
+        # Rotation about Z, column-major as QTM sends it
+        self.rot[:] = 0.0
+        self.rot[:, 0] = c
+        self.rot[:, 1] = s
+        self.rot[:, 3] = -s
+        self.rot[:, 4] = c
+        self.rot[:, 8] = 1.0
+        # QTM euler angles as read by cf-qualisys.py (yaw first)
+        self.euler[:, 0] = np.degrees(yaw)
+        return self.pos, self.rot, self.euler
+
+
+class RecordedMotion:
+    """Loop the frames of a recording."""
+    def __init__(self, path):
+        self.names, self.records = open_recording(path)
+        self.euler = np.zeros((len(self.names), 3))
+        self._i = 0
+
+    def frame(self, t):
+        record = self.records[self._i % len(self.records)]
+        self._i += 1
+        return record['pos'], record['rot'], self.euler
+
+
+#
+# SERVER
+#
+
+
+class QtmStandinProtocol(asyncio.Protocol):
+    """One client connection."""
+    def __init__(self, motion):
+        self.motion = motion
+        self.transport = None
+        self._buffer = b''
+        self._stream_task = None
+        self._paused = None
+        self.paused_time = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=write_buffer_limit)
+        print('Client connected: ' + str(transport.get_extra_info('peername')))
+        transport.write(pack_string(PACKET_COMMAND, 'QTM RT Interface connected'))
+
+    def connection_lost(self, exc):
+        print('Client disconnected.')
+        self._stop_stream()
+
+    def pause_writing(self):
+        self._paused = time.monotonic()
+
+    def resume_writing(self):
+        if self._paused is not None:
+            self.paused_time += time.monotonic() - self._paused
+            self._paused = None
+
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _header.size:
+            size, packet_type = _header.unpack_from(self._buffer)
+            if len(self._buffer) < size:
+                break
+            payload, self._buffer = self._buffer[_header.size:size], self._buffer[size:]
+            if packet_type == PACKET_COMMAND:
+                self._on_command(payload.rstrip(b'\0').decode('utf-8'))
+
+    def _on_command(self, command):
+        words = command.split()
+        if not words:
+            return
+        cmd = words[0].lower()
+        if cmd == 'version':
+            self.transport.write(pack_string(PACKET_COMMAND, 'Version set to ' + words[1]))
+        elif cmd == 'qtmversion':
+            self.transport.write(pack_string(PACKET_COMMAND, 'QTM Version is 2.x (stand-in)'))
+        elif cmd == 'getparameters':
+            self.transport.write(pack_string(PACKET_XML, parameters_xml(self.motion.names)))
+        elif cmd == 'streamframes':
+            if len(words) > 1 and words[1].lower() == 'stop':
+                self._stop_stream()
+                self.transport.write(pack_packet(PACKET_NO_MORE_DATA, b''))
+            else:
+                components = set()
+                for word in words[2:]:
+                    if word.lower() == '6d':
+                        components.add(COMPONENT_6D)
+                    elif word.lower() == '6deuler':
+                        components.add(COMPONENT_6D_EULER)
+                self._stop_stream()
+                self._stream_task = asyncio.ensure_future(self._stream(sorted(components)))
+        elif cmd == 'bye':
+            self.transport.close()
+        else:
+            self.transport.write(pack_string(PACKET_ERROR, 'Parse error'))
+
+    def _stop_stream(self):
+        if self._stream_task:
+            self._stream_task.cancel()
+            self._stream_task = None
+
+    async def _stream(self, components):
+        print('Streaming {} bodies at {} Hz, components {}'.format(
+            len(self.motion.names), frame_rate, components))
+        period = 1.0 / frame_rate
+        start = time.monotonic()
+        framenumber = 0
+        sent_last = 0
+        paused_last = 0.0
+        dropped = 0
+        dropped_last = 0
+        report = start + 1.0
+        while not self.transport.is_closing():
+            deadline = start + framenumber * period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            t = deadline - start
+            if self._paused is None:
+                pos, rot, euler = self.motion.frame(t)
+                self.transport.write(pack_frame(int(t * 1e6), framenumber, pos, rot, euler, components))
+            else:
+                # Client is not reading fast enough, drop the frame like QTM does
+                dropped += 1
+            framenumber += 1
+
+            now = time.monotonic()
+            if now >= report:
+                paused = self.paused_time + (now - self._paused if self._paused is not None else 0.0)
+                buffered = self.transport.get_write_buffer_size()
+                print('Sent {:5d} frames/s | dropped {:5d} | waited on client {:5.1f}% | buffered {:7d} B{}'.format(
+                    (framenumber - sent_last) - (dropped - dropped_last), dropped - dropped_last,
+                    100 * (paused - paused_last), buffered,
+                    ' | CLIENT FALLING BEHIND' if dropped > dropped_last else ''))
+                sent_last = framenumber
+                dropped_last = dropped
+                paused_last = paused
+                report += 1.0
+
+
+async def main():
+    if replay_file:
+        motion = RecordedMotion(replay_file)
+    else:
+        motion = SyntheticMotion(body_names + ['body' + str(i) for i in range(n_extra_bodies)])
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: QtmStandinProtocol(motion), host, port)
+    print('QTM stand-in listening on {}:{}'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+asyncio.run(main())
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Timing helpers for fixed-rate control loops.
+"""
+
+import asyncio
+import time
+
+
+class RateScheduler:
+    """Drift-free periodic scheduler with overrun and jitter statistics.
+
+    Deadlines are start + k * period, so sleeping inaccuracies never accumulate.
+    When a tick runs later than a whole period, the missed deadlines are skipped
+    and counted as overruns instead of being fired back to back.
+    """
+    def __init__(self, rate_hz, jitter_window=4096):
+        self.period = 1.0 / rate_hz
+        self.ticks = 0
+        self.overruns = 0
+        self._jitter = [0.0] * jitter_window
+        self._jitter_count = 0
+        self._start = None
+        self._k = 0
+
+    def _next_deadline(self):
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+            self._k = 0
+        else:
+            self._k += 1
+        deadline = self._start + self._k * self.period
+
+        if now > deadline + self.period:
+            # Overrun: skip to the latest deadline that has passed, so this tick runs at once
+            # and the next one is back on the grid
+            missed = int((now - deadline) / self.period)
+            self.overruns += missed
+            self._k += missed
+            deadline = self._start + self._k * self.period
+        return deadline
+
+    def _woke(self, deadline):
+        # Wake-up jitter relative to the deadline
+        self._jitter[self._jitter_count % len(self._jitter)] = time.monotonic() - deadline
+        self._jitter_count += 1
+        self.ticks += 1
+
+    def wait(self):
+        """Sleep until the next deadline. Returns the deadline (time.monotonic based)."""
+        deadline = self._next_deadline()
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._woke(deadline)
+        return deadline
+
+    async def wait_async(self):
+        """Like wait(), but lets other tasks of the asyncio event loop run until the deadline."""
+        deadline = self._next_deadline()
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._woke(deadline)
+        return deadline
+
+    def jitter_percentile(self, p):
+        """Wake-up jitter percentile in s over the last jitter_window ticks."""
+        n = min(self._jitter_count, len(self._jitter))
+        if n == 0:
+            return 0.0
+        samples = sorted(self._jitter[:n])
+        return samples[min(n - 1, int(p / 100.0 * n))]
+
+    def stats(self):
+        return {'ticks': self.ticks, 'overruns': self.overruns,
+                'jitter_p50_ms': self.jitter_percentile(50) * 1000,
+                'jitter_p99_ms': self.jitter_percentile(99) * 1000}
+
+    def __str__(self):
+        return "Ticks: {} Overruns: {} Jitter p50: {:6.3f} ms p99: {:6.3f} ms".format(
+            self.ticks, self.overruns,
+            self.jitter_percentile(50) * 1000, self.jitter_percentile(99) * 1000)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Test geofence clamping: clamped points are at least margin inside the allowed space.
+Runs without any device, directly or with pytest.
+"""
+
+import numpy as np
+
+from geofence import Box, Cylinder, Geofence, Prism
+
+
+def random_points(geofence, n=20000, seed=0):
+    """Random points all over the grid, including the padding around the allowed space."""
+    top = geofence.origin + (geofence.shape - 1) * geofence.resolution
+    return np.random.default_rng(seed).uniform(geofence.origin, top, (n, 3))
+
+
+def test_box_clamp_is_exact():
+    box = Box((-1.0, -2.0, 0.0), (1.0, 1.0, 1.5))
+    geofence = Geofence([box])
+    points = random_points(geofence)
+    for margin in (0.0, 0.2):
+        clamped = geofence.clamp(points, margin=margin)
+        expected = np.clip(points, box.min + margin, box.max - margin)
+        assert np.abs(clamped - expected).max() < 1e-12
+        assert box.sdf(clamped).max() <= -margin + 1e-12
+    assert np.allclose(geofence.clamp((2.0, 2.0, 2.0)), (1.0, 1.0, 1.5))
+
+
+def test_box_exit_distance_is_per_axis():
+    geofence = Geofence([Box((-1.0, -2.0, 0.0), (1.0, 1.0, 1.5))])
+    # 0.15 m outside in x and y is within a 0.2 m margin on every side
+    assert np.allclose(geofence.exit_distance([(1.15, 1.15, 1.0), (0.0, 0.0, 0.5)]), (0.15, -0.5))
+
+
+def test_clamp_around_no_fly_volumes():
+    pillar = Cylinder((0.0, -1.0), 0.2, (0.0, 3.0))
+    table = Prism([(0.3, 0.0), (0.9, 0.0), (0.9, 0.6), (0.3, 0.6)], (0.0, 0.8))
+    geofence = Geofence([Box((-1.0, -2.0, 0.0), (1.0, 1.0, 1.5))], [pillar, table])
+    points = np.vstack((random_points(geofence), [(0.0, -1.0, 0.7), (2.0, 2.0, 2.0)]))
+    for margin in (0.0, 0.1):
+        clamped = geofence.clamp(points, margin=margin)
+        assert geofence.distance(clamped).max() <= -margin
+        # Points already inside stay where they are
+        inside = geofence.distance(points) <= -margin
+        assert np.array_equal(clamped[inside], points[inside])
+
+
+def test_clamp_fallback():
+    geofence = Geofence([Box((-1.0, -2.0, 0.0), (1.0, 1.0, 1.5))], [Cylinder((0.0, -1.0), 0.2, (0.0, 3.0))])
+    safe = np.array((0.5, 0.5, 1.0))
+    clamped = geofence.clamp((0.0, -1.0, 0.7), iterations=0, fallback=safe)
+    assert np.array_equal(clamped, safe)
+
+
+if __name__ == '__main__':
+    test_box_clamp_is_exact()
+    test_box_exit_distance_is_per_axis()
+    test_clamp_around_no_fly_volumes()
+    test_clamp_fallback()
+    print('OK')
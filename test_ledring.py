@@ -12,13 +12,13 @@ from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.utils import uri_helper
 
-from helpers import cf_preflight_reset
+from helpers import CACHE_DIR, cf_preflight_reset
 
 
 # Init
 cflib.crtp.init_drivers()
 cf_uri = uri_helper.uri_from_env()
-cf = Crazyflie()
+cf = Crazyflie(rw_cache=CACHE_DIR)
 
 
 print(f'Establishing synchronous connection to Crazyflie at "{cf_uri}"...')
@@ -27,7 +27,7 @@ with SyncCrazyflie(cf_uri, cf=cf) as scf:
     print(f'Connected to Crazyflie at "{cf_uri}"...')
 
     print('Pre-flight reset...')
-    cf_preflight_reset(cf)
+    cf_preflight_reset(cf).close()
 
     ring_neffect = cf.param.get_value('ring.neffect')
     print(f'{ring_neffect} effects available on LED ring.')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Follow a moving target with short polynomial trajectory segments instead of
+a position setpoint per frame.
+
+SegmentPlanner fits a quintic segment from where the drone is heading now
+to where the target is predicted to be, and only plans a new one when the
+target leaves the path that segment converges onto. TrajectoryStreamer uploads segments to the
+trajectory memory and runs them with the high-level commander, so the radio
+carries a few packets per segment instead of a setpoint per control tick.
+"""
+
+import math
+
+import numpy as np
+
+from cflib.crazyflie.mem import MemoryElement, Poly, Poly4D
+
+
+# Trajectory memory bytes per Poly4D piece: duration and 4 x 8 float coefficients
+PIECE_SIZE = 132
+
+
+def quintic(p0, v0, a0, p1, v1, a1, duration):
+    """Coefficients (ascending, padded to 8) of quintics from (p0, v0, a0) to (p1, v1, a1), per axis."""
+    T = duration
+    dp = p1 - p0
+    coeffs = np.zeros((len(p0), 8))
+    coeffs[:, 0] = p0
+    coeffs[:, 1] = v0
+    coeffs[:, 2] = a0 / 2.0
+    coeffs[:, 3] = (20.0 * dp - (8.0 * v1 + 12.0 * v0) * T - (3.0 * a0 - a1) * T ** 2) / (2.0 * T ** 3)
+    coeffs[:, 4] = (-30.0 * dp + (14.0 * v1 + 16.0 * v0) * T + (3.0 * a0 - 2.0 * a1) * T ** 2) / (2.0 * T ** 4)
+    coeffs[:, 5] = (12.0 * dp - 6.0 * (v1 + v0) * T - (a0 - a1) * T ** 2) / (2.0 * T ** 5)
+    return coeffs
+
+
+class Segment:
+    """One polynomial piece in x, y, z and yaw (rad), started at time start (time.monotonic())."""
+    def __init__(self, start, duration, coeffs):
+        self.start = start
+        self.duration = duration
+        self.coeffs = coeffs
+
+    def state(self, t):
+        """Position, velocity and acceleration (each x, y, z, yaw) at time t, held after the end."""
+        s = min(max(t - self.start, 0.0), self.duration)
+        powers = s ** np.arange(8)
+        n = np.arange(8)
+        pos = self.coeffs @ powers
+        vel = self.coeffs[:, 1:] @ (n[1:] * powers[:-1])
+        acc = self.coeffs[:, 2:] @ (n[2:] * (n[2:] - 1) * powers[:-2])
+        if t - self.start >= self.duration:
+            vel[:] = 0.0
+            acc[:] = 0.0
+        return pos, vel, acc
+
+
+class SegmentPlanner:
+    """Plan segments following a target moving at constant velocity and yaw rate, replanning only when needed.
+
+    Each segment converges onto the target path as extrapolated when it was
+    planned, the reference. A new segment is planned when the target is
+    predicted to be more than threshold (m) or yaw_threshold (deg) off the
+    reference lookahead seconds from now, or when the segment ends within
+    lookahead while the target still moves. Comparing against the reference
+    instead of the segment ignores the transient the drone flies while
+    converging. After a replan the thresholds only re-arm once the target is
+    back within release x threshold of the new reference (hysteresis), unless
+    it gets twice as far off. Segments last horizon seconds, longer if
+    max_speed (m/s) requires it, and start latency seconds from now, the time
+    it takes to get them on board. Lookahead and horizon are stretched to
+    cover at least one min_interval, the shortest time between replans.
+    """
+    def __init__(self, horizon=1.0, threshold=0.05, lookahead=0.2, latency=0.05, min_interval=0.1,
+                 max_speed=None, yaw_threshold=10.0, release=0.5, yaw_window=0.1, yaw_alpha=0.5):
+        self.lookahead = max(lookahead, min_interval)
+        self.horizon = max(horizon, self.lookahead + min_interval)
+        self.threshold = threshold
+        self.latency = latency
+        self.min_interval = min_interval
+        self.max_speed = max_speed
+        self.yaw_threshold = math.radians(yaw_threshold)
+        self.release = release
+        self.yaw_window = yaw_window
+        self.yaw_alpha = yaw_alpha
+
+        self.segment = None
+        self.planned = 0
+        self.yaw_rate = 0.0
+        self._reference = None
+        self._armed = True
+        self._last_plan = -math.inf
+        self._yaw_sample = None
+
+    def _update_yaw_rate(self, now, yaw):
+        """Low-pass yaw rate (rad/s) from yaw samples at least yaw_window seconds apart."""
+        if self._yaw_sample is None:
+            self._yaw_sample = (now, yaw)
+            return
+        t, last = self._yaw_sample
+        if now - t >= self.yaw_window:
+            rate = math.remainder(yaw - last, 2.0 * math.pi) / (now - t)
+            self.yaw_rate += self.yaw_alpha * (rate - self.yaw_rate)
+            self._yaw_sample = (now, yaw)
+
+    def _extrapolate(self, t):
+        """Target position and yaw on the reference at time t."""
+        t0, target, velocity, acceleration, yaw, yaw_rate = self._reference
+        dt = t - t0
+        return target + velocity * dt + 0.5 * acceleration * dt ** 2, yaw + yaw_rate * dt
+
+    def _deviation(self, now, target, velocity, acceleration, yaw):
+        predicted = target + velocity * self.lookahead + 0.5 * acceleration * self.lookahead ** 2
+        predicted_yaw = yaw + self.yaw_rate * self.lookahead
+        position, reference_yaw = self._extrapolate(now + self.lookahead)
+        yaw_error = abs(math.remainder(predicted_yaw - reference_yaw, 2.0 * math.pi))
+        return np.linalg.norm(predicted - position), yaw_error
+
+    def update(self, now, target, velocity, yaw, acceleration=None, position=None):
+        """New segment for target position, velocity and acceleration (m, m/s, m/s^2) and yaw (deg),
+        or None if the plan holds.
+
+        position: current position of the drone, where the first segment starts.
+        """
+        target = np.asarray(target, dtype=float)
+        velocity = np.asarray(velocity, dtype=float)
+        acceleration = np.zeros(3) if acceleration is None else np.asarray(acceleration, dtype=float)
+        yaw = math.radians(yaw)
+        self._update_yaw_rate(now, yaw)
+        if self.segment is not None:
+            distance, yaw_error = self._deviation(now, target, velocity, acceleration, yaw)
+            if distance < self.release * self.threshold and yaw_error < self.release * self.yaw_threshold:
+                self._armed = True
+            if now - self._last_plan < self.min_interval:
+                return None
+            off = distance > self.threshold or yaw_error > self.yaw_threshold
+            far = distance > 2.0 * self.threshold or yaw_error > 2.0 * self.yaw_threshold
+            moving = (np.linalg.norm(velocity) * self.lookahead > self.release * self.threshold
+                      or abs(self.yaw_rate) * self.lookahead > self.release * self.yaw_threshold)
+            ending = now + self.lookahead > self.segment.start + self.segment.duration
+            if not (off and self._armed or far or ending and moving):
+                return None
+
+        self._reference = (now, target, velocity, acceleration, yaw, self.yaw_rate)
+        self._armed = False
+        start = now + self.latency
+        if self.segment is None:
+            p0 = np.append(position if position is not None else target, yaw)
+            v0 = np.zeros(4)
+            a0 = np.zeros(4)
+        else:
+            p0, v0, a0 = self.segment.state(start)
+        if self.max_speed:
+            speed = np.linalg.norm(velocity)
+            if speed > self.max_speed:
+                velocity = velocity * (self.max_speed / speed)
+
+        # Long enough for the distance at max_speed, the peak speed of a quintic is 1.875 x its mean
+        duration = self.horizon
+        if self.max_speed:
+            end = target + velocity * duration
+            duration = max(duration, 1.875 * np.linalg.norm(end - p0[:3]) / self.max_speed)
+        # Converge onto the target extrapolated to the end of the segment, from now
+        T = duration + self.latency
+        end_yaw = yaw + self.yaw_rate * T
+        p1 = np.append(target + velocity * T + 0.5 * acceleration * T ** 2,
+                       p0[3] + math.remainder(end_yaw - p0[3], 2.0 * math.pi))
+        v1 = np.append(velocity + acceleration * T, self.yaw_rate)
+        a1 = np.append(acceleration, 0.0)
+        coeffs = quintic(p0, v0, a0, p1, v1, a1, duration)
+
+        self.segment = Segment(start, duration, coeffs)
+        self.planned += 1
+        self._last_plan = now
+        return self.segment
+
+
+class TrajectoryStreamer:
+    """Upload segments to the trajectory memory and start them with the high-level commander.
+
+    Segments alternate between two memory slots (trajectory ids 1 and 2), so
+    the running one is never overwritten. A segment planned while the
+    previous upload is still in flight is not sent: check ready() before
+    planning, send() returns False when busy.
+    """
+    def __init__(self, cf):
+        self.cf = cf
+        self.mem = cf.mem.get_mems(MemoryElement.TYPE_TRAJ)[0]
+        self.sent = 0
+        self.busy = 0
+        self.failed = 0
+        self._slot = 0
+        self._defined = set()
+        self._in_flight = False
+
+    def ready(self):
+        """True when no upload is in flight, so a new segment can be sent."""
+        return not self._in_flight
+
+    def send(self, segment):
+        if self._in_flight:
+            self.busy += 1
+            return False
+        x, y, z, yaw = (Poly(list(c)) for c in segment.coeffs)
+        self.mem.trajectory = [Poly4D(segment.duration, x, y, z, yaw)]
+        self._slot = 1 - self._slot
+        self._in_flight = True
+        self.mem.write_data(self._written, self._write_failed, start_addr=self._slot * PIECE_SIZE)
+        return True
+
+    def _written(self, mem, addr):
+        trajectory_id = self._slot + 1
+        hlc = self.cf.high_level_commander
+        if trajectory_id not in self._defined:
+            hlc.define_trajectory(trajectory_id, self._slot * PIECE_SIZE, 1)
+            self._defined.add(trajectory_id)
+        hlc.start_trajectory(trajectory_id, 1.0, relative=False)
+        self.sent += 1
+        self._in_flight = False
+
+    def _write_failed(self, mem, addr):
+        self.failed += 1
+        self._in_flight = False
+
+    def packets(self):
+        """Radio packets spent so far: memory writes of up to 24 bytes and a start per segment."""
+        return self.sent * (math.ceil(PIECE_SIZE / 24) + 1) + len(self._defined)
+
+    def stats(self):
+        return {'sent': self.sent, 'busy': self.busy, 'failed': self.failed, 'packets': self.packets()}
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Fill the shared log and param TOC cache (helpers.CACHE_DIR) ahead of a session.
+
+Connects to every Crazyflie once, which downloads and caches its TOCs, so
+the flight scripts connect from the cache instead. Run again after a
+firmware update.
+
+Usage: python warm-cache.py [uri ...]
+"""
+
+import os
+import sys
+import time
+
+import cflib.crtp
+
+from helpers import CACHE_DIR, cf_connect
+
+
+# Settings
+uris = ['radio://0/80/2M'] # used when no URIs are given on the command line
+
+
+cflib.crtp.init_drivers(enable_debug_driver=False)
+
+print('TOC cache: ' + CACHE_DIR)
+for uri in sys.argv[1:] or uris:
+    for run in ['download', 'cached']:
+        start = time.monotonic()
+        try:
+            scf = cf_connect(uri)
+        except Exception as ex:
+            print('{}: connection failed: {}'.format(uri, ex))
+            break
+        elapsed = time.monotonic() - start
+        toc = scf.cf.log.toc.toc, scf.cf.param.toc.toc
+        n_log, n_param = (sum(len(group) for group in t.values()) for t in toc)
+        scf.close_link()
+        print('{}: {:8} connect {:5.2f} s, {} log and {} param variables'.format(uri, run, elapsed, n_log, n_param))
+print('{} cached TOC file(s)'.format(len(os.listdir(CACHE_DIR)) if os.path.isdir(CACHE_DIR) else 0))